@@ -52,4 +52,43 @@ REQUEST_SENDER_DISMISS = [REQUEST_ENROLL_ACCEPTED,
 REQUEST_RECEIVER_DISMISS = [REQUEST_DEROLL,
                             REQUEST_QUIT]
 
-JSON_NULL = '{}'
\ No newline at end of file
+JSON_NULL = '{}'
+
+# Upper limit of the page size a client can ask for on paginated lists
+MAX_PAGE_SIZE = 500
+
+# Number of search results returned when the client does not ask for a page size
+SEARCH_PAGE_SIZE = 20
+
+# Number of messages returned when the client does not ask for a page size
+MESSAGE_PAGE_SIZE = 15
+
+# Number of lesson requests returned when the client does not ask for a page size
+REQUEST_PAGE_SIZE = 50
+
+# Number of list items encoded together into one chunk of a streamed response
+STREAM_CHUNK_SIZE = 100
+
+# Upper limit of the number of actions in a reg log batch. The ids of a batch
+# are passed to SQL as bound parameters, which SQLite limits to 999 per query.
+MAX_REG_LOG_BATCH = 500
+
+# Kinds of objects reported by /j/sync/
+SYNC_LESSON = 'lesson'
+SYNC_REG_LOG = 'reg_log'
+SYNC_REQUEST = 'request'
+SYNC_MESSAGE = 'message'
+
+# Seconds a sync token is moved back from the time of the sync, to catch the
+# writes that were still being committed while it ran
+SYNC_OVERLAP = 60
+
+# Days tombstones of deleted objects are kept. Clients with an older sync token
+# get a full sync.
+SYNC_TOMBSTONE_DAYS = 30
+
+# Seconds a long-poll pulse request waits for a change before it answers anyway
+PULSE_WAIT_TIMEOUT = 25
+
+# Seconds between the rechecks of the version stamps by a waiting pulse request
+PULSE_RECHECK_INTERVAL = 5
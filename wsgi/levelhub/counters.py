@@ -0,0 +1,117 @@
+from collections import defaultdict
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from levelhub.models import Lesson, LessonReg, LessonRegLog
+from levelhub.queries import active_reg_counts, count_new_lesson_requests, reg_log_counts
+
+
+# ############################################################################
+# Denormalized counters
+#
+# Database counters are updated with F() expressions so concurrent writers never
+# overwrite each other. Each update also moves update_time of the rows it
+# changes. Callers are expected to run the update in the same transaction as
+# the write it accounts for. The rebuild functions recompute the counters from
+# the source tables and are used by the rebuild_counters management command.
+#############################################################################
+
+# A registration of the lesson became active, or an active one stopped being so
+def lesson_reg_activated(lesson_id):
+    Lesson.objects.filter(id=lesson_id).update(active_reg_count=F('active_reg_count') + 1,
+                                               update_time=timezone.now())
+
+
+def lesson_reg_deactivated(lesson_id):
+    Lesson.objects.filter(id=lesson_id).update(active_reg_count=F('active_reg_count') - 1,
+                                               update_time=timezone.now())
+
+
+# The number of new lesson requests shown in the pulse is kept in the cache
+# with the generation of the user's requests it was counted at. Every change of
+# the user's requests starts a new generation once it has been committed, which
+# orphans the cached count, and the next pulse counts again. A count read from
+# the database before a change committed is stored with the old generation, so
+# it is never served after the change.
+def _new_requests_key(user_id):
+    return 'levelhub:new_requests:%d' % user_id
+
+
+def _requests_generation_key(user_id):
+    return 'levelhub:generation:requests:%d' % user_id
+
+
+def new_lesson_requests(user_id):
+    key, generation_key = _new_requests_key(user_id), _requests_generation_key(user_id)
+    cached = cache.get_many([key, generation_key])
+    generation = cached.get(generation_key)
+    if generation is None:
+        cache.add(generation_key, uuid.uuid4().hex, settings.PULSE_CACHE_TIMEOUT)
+        generation = cache.get(generation_key)
+    elif key in cached and cached[key][0] == generation:
+        return cached[key][1]
+    n = count_new_lesson_requests(user_id)
+    cache.set(key, (generation, n), settings.PULSE_CACHE_TIMEOUT)
+    return n
+
+
+# The new lesson requests of the users changed. Call after the change has been
+# committed.
+def new_lesson_requests_changed(*user_ids):
+    cache.set_many(dict((_requests_generation_key(user_id), uuid.uuid4().hex) for user_id in user_ids),
+                   settings.PULSE_CACHE_TIMEOUT)
+
+
+# Apply the reg log counter changes of a batch of reg log writes, given as
+# {lesson_reg_id: (change of total_logs, change of unused_logs)}. Registrations
+# with the same changes are updated together.
+def reg_log_counts_changed(changes):
+    reg_ids_by_change = defaultdict(list)
+    for reg_id, change in changes.items():
+        if change != (0, 0):
+            reg_ids_by_change[change].append(reg_id)
+    for (total, unused), reg_ids in reg_ids_by_change.items():
+        LessonReg.objects.filter(id__in=reg_ids).update(total_logs=F('total_logs') + total,
+                                                        unused_logs=F('unused_logs') + unused,
+                                                        update_time=timezone.now())
+
+
+# Recompute total_logs and unused_logs of the given registrations, or of all
+# registrations if lesson_regs is None. Return the ids of the registrations
+# whose counters were wrong. Nothing is written if check_only is True.
+def rebuild_reg_log_counters(lesson_regs=None, check_only=False):
+    if lesson_regs is None:
+        lesson_regs = LessonReg.objects.all()
+    log_counts = reg_log_counts(LessonRegLog.objects.filter(lesson_reg__in=lesson_regs.values('id')))
+
+    wrong_ids = []
+    for reg_id, total_logs, unused_logs in lesson_regs.values_list('id', 'total_logs', 'unused_logs'):
+        total, unused = log_counts.get(reg_id, (0, 0))
+        if (total_logs, unused_logs) != (total, unused):
+            wrong_ids.append(reg_id)
+            if not check_only:
+                LessonReg.objects.filter(id=reg_id).update(total_logs=total, unused_logs=unused,
+                                                           update_time=timezone.now())
+    return wrong_ids
+
+
+# Recompute active_reg_count of the given lessons, or of all lessons if lessons
+# is None. Return the ids of the lessons whose counter was wrong. Nothing is
+# written if check_only is True.
+def rebuild_active_reg_counts(lessons=None, check_only=False):
+    if lessons is None:
+        lessons = Lesson.objects.all()
+    nregs = active_reg_counts(LessonReg.objects.filter(lesson__in=lessons.values('id')))
+
+    wrong_ids = []
+    for lesson_id, active_reg_count in lessons.values_list('id', 'active_reg_count'):
+        if active_reg_count != nregs.get(lesson_id, 0):
+            wrong_ids.append(lesson_id)
+            if not check_only:
+                Lesson.objects.filter(id=lesson_id).update(active_reg_count=nregs.get(lesson_id, 0),
+                                                           update_time=timezone.now())
+    return wrong_ids
@@ -0,0 +1,33 @@
+from django.conf import settings
+
+
+# ############################################################################
+# SQLite connection setup
+#
+# Every new SQLite connection runs the pragmas of settings.SQLITE_PRAGMAS. In
+# WAL mode readers keep reading the last committed data while a transaction
+# writes, instead of waiting for it, and a writer only waits for the other
+# writers. How long a connection waits for a lock before it fails with
+# "database is locked" is the timeout option of the database, see
+# SQLITE_BUSY_TIMEOUT.
+#
+# The pragmas run on the raw connection, so they do not show among the
+# queries of the request that opened it.
+#############################################################################
+
+def setup_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in settings.SQLITE_PRAGMAS:
+        connection.connection.execute('PRAGMA %s = %s' % (name, value))
+
+
+# {pragma name: value} of the connection
+def pragmas(connection):
+    cursor = connection.cursor()
+    values = {}
+    for name, _ in settings.SQLITE_PRAGMAS + (('busy_timeout', None),):
+        cursor.execute('PRAGMA %s' % name)
+        row = cursor.fetchone()
+        values[name] = row[0] if row else None
+    return values
@@ -0,0 +1,104 @@
+from django.conf import settings
+from django.db import connection
+
+from levelhub.models import LessonReg, UserMessage
+from levelhub.consts import *
+
+
+# ############################################################################
+# Message inboxes for fan-out on write
+#
+# With settings.MESSAGE_FANOUT set to 'write', posting a message inserts a
+# UserMessage row for the teacher and every active student of each lesson the
+# message is sent to. A user's feed is then a range scan over the
+# (user, message) index of its inbox. Users who join a lesson get the messages
+# already sent to it, like the feed looked up through their lessons shows them.
+# Users who leave a lesson, and the members of a deleted lesson, lose the
+# messages of the lesson that were not also sent to another of their lessons,
+# so that an inbox only holds messages its user can see.
+#############################################################################
+
+# Condition of the inbox rows, of levelhub_usermessage, whose message is sent
+# to a lesson of the user other than the one given as a parameter
+SEEN_IN_OTHER_LESSON = """EXISTS (
+    SELECT 1 FROM levelhub_lessonmessage lm JOIN levelhub_lesson l ON l.id = lm.lesson_id
+    WHERE lm.message_id = levelhub_usermessage.message_id AND lm.lesson_id != %s AND l.status = %s
+    AND (l.teacher_id = levelhub_usermessage.user_id
+         OR EXISTS (SELECT 1 FROM levelhub_lessonreg lr
+                    WHERE lr.lesson_id = l.id AND lr.student_id = levelhub_usermessage.user_id
+                    AND lr.status = %s)))"""
+
+def fanout_on_write():
+    return settings.MESSAGE_FANOUT == 'write'
+
+
+# Deliver a new message to the inboxes of everyone in the given lessons
+def fan_out(message, lessons):
+    recipient_ids = set(lesson.teacher_id for lesson in lessons)
+    recipient_ids.update(LessonReg.objects.filter(lesson__in=[lesson.id for lesson in lessons],
+                                                  status=LESSON_REG_ACTIVE, student__isnull=False)
+                         .values_list('student', flat=True))
+    UserMessage.objects.bulk_create([UserMessage(user_id=user_id, message=message) for user_id in recipient_ids])
+
+
+# Add the inbox rows that are missing for the messages already posted,
+# addressed to the current teachers and active students of their lessons.
+# Return the number of rows added.
+def backfill():
+    cursor = connection.cursor()
+    cursor.execute("""
+        INSERT INTO levelhub_usermessage (user_id, message_id)
+        SELECT recipients.user_id, recipients.message_id FROM (
+            SELECT l.teacher_id AS user_id, lm.message_id AS message_id
+            FROM levelhub_lessonmessage lm JOIN levelhub_lesson l ON l.id = lm.lesson_id
+            UNION
+            SELECT lr.student_id AS user_id, lm.message_id AS message_id
+            FROM levelhub_lessonmessage lm JOIN levelhub_lessonreg lr ON lr.lesson_id = lm.lesson_id
+            WHERE lr.status = %s AND lr.student_id IS NOT NULL
+        ) recipients
+        WHERE NOT EXISTS (SELECT 1 FROM levelhub_usermessage um
+                          WHERE um.user_id = recipients.user_id AND um.message_id = recipients.message_id)
+        """, [LESSON_REG_ACTIVE])
+    return cursor.rowcount
+
+
+# Deliver the messages already sent to the lesson to the inbox of the user.
+# Call once the user's registration has been activated. Inboxes only receive
+# messages with fan-out on write, 'manage.py backfill_inbox' fills them when
+# switching to it.
+def lesson_joined(lesson_id, user_id):
+    if not fanout_on_write():
+        return
+    connection.cursor().execute("""
+        INSERT INTO levelhub_usermessage (user_id, message_id)
+        SELECT DISTINCT %s, lm.message_id FROM levelhub_lessonmessage lm
+        WHERE lm.lesson_id = %s
+        AND NOT EXISTS (SELECT 1 FROM levelhub_usermessage um
+                        WHERE um.user_id = %s AND um.message_id = lm.message_id)
+        """, [user_id, lesson_id, user_id])
+
+
+# Drop the messages of the lesson from the inbox of the user, or of everyone
+# if user_id is None, unless they were also sent to another lesson of theirs.
+# Call once the user's registration has been deactivated, or before the lesson
+# is deleted. Inboxes are kept whatever MESSAGE_FANOUT is, so that they are
+# still right after switching to 'write'.
+def lesson_left(lesson_id, user_id=None):
+    sql = """DELETE FROM levelhub_usermessage
+        WHERE message_id IN (SELECT message_id FROM levelhub_lessonmessage WHERE lesson_id = %s)
+        AND NOT """ + SEEN_IN_OTHER_LESSON
+    params = [lesson_id, lesson_id, LESSON_ACTIVE, LESSON_REG_ACTIVE]
+    if user_id is not None:
+        sql += ' AND user_id = %s'
+        params.append(user_id)
+    connection.cursor().execute(sql, params)
+
+
+# Delete the inbox rows of messages their users cannot see anymore, i.e. left
+# behind before inboxes were kept up to date by lesson_left. Return the number
+# of rows deleted.
+def prune():
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM levelhub_usermessage WHERE NOT ' + SEEN_IN_OTHER_LESSON,
+                   [0, LESSON_ACTIVE, LESSON_REG_ACTIVE])
+    return cursor.rowcount
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_syncdb
+
+from levelhub import models, search
+
+
+# syncdb creates regular tables only. Add the full text search tables and
+# their triggers once the levelhub tables exist.
+def install_search(sender, **kwargs):
+    search.install()
+
+post_syncdb.connect(install_search, sender=models)
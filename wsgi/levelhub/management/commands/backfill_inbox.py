@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from levelhub import inbox
+
+
+class Command(NoArgsCommand):
+    help = ('Write the UserMessage inbox rows missing for messages already posted and delete the ones of '
+            'messages their users cannot see anymore. Run before switching MESSAGE_FANOUT to write.')
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            n_added = inbox.backfill()
+            n_deleted = inbox.prune()
+        self.stdout.write('%d inbox row(s) added, %d deleted' % (n_added, n_deleted))
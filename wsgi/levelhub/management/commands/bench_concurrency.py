@@ -0,0 +1,164 @@
+from optparse import make_option
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Count
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from levelhub import dbtuning
+from levelhub.management.commands.bench_endpoints import BENCH_PASSWORD, make_client, percentile
+from levelhub.management.commands.seed_synthetic import SEED_OPTIONS, seed_from_options
+from levelhub.models import LessonReg, LessonRegLog
+from levelhub.consts import *
+
+
+class Command(NoArgsCommand):
+    help = ('Measure the read throughput of SQLite while reg log batches are being written. Seeds a scratch '
+            'database file, then for each journal mode runs reader threads fetching reg logs, rosters and sync '
+            'deltas of random students next to writer threads posting reg log batches as their teachers.')
+
+    option_list = NoArgsCommand.option_list + SEED_OPTIONS + (
+        make_option('--journal-modes', dest='journal_modes', default='delete,wal',
+                    help='Comma separated journal modes to compare.'),
+        make_option('--readers', type='int', dest='readers', default=4),
+        make_option('--writers', type='int', dest='writers', default=2),
+        make_option('--batch', type='int', dest='batch', default=20,
+                    help='Number of reg log actions in each posted batch.'),
+        make_option('--seconds', type='float', dest='seconds', default=10.0,
+                    help='Duration of the run of each journal mode.'),
+        make_option('--json', action='store_true', dest='json', default=False,
+                    help='Print the results as JSON.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        directory = tempfile.mkdtemp(prefix='levelhub-bench-')
+        # Threads only share a database in a file
+        settings.DATABASES['default']['TEST_NAME'] = os.path.join(directory, 'bench.sqlite3')
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+        pragmas = settings.SQLITE_PRAGMAS
+        try:
+            with transaction.atomic():
+                seed_from_options(options, BENCH_PASSWORD)
+            teachers = list(User.objects.filter(lesson__status=LESSON_ACTIVE,
+                                                lesson__lessonreg__status=LESSON_REG_ACTIVE)
+                            .annotate(n=Count('lesson__lessonreg')).order_by('-n')[:options['writers']])
+            students = list(User.objects.filter(lessonreg__status=LESSON_REG_ACTIVE).distinct()[:200])
+
+            results = []
+            for journal_mode in options['journal_modes'].split(','):
+                settings.SQLITE_PRAGMAS = tuple((name, journal_mode if name == 'journal_mode' else value)
+                                                for name, value in pragmas)
+                connection.close()
+                cache.clear()
+                results.append(self.run(teachers, students, options))
+        finally:
+            settings.SQLITE_PRAGMAS = pragmas
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+            teardown_test_environment()
+            shutil.rmtree(directory, True)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+            return
+        self.stdout.write('%-8s %10s %9s %9s %9s %10s %9s %8s'
+                          % ('journal', 'reads/s', 'p50 ms', 'p95 ms', 'p99 ms', 'batches/s', 'p95 ms', 'failed'))
+        for r in results:
+            self.stdout.write('%-8s %10.1f %9.2f %9.2f %9.2f %10.1f %9.2f %8d'
+                              % (r['journal_mode'], r['reads_per_second'], r['read_ms']['p50'],
+                                 r['read_ms']['p95'], r['read_ms']['p99'], r['batches_per_second'],
+                                 r['batch_ms']['p95'], r['failed']))
+
+    def run(self, teachers, students, options):
+        deadline = time.time() + options['seconds']
+        read_ms, batch_ms, failed = [], [], []
+        lock = threading.Lock()
+
+        def timed(client, method, path, data, latencies):
+            start = time.time()
+            try:
+                if method == 'get':
+                    response = client.get(path, data)
+                else:
+                    response = client.post(path, json.dumps(data), content_type='application/json')
+                if getattr(response, 'streaming', False):
+                    ''.join(response.streaming_content)
+                ok = response.status_code < 500
+            except DatabaseError:
+                # e.g. database is locked
+                ok = False
+            with lock:
+                if not ok:
+                    failed.append(path)
+                else:
+                    latencies.append((time.time() - start) * 1000.0)
+
+        def reader(seed):
+            rnd = random.Random(seed)
+            client = make_client()
+            try:
+                student = rnd.choice(students)
+                client.login(username=student.username, password=BENCH_PASSWORD)
+                lesson_regs = list(LessonReg.objects.filter(student=student, status=LESSON_REG_ACTIVE))
+                while time.time() < deadline:
+                    lesson_reg = rnd.choice(lesson_regs)
+                    timed(client, 'get', '/j/process_lesson_reg_logs/', {'reg_id': lesson_reg.id}, read_ms)
+                    timed(client, 'get', '/j/process_lesson_regs/', {'lesson_id': lesson_reg.lesson_id}, read_ms)
+                    timed(client, 'get', '/j/sync/', {}, read_ms)
+            finally:
+                connection.close()
+
+        def writer(teacher, seed):
+            rnd = random.Random(seed)
+            client = make_client()
+            try:
+                client.login(username=teacher.username, password=BENCH_PASSWORD)
+                reg_ids = list(LessonReg.objects.filter(lesson__teacher=teacher, status=LESSON_REG_ACTIVE)
+                               .values_list('id', flat=True))
+                while time.time() < deadline:
+                    # Create logs and use or delete some of the ones created before
+                    rlog_ids = list(LessonRegLog.objects.filter(lesson_reg__in=reg_ids)
+                                    .order_by('-id').values_list('id', flat=True)[:options['batch']])
+                    actions = []
+                    for _ in range(options['batch']):
+                        if rlog_ids and rnd.random() < 0.5:
+                            actions.append({'action': rnd.choice(['update', 'delete']), 'rlog_id': rlog_ids.pop(),
+                                            'use_time': '2014-07-02 12:00:00Z', 'data': '{}'})
+                        else:
+                            actions.append({'action': 'create', 'reg_id': rnd.choice(reg_ids), 'use_time': None,
+                                            'data': '{}'})
+                    timed(client, 'post', '/j/process_lesson_reg_logs/', actions, batch_ms)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(options['readers'])]
+        threads.extend(threading.Thread(target=writer, args=(teacher, i)) for i, teacher in enumerate(teachers))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        read_ms.sort()
+        batch_ms.sort()
+        return {'journal_mode': dbtuning.pragmas(connection)['journal_mode'],
+                'readers': options['readers'],
+                'writers': len(teachers),
+                'seconds': options['seconds'],
+                'reads_per_second': len(read_ms) / options['seconds'],
+                'read_ms': dict((p, percentile(read_ms, n) if read_ms else None)
+                                for p, n in (('p50', 50), ('p95', 95), ('p99', 99))),
+                'batches_per_second': len(batch_ms) / options['seconds'],
+                'batch_ms': dict((p, percentile(batch_ms, n) if batch_ms else None)
+                                 for p, n in (('p50', 50), ('p95', 95), ('p99', 99))),
+                'failed': len(failed)}
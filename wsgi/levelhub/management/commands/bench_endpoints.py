@@ -0,0 +1,310 @@
+from collections import defaultdict
+from datetime import datetime
+from itertools import count
+from optparse import make_option
+import json
+import platform
+import random
+import resource
+import sys
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+from levelhub.management.commands.seed_synthetic import SEED_OPTIONS, seed_from_options
+from levelhub.models import UserProfile, Lesson, LessonReg, LessonRegLog, LessonMessage, LessonRequest, Message
+from levelhub.consts import *
+
+
+BENCH_PASSWORD = 'bench'
+
+# Numbers the users made by the register endpoint
+REGISTER_SERIAL = count()
+
+
+# The cross domain middleware needs the Host header
+def make_client():
+    return Client(HTTP_HOST='testserver')
+
+
+# Rows for a write to act on. They are made before each request, outside of its
+# timing, so that the write can be repeated without using up the seeded data.
+def scratch_lesson(teacher, active_reg_count=0):
+    return Lesson.objects.create(teacher=teacher, name='Benchmark lesson', description='Made by the benchmark',
+                                 active_reg_count=active_reg_count)
+
+
+def scratch_reg(teacher, student):
+    return LessonReg.objects.create(lesson=scratch_lesson(teacher, 1), student=student)
+
+
+# A request of the sender as the teacher of a new lesson
+def scratch_request(sender, receiver, status):
+    return LessonRequest.objects.create(sender=sender, receiver=receiver, lesson=scratch_lesson(sender),
+                                        status=status)
+
+
+def scratch_message(sender, lesson_id):
+    message = Message.objects.create(sender=sender, body='Benchmark message')
+    LessonMessage.objects.create(lesson_id=lesson_id, message=message)
+    return message
+
+
+# (name, method, path, function making the data of a request from the context
+# of a benchmark user or returning None if it does not apply to the user). The
+# function is called before every request and may make the rows it acts on.
+# The writes to the seeded lessons only apply to the user managing a lesson,
+# the other party of the requests is the benchmark peer.
+ENDPOINTS = [
+    ('login', 'post', '/j/login/',
+     lambda ctx: {'username': ctx['user'].username, 'password': BENCH_PASSWORD}),
+    ('register', 'post', '/j/register/',
+     lambda ctx: {'username': 'benchreg%d' % next(REGISTER_SERIAL), 'password1': BENCH_PASSWORD,
+                  'password2': BENCH_PASSWORD}),
+    ('logout', 'post', '/j/logout/', lambda ctx: {}),
+    ('lessons all', 'get', '/j/process_lessons/', lambda ctx: {'category': 'all'}),
+    ('lessons teach', 'get', '/j/process_lessons/', lambda ctx: {'category': 'teach'}),
+    ('lessons study', 'get', '/j/process_lessons/', lambda ctx: {'category': 'study'}),
+    ('lesson requests', 'get', '/j/process_lesson_requests/', lambda ctx: {}),
+    ('lesson regs', 'get', '/j/process_lesson_regs/', lambda ctx: {'lesson_id': ctx['lesson_id']}),
+    ('lesson regs page', 'get', '/j/process_lesson_regs/',
+     lambda ctx: {'lesson_id': ctx['lesson_id'], 'limit': MAX_PAGE_SIZE}),
+    ('lesson reg logs', 'get', '/j/process_lesson_reg_logs/',
+     lambda ctx: {'reg_id': ctx['reg_id']} if ctx['reg_id'] else None),
+    ('messages newest', 'get', '/j/process_lesson_messages/',
+     lambda ctx: {'msg_id': 2 ** 31 - 1, 'action': 'older'}),
+    ('messages newer', 'get', '/j/process_lesson_messages/',
+     lambda ctx: {'msg_id': ctx['msg_id'], 'action': 'newer'}),
+    ('sync full', 'get', '/j/sync/', lambda ctx: {}),
+    ('sync delta', 'get', '/j/sync/', lambda ctx: {'token': ctx['sync_token']}),
+    ('pulse', 'get', '/j/pulse/', lambda ctx: {}),
+    ('user search', 'get', '/j/user_search', lambda ctx: {'phrase': 'First1'}),
+    ('lesson search', 'get', '/j/lesson_search', lambda ctx: {'phrase': 'Lesson 1'}),
+    ('lesson update', 'post', '/j/process_lessons/',
+     lambda ctx: {'action': 'update', 'lesson_id': ctx['lesson_id'], 'name': 'Lesson renamed',
+                  'description': 'Renamed by the benchmark'} if ctx['manages'] else None),
+    ('lesson reg update', 'post', '/j/process_lesson_regs/',
+     lambda ctx: {'reg_id': ctx['reg_id'], 'daytimes': 'Mon 10:00'} if ctx['manages'] and ctx['reg_id'] else None),
+    ('reg logs batch', 'post', '/j/process_lesson_reg_logs/',
+     lambda ctx: [{'action': 'create', 'reg_id': ctx['reg_id'], 'use_time': None, 'data': '{}'},
+                  {'action': 'update', 'rlog_id': ctx['rlog_id'], 'use_time': None, 'data': '{}'}]
+     if ctx['manages'] and ctx['rlog_id'] else None),
+    ('message post', 'post', '/j/process_lesson_messages/',
+     lambda ctx: {'action': 'create', 'lesson_ids': [ctx['lesson_id']], 'body': 'Benchmark message'}),
+    ('message delete', 'post', '/j/process_lesson_messages/',
+     lambda ctx: {'action': 'delete', 'message_id': scratch_message(ctx['user'], ctx['lesson_id']).id}),
+    ('lesson create', 'post', '/j/process_lessons/',
+     lambda ctx: {'action': 'create', 'name': 'Benchmark lesson', 'description': 'Made by the benchmark'}),
+    ('lesson delete', 'post', '/j/process_lessons/',
+     lambda ctx: {'action': 'delete', 'lesson_id': scratch_lesson(ctx['user']).id}),
+    ('request enroll', 'post', '/j/process_lesson_requests/',
+     lambda ctx: {'action': 'enroll', 'lesson_id': scratch_lesson(ctx['user']).id, 'student_id': ctx['peer'].id,
+                  'message': 'Benchmark enroll', 'daytimes': 'Mon 10:00'}),
+    ('request join', 'post', '/j/process_lesson_requests/',
+     lambda ctx: {'action': 'join', 'lesson_id': scratch_lesson(ctx['peer']).id, 'message': 'Benchmark join'}),
+    ('request accept', 'post', '/j/process_lesson_requests/',
+     lambda ctx: {'action': 'accept', 'req_id': scratch_request(ctx['peer'], ctx['user'], REQUEST_ENROLL).id}),
+    ('request reject', 'post', '/j/process_lesson_requests/',
+     lambda ctx: {'action': 'reject', 'req_id': scratch_request(ctx['peer'], ctx['user'], REQUEST_ENROLL).id}),
+    ('request dismiss', 'post', '/j/process_lesson_requests/',
+     lambda ctx: {'action': 'dismiss', 'req_id': scratch_request(ctx['peer'], ctx['user'], REQUEST_DEROLL).id}),
+    ('request deroll', 'post', '/j/process_lesson_requests/',
+     lambda ctx: {'action': 'deroll', 'reg_id': scratch_reg(ctx['user'], ctx['peer']).id}),
+    ('request quit', 'post', '/j/process_lesson_requests/',
+     lambda ctx: {'action': 'quit', 'reg_id': scratch_reg(ctx['peer'], ctx['user']).id}),
+]
+
+
+# Nearest rank percentile of the sorted values
+def percentile(values, p):
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+# The peak resident memory of the whole process, which never goes down
+def process_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class Command(NoArgsCommand):
+    help = ('Seed a scratch test database with synthetic data and drive every /j/ endpoint through the test '
+            'client as a few benchmark users. Report the p50/p95/p99 latency, queries per request and memory '
+            'of each endpoint as JSON, so that the results of releases can be compared. The memory is the '
+            'peak of the whole process after the endpoint ran and how much the endpoint raised it.')
+
+    option_list = NoArgsCommand.option_list + SEED_OPTIONS + (
+        make_option('--repeat', type='int', dest='repeat', default=20,
+                    help='Number of requests to each endpoint per benchmark user. The first one runs '
+                         'with a cold view cache.'),
+        make_option('--bench-users', type='int', dest='bench_users', default=3,
+                    help='Number of benchmark users: the busiest teacher, the busiest student, then random '
+                         'students.'),
+        make_option('--output', dest='output', default=None, help='Write the JSON results to this file.'),
+        make_option('--text', action='store_true', dest='text', default=False,
+                    help='Print a table instead of JSON.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+        try:
+            with transaction.atomic():
+                seed_from_options(options, BENCH_PASSWORD)
+            cache.clear()
+            contexts = self.make_contexts(options['bench_users'], random.Random(options['seed']))
+            results = {'meta': self.meta(options, contexts), 'endpoints': self.run(contexts, options['repeat'])}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+            teardown_test_environment()
+
+        if options['text']:
+            output = self.format_table(results)
+        else:
+            output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    # The context of each benchmark user: a lesson of the user, one of its
+    # registrations and a reg log of it
+    def make_contexts(self, n_users, rnd):
+        teachers = User.objects.filter(lesson__status=LESSON_ACTIVE).annotate(n=Count('lesson')).order_by('-n')
+        students = User.objects.filter(lessonreg__status=LESSON_REG_ACTIVE) \
+            .annotate(n=Count('lessonreg')).order_by('-n')
+        users = list(teachers[:1]) + list(students[:1])
+        student_ids = list(User.objects.filter(lessonreg__status=LESSON_REG_ACTIVE)
+                           .exclude(id__in=[user.id for user in users]).distinct().values_list('id', flat=True))
+        for user_id in rnd.sample(student_ids, min(max(n_users - len(users), 0), len(student_ids))):
+            users.append(User.objects.get(id=user_id))
+
+        # The other party of the requests
+        peer = User.objects.create_user('benchpeer', password=BENCH_PASSWORD)
+        UserProfile(user=peer).save()
+
+        contexts = []
+        for user in users[:n_users]:
+            lessons = Lesson.objects.filter(teacher=user, status=LESSON_ACTIVE)
+            manages = lessons.exists()
+            if manages:
+                lesson = lessons.annotate(n=Count('lessonreg')).order_by('-n')[0]
+                lesson_reg = LessonReg.objects.filter(lesson=lesson, status=LESSON_REG_ACTIVE).first()
+            else:
+                lesson_reg = LessonReg.objects.filter(student=user, status=LESSON_REG_ACTIVE) \
+                    .select_related('lesson').first()
+                lesson = lesson_reg.lesson
+            lesson_reg_log = LessonRegLog.objects.filter(lesson_reg=lesson_reg).first() if lesson_reg else None
+            first_message = LessonMessage.objects.filter(lesson=lesson).order_by('message').first()
+            contexts.append({'user': user,
+                             'peer': peer,
+                             'manages': manages,
+                             'lesson_id': lesson.id,
+                             'reg_id': lesson_reg.id if lesson_reg else None,
+                             'rlog_id': lesson_reg_log.id if lesson_reg_log else None,
+                             'msg_id': first_message.message_id if first_message else 0,
+                             'sync_token': None})
+        return contexts
+
+    def meta(self, options, contexts):
+        return {'time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%SZ'),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'options': dict((option.dest, options[option.dest]) for option in SEED_OPTIONS),
+                'repeat': options['repeat'],
+                'rows': dict((model.__name__, model.objects.count())
+                             for model in (User, Lesson, LessonReg, LessonRegLog, LessonRequest, Message)),
+                'bench_users': [{'username': ctx['user'].username, 'manages': ctx['manages']}
+                                for ctx in contexts]}
+
+    def run(self, contexts, repeat):
+        clients = []
+        for ctx in contexts:
+            client = make_client()
+            client.login(username=ctx['user'].username, password=BENCH_PASSWORD)
+            clients.append(client)
+
+        results = []
+        for name, method, path, make_data in ENDPOINTS:
+            latencies, queries, sizes = [], [], []
+            statuses = defaultdict(int)
+            rss_before = process_peak_rss_kb()
+            for ctx, client in zip(contexts, clients):
+                if name == 'sync delta' and ctx['sync_token'] is None:
+                    _, content = self.request(client, 'get', '/j/sync/', {})
+                    ctx['sync_token'] = json.loads(content)['main']['sync_token']
+                for _ in range(repeat):
+                    data = make_data(ctx)
+                    if data is None:
+                        break
+                    request_client = self.request_client(name, ctx, client)
+                    with CaptureQueriesContext(connection) as captured:
+                        start = time.time()
+                        status, content = self.request(request_client, method, path, data)
+                        latencies.append((time.time() - start) * 1000.0)
+                    queries.append(len(captured.captured_queries))
+                    sizes.append(len(content))
+                    statuses[status] += 1
+
+            if not latencies:
+                continue
+            latencies.sort()
+            results.append({'name': name,
+                            'method': method.upper(),
+                            'path': path,
+                            'requests': len(latencies),
+                            'statuses': dict((str(status), n) for status, n in statuses.items()),
+                            'latency_ms': {'p50': percentile(latencies, 50),
+                                           'p95': percentile(latencies, 95),
+                                           'p99': percentile(latencies, 99),
+                                           'mean': sum(latencies) / len(latencies),
+                                           'max': latencies[-1]},
+                            'queries': {'mean': float(sum(queries)) / len(queries), 'max': max(queries)},
+                            'response_bytes': {'mean': float(sum(sizes)) / len(sizes), 'max': max(sizes)},
+                            'process_peak_rss_kb': process_peak_rss_kb(),
+                            'process_peak_growth_kb': process_peak_rss_kb() - rss_before})
+        return results
+
+    # Logging in, registering and logging out replace the session, so they get
+    # clients of their own
+    def request_client(self, name, ctx, client):
+        if name in ('login', 'register'):
+            return make_client()
+        if name == 'logout':
+            client = make_client()
+            client.login(username=ctx['user'].username, password=BENCH_PASSWORD)
+        return client
+
+    # Return the status and the whole content of the response
+    def request(self, client, method, path, data):
+        if method == 'get':
+            response = client.get(path, data)
+        elif path in ('/j/login/', '/j/register/'):  # take a form
+            response = client.post(path, data)
+        else:
+            response = client.post(path, json.dumps(data), content_type='application/json')
+        if getattr(response, 'streaming', False):
+            content = ''.join(response.streaming_content)
+        else:
+            content = response.content
+        return response.status_code, content
+
+    def format_table(self, results):
+        lines = ['%-20s %6s %9s %9s %9s %8s %8s %12s'
+                 % ('endpoint', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'max q', 'proc peak KB')]
+        for r in results['endpoints']:
+            lines.append('%-20s %6d %9.2f %9.2f %9.2f %8.1f %8d %12d'
+                         % (r['name'], r['requests'], r['latency_ms']['p50'], r['latency_ms']['p95'],
+                            r['latency_ms']['p99'], r['queries']['mean'], r['queries']['max'],
+                            r['process_peak_rss_kb']))
+        return '\n'.join(lines)
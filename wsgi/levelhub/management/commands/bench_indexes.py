@@ -0,0 +1,111 @@
+from optparse import make_option
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import get_app, get_models
+
+from levelhub import synthetic
+from levelhub.models import Lesson, LessonReg, LessonRegLog, LessonMessage, LessonRequest
+from levelhub.consts import *
+
+
+# Queryset factories for the hot filter paths, given a random generator and
+# the ids to pick from
+HOT_QUERIES = [
+    ('LessonReg (lesson, status)',
+     lambda rnd, ids: LessonReg.objects.filter(lesson=rnd.choice(ids['lesson']), status=LESSON_REG_ACTIVE)),
+    ('LessonReg (student, status)',
+     lambda rnd, ids: LessonReg.objects.filter(student=rnd.choice(ids['user']), status=LESSON_REG_ACTIVE)),
+    ('LessonRegLog (lesson_reg, use_time)',
+     lambda rnd, ids: LessonRegLog.objects.filter(lesson_reg=rnd.choice(ids['reg']), use_time=None)),
+    ('LessonRequest (receiver, is_new, status)',
+     lambda rnd, ids: LessonRequest.objects.filter(receiver=rnd.choice(ids['user']), is_new=True,
+                                                   status__in=REQUEST_RECEIVER_NOTICE)),
+    ('LessonRequest (sender, is_new, status)',
+     lambda rnd, ids: LessonRequest.objects.filter(sender=rnd.choice(ids['user']), is_new=True,
+                                                   status__in=REQUEST_SENDER_NOTICE)),
+    ('LessonMessage (lesson, message)',
+     lambda rnd, ids: LessonMessage.objects.filter(lesson=rnd.choice(ids['lesson']),
+                                                   message__lt=rnd.choice(ids['message'])).order_by('-message')[:15]),
+]
+
+
+class Command(BaseCommand):
+    help = ('Seed a scratch test database with synthetic data and compare query plans and timings '
+            'of the hot filter paths without and with the composite (index_together) indexes.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', dest='users', default=20000),
+        make_option('--lessons', type='int', dest='lessons', default=5000),
+        make_option('--regs-per-lesson', type='int', dest='regs_per_lesson', default=20),
+        make_option('--logs-per-reg', type='int', dest='logs_per_reg', default=10),
+        make_option('--requests', type='int', dest='requests', default=50000),
+        make_option('--messages', type='int', dest='messages', default=50000),
+        make_option('--repeat', type='int', dest='repeat', default=200,
+                    help='Number of times each query is run for timing.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        old_name = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+        try:
+            self.stdout.write('Seeding synthetic data ...')
+            synthetic.seed(n_users=options['users'], n_lessons=options['lessons'],
+                           regs_per_lesson=options['regs_per_lesson'], logs_per_reg=options['logs_per_reg'],
+                           n_requests=options['requests'], n_messages=options['messages'])
+            ids = {'user': list(User.objects.values_list('id', flat=True)),
+                   'lesson': list(Lesson.objects.values_list('id', flat=True)),
+                   'reg': list(LessonReg.objects.values_list('id', flat=True)),
+                   'message': list(LessonMessage.objects.values_list('message', flat=True))}
+
+            cursor = connection.cursor()
+            create_sql, drop_sql = self.composite_index_sql()
+            for sql in drop_sql:
+                cursor.execute(sql)
+            cursor.execute('ANALYZE')
+            before = self.run_queries(cursor, ids, options['repeat'])
+
+            for sql in create_sql:
+                cursor.execute(sql)
+            cursor.execute('ANALYZE')
+            after = self.run_queries(cursor, ids, options['repeat'])
+
+            for (name, _), (plan_before, ms_before), (plan_after, ms_after) in zip(HOT_QUERIES, before, after):
+                self.stdout.write('\n%s' % name)
+                self.stdout.write('  without composite index: %8.3f ms/query  %s' % (ms_before, plan_before))
+                self.stdout.write('  with composite index:    %8.3f ms/query  %s' % (ms_after, plan_after))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+    # CREATE INDEX and DROP INDEX statements of the index_together indexes
+    def composite_index_sql(self):
+        create_sql, drop_sql = [], []
+        for model in get_models(get_app('levelhub')):
+            for fs in model._meta.index_together:
+                fields = [model._meta.get_field_by_name(f)[0] for f in fs]
+                for sql in connection.creation.sql_indexes_for_fields(model, fields, no_style()):
+                    create_sql.append(sql.rstrip(';'))
+                    drop_sql.append('DROP INDEX %s' % sql.split()[2])
+        return create_sql, drop_sql
+
+    # Return (query plan, average milliseconds) of each hot query
+    def run_queries(self, cursor, ids, repeat):
+        explain = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        results = []
+        for _, make_queryset in HOT_QUERIES:
+            rnd = random.Random(0)
+            sql, params = make_queryset(rnd, ids).query.sql_with_params()
+            cursor.execute(explain + sql, params)
+            plan = ' | '.join(str(row[-1]) for row in cursor.fetchall())
+
+            start = time.time()
+            for _ in range(repeat):
+                sql, params = make_queryset(rnd, ids).query.sql_with_params()
+                cursor.execute(sql, params)
+                cursor.fetchall()
+            results.append((plan, (time.time() - start) * 1000.0 / repeat))
+        return results
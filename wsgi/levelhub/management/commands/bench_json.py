@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils.timezone import utc
+
+from levelhub.models import UserProfile, Lesson
+from levelhub.utils import json_backends, json_default
+
+
+class Command(BaseCommand):
+    help = ('Compare the encode throughput of the installed JSON backends on a lesson list payload, '
+            'against the standard library encoder formatting datetimes in a default() callback.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--lessons', type='int', dest='lessons', default=10000),
+        make_option('--teachers', type='int', dest='teachers', default=500),
+        make_option('--repeat', type='int', dest='repeat', default=20,
+                    help='Number of times each payload is encoded for timing.'),
+    )
+
+    def handle(self, *args, **options):
+        formatted, raw = self.make_payloads(options['lessons'], options['teachers'])
+        # Datetimes are left in the raw payload, as dictify used to return them
+        encoders = [('json + default() per datetime', raw, lambda obj: json.dumps(obj, default=json_default))]
+        encoders.extend(('%s, preformatted datetimes' % name, formatted, dumps) for name, dumps in json_backends())
+
+        self.stdout.write('%d lessons, %d repeats' % (options['lessons'], options['repeat']))
+        for name, payload, dumps in encoders:
+            size = len(dumps(payload))
+            start = time.time()
+            for _ in range(options['repeat']):
+                dumps(payload)
+            seconds = (time.time() - start) / options['repeat']
+            self.stdout.write('  %-40s %8.2f ms/encode  %7.1f MB/s  %9.0f lessons/s'
+                              % (name, seconds * 1000.0, size / seconds / 1e6, options['lessons'] / seconds))
+
+    # Return the {'pulse', 'main'} response of a teach lesson list with
+    # formatted datetimes and the same response with datetime objects
+    def make_payloads(self, n_lessons, n_teachers):
+        joined = datetime(2014, 6, 1, tzinfo=utc)
+        profiles = {}
+        for i in range(n_teachers):
+            user = User(id=i + 1, username='teacher%d' % i, first_name='First%d' % i, last_name='Last%d' % i,
+                        email='teacher%d@example.com' % i, last_login=joined, date_joined=joined)
+            profiles[user.id] = UserProfile(user=user).dictify()
+
+        formatted, raw = [], []
+        for i in range(n_lessons):
+            lesson = Lesson(id=i + 1, teacher_id=i % n_teachers + 1, name='Lesson %d' % i,
+                            description='Description of lesson number %d' % i,
+                            creation_time=joined + timedelta(minutes=i), active_reg_count=i % 30)
+            # A plain dict can stand in for a ProfileMap, dictify only calls get()
+            d = lesson.dictify({'nregs': lesson.active_reg_count}, profiles)
+            formatted.append(d)
+            raw.append(dict(d, creation_time=lesson.creation_time))
+
+        return ({'pulse': {'n_new_requests': 0}, 'main': formatted},
+                {'pulse': {'n_new_requests': 0}, 'main': raw})
@@ -0,0 +1,32 @@
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connections
+
+from levelhub import routers
+
+
+class Command(NoArgsCommand):
+    help = ('Replace the SQLite file of the replica database with a copy of the default one, for trying the '
+            'replica routing locally with two SQLite files. Stop the server first, open replica connections '
+            'would keep reading the old file.')
+
+    def handle_noargs(self, **options):
+        if not routers.enabled():
+            raise CommandError('No replica database is configured, see LEVELHUB_REPLICA_DB_NAME')
+        primary, replica = connections['default'], connections[routers.REPLICA]
+        if primary.vendor != 'sqlite' or replica.vendor != 'sqlite':
+            raise CommandError('Only SQLite databases can be copied')
+
+        # Move the committed pages out of the write-ahead log into the file
+        primary.cursor().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        replica.close()
+        name = settings.DATABASES[routers.REPLICA]['NAME']
+        shutil.copyfile(settings.DATABASES['default']['NAME'], name + '.tmp')
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+        os.rename(name + '.tmp', name)
+        self.stdout.write('Copied %s to %s' % (settings.DATABASES['default']['NAME'], name))
@@ -0,0 +1,82 @@
+from collections import defaultdict
+from optparse import make_option
+import pstats
+import re
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from levelhub import profiles
+
+
+# The SQLite backend logs queries as the statement and its parameters, other
+# backends with the parameters interpolated. Their literals are replaced to
+# group the queries that only differ by parameters.
+SQL_WITH_PARAMS = re.compile(r"^QUERY = u?(['\"])(.*)\1 - PARAMS = ", re.DOTALL)
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def statement(sql):
+    match = SQL_WITH_PARAMS.match(sql)
+    return match.group(2) if match else SQL_LITERALS.sub('?', sql)
+
+
+class Command(BaseCommand):
+    args = '[profile name]'
+    help = ('List the saved request profiles, or summarize one: its slowest functions and its queries, '
+            'grouped by statement.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=25,
+                    help='Number of functions and statements shown in a summary.'),
+        make_option('--sort', dest='sort', default='cumulative',
+                    help='pstats sort key of the functions, e.g. cumulative, tottime or calls.'),
+        make_option('--token', action='store_true', dest='token', default=False,
+                    help='Print a token for the X-Levelhub-Profile header of a request to profile.'),
+        make_option('--clear', action='store_true', dest='clear', default=False,
+                    help='Delete all saved profiles.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['token']:
+            self.stdout.write(profiles.make_token())
+        elif options['clear']:
+            for name in profiles.names():
+                profiles.delete(name)
+        elif args:
+            self.summarize(args[0], options['limit'], options['sort'])
+        else:
+            self.list()
+
+    def list(self):
+        for name in profiles.names():
+            info, _ = profiles.load(name)
+            self.stdout.write('%s  %-4s %-28s %3d %9.1f ms %4d queries  %s'
+                              % (info['time'], info['method'], info['endpoint'], info['status'], info['wall_ms'],
+                                 len(info['queries']), name))
+
+    def summarize(self, name, limit, sort):
+        try:
+            info, prof_path = profiles.load(name)
+        except IOError:
+            raise CommandError('No profile named %s' % name)
+
+        self.stdout.write('%s %s -> %d in %.1f ms, user %s, %s'
+                          % (info['method'], info['path'], info['status'], info['wall_ms'], info['user_id'],
+                             info['time']))
+
+        statements = defaultdict(lambda: [0, 0.0])
+        for query in info['queries']:
+            totals = statements[statement(query['sql'])]
+            totals[0] += 1
+            totals[1] += float(query['time'])
+        self.stdout.write('\n%d queries in %.1f ms, %d distinct statements'
+                          % (len(info['queries']), sum(float(q['time']) for q in info['queries']) * 1000.0,
+                             len(statements)))
+        for sql, (count, seconds) in sorted(statements.items(), key=lambda item: -item[1][1])[:limit]:
+            self.stdout.write('  %4dx %8.1f ms  %s' % (count, seconds * 1000.0, sql[:200]))
+
+        self.stdout.write('')
+        self.stdout.flush()
+        stats = pstats.Stats(prof_path, stream=sys.stdout)
+        stats.sort_stats(sort).print_stats(limit)
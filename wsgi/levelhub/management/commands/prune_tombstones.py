@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+from levelhub import sync
+from levelhub.consts import SYNC_TOMBSTONE_DAYS
+
+
+class Command(NoArgsCommand):
+    help = ('Delete the tombstones of deleted objects that are older than %d days. Clients with an older '
+            'sync token get a full sync anyway.' % SYNC_TOMBSTONE_DAYS)
+
+    def handle_noargs(self, **options):
+        sync.prune_tombstones()
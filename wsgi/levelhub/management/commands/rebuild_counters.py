@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+from levelhub.counters import rebuild_active_reg_counts, rebuild_reg_log_counters
+
+
+class Command(NoArgsCommand):
+    help = 'Recompute the denormalized counters from the tables they summarize.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--check', action='store_true', dest='check', default=False,
+                    help='Only report wrong counters, do not fix them.'),
+    )
+
+    def handle_noargs(self, **options):
+        check_only = options['check']
+        with transaction.atomic():
+            wrong_lesson_ids = rebuild_active_reg_counts(check_only=check_only)
+            wrong_reg_ids = rebuild_reg_log_counters(check_only=check_only)
+
+        if wrong_lesson_ids:
+            self.stdout.write('%d lesson(s) with wrong active registration counters: %s'
+                              % (len(wrong_lesson_ids), ', '.join(str(x) for x in wrong_lesson_ids)))
+        if wrong_reg_ids:
+            self.stdout.write('%d lesson registration(s) with wrong reg log counters: %s'
+                              % (len(wrong_reg_ids), ', '.join(str(x) for x in wrong_reg_ids)))
+
+        if wrong_lesson_ids or wrong_reg_ids:
+            if check_only:
+                raise CommandError('Counters are inconsistent, run without --check to fix them')
+            self.stdout.write('Counters fixed')
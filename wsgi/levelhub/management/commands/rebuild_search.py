@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from levelhub import search
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuild the full text search tables from the lesson and user tables.'
+
+    def handle_noargs(self, **options):
+        if not search.fts5_available():
+            self.stdout.write('Full text search is not available with this database')
+            return
+        with transaction.atomic():
+            search.rebuild()
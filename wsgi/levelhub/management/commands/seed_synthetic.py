@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from levelhub import synthetic
+
+
+# Options of the synthetic data volumes, shared with the benchmark commands
+SEED_OPTIONS = (
+    make_option('--users', type='int', dest='users', default=2000),
+    make_option('--lessons', type='int', dest='lessons', default=500),
+    make_option('--regs-per-lesson', type='int', dest='regs_per_lesson', default=20,
+                help='Mean number of registrations of a lesson.'),
+    make_option('--logs-per-reg', type='int', dest='logs_per_reg', default=20),
+    make_option('--requests', type='int', dest='requests', default=5000),
+    make_option('--messages', type='int', dest='messages', default=5000),
+    make_option('--skew', type='float', dest='skew', default=1.0,
+                help='Zipf exponent of the activity of users and lessons, 0 for uniform data.'),
+    make_option('--seed', type='int', dest='seed', default=0, help='Seed of the random generator.'),
+)
+
+
+def seed_from_options(options, password=None):
+    synthetic.seed(n_users=options['users'], n_lessons=options['lessons'],
+                   regs_per_lesson=options['regs_per_lesson'], logs_per_reg=options['logs_per_reg'],
+                   n_requests=options['requests'], n_messages=options['messages'], skew=options['skew'],
+                   password=password, random_seed=options['seed'])
+
+
+class Command(NoArgsCommand):
+    help = ('Fill the database with synthetic users, lessons, registrations, reg logs, requests and messages. '
+            'Rows are bulk inserted, so only run it against an empty scratch database.')
+
+    option_list = NoArgsCommand.option_list + SEED_OPTIONS + (
+        make_option('--password', dest='password', default=None,
+                    help='Password of every synthetic user. By default they cannot log in.'),
+    )
+
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            seed_from_options(options, options['password'])
+        self.stdout.write('Seeded %d users and %d lessons' % (options['users'], options['lessons']))
@@ -0,0 +1,89 @@
+import re
+
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import get_app, get_models
+
+from levelhub import search
+from levelhub.counters import rebuild_active_reg_counts, rebuild_reg_log_counters
+from levelhub.models import rebuild_reg_sort_names
+
+
+# Columns added to the levelhub tables after they were first created, as
+# (table, column, definition). syncdb creates them for new tables but never
+# alters an existing table.
+NEW_COLUMNS = [
+    ('levelhub_lessonreg', 'total_logs', 'integer NOT NULL DEFAULT 0'),
+    ('levelhub_lessonreg', 'unused_logs', 'integer NOT NULL DEFAULT 0'),
+    ('levelhub_lesson', 'active_reg_count', 'integer NOT NULL DEFAULT 0'),
+    ('levelhub_userprofile', 'lessons_modified', "datetime NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    ('levelhub_userprofile', 'requests_modified', "datetime NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    ('levelhub_userprofile', 'messages_modified', "datetime NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    ('levelhub_lesson', 'update_time', "datetime NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    ('levelhub_lessonreg', 'update_time', "datetime NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    ('levelhub_lessonreglog', 'update_time', "datetime NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    ('levelhub_message', 'update_time', "datetime NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    ('levelhub_lessonrequest', 'update_time', "datetime NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    ('levelhub_lessonreg', 'sort_name', "varchar(64) NOT NULL DEFAULT ''"),
+]
+
+
+# Names of the indexes that exist on a table
+def index_names(cursor, table):
+    if connection.vendor == 'sqlite':
+        cursor.execute('PRAGMA index_list(%s)' % connection.ops.quote_name(table))
+        return set(row[1] for row in cursor.fetchall())
+    elif connection.vendor == 'postgresql':
+        cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+        return set(row[0] for row in cursor.fetchall())
+    elif connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+        return set(row[2] for row in cursor.fetchall())
+    else:
+        raise NotImplementedError('Index introspection for %s' % connection.vendor)
+
+
+class Command(NoArgsCommand):
+    help = 'Bring the levelhub tables of an existing database up to date. Run after syncdb.'
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        cursor = connection.cursor()
+        introspection = connection.introspection
+        qn = connection.ops.quote_name
+
+        added_columns = []
+        with transaction.atomic():
+            for table, column, definition in NEW_COLUMNS:
+                existing = [row[0] for row in introspection.get_table_description(cursor, table)]
+                if column in existing:
+                    continue
+                if verbosity >= 1:
+                    self.stdout.write('Adding column %s.%s' % (table, column))
+                cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (qn(table), qn(column), definition))
+                added_columns.append((table, column))
+
+            # Indexes added to models, including index_together, after their tables were created
+            for model in get_models(get_app('levelhub')):
+                existing = index_names(cursor, model._meta.db_table)
+                for sql in connection.creation.sql_indexes_for_model(model, no_style()):
+                    name = re.match(r'CREATE INDEX (\S+) ON', sql).group(1).strip('"`')
+                    if name in existing:
+                        continue
+                    if verbosity >= 1:
+                        self.stdout.write('Creating index %s' % name)
+                    cursor.execute(sql.rstrip(';'))
+
+            # Full text search tables and the triggers keeping them in sync
+            for fts_table in search.install():
+                if verbosity >= 1:
+                    self.stdout.write('Created search table %s' % fts_table)
+
+            # Fill new counter columns from the tables they summarize
+            if ('levelhub_lessonreg', 'total_logs') in added_columns:
+                rebuild_reg_log_counters()
+            if ('levelhub_lesson', 'active_reg_count') in added_columns:
+                rebuild_active_reg_counts()
+            if ('levelhub_lessonreg', 'sort_name') in added_columns:
+                rebuild_reg_sort_names()
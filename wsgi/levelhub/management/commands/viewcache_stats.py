@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from levelhub import viewcache
+
+
+class Command(BaseCommand):
+    help = ('Show the hits and misses of the per-user view cache. With the local memory cache each process '
+            'counts its own, so this is only meaningful with a shared cache such as Redis.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset', default=False,
+                    help='Reset the counts after showing them.'),
+    )
+
+    def handle(self, *args, **options):
+        for view, (hits, misses) in sorted(viewcache.stats().items()):
+            total = hits + misses
+            self.stdout.write('%-16s %8d hits %8d misses  %5.1f%% hit rate'
+                              % (view, hits, misses, 100.0 * hits / total if total else 0.0))
+        if options['reset']:
+            viewcache.reset_stats()
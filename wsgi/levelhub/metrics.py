@@ -0,0 +1,159 @@
+from bisect import bisect_left
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+
+
+# ############################################################################
+# Request metrics
+#
+# middleware.metrics measures the wall time and the time spent encoding JSON
+# of every request, and the number and time of the SQL queries of one in
+# REQUEST_METRICS_QUERY_SAMPLE_RATE requests, and records them here under the
+# URL name of the view. Each process aggregates its own requests into
+# per-endpoint totals and histograms, and every REQUEST_METRICS_REPORT_INTERVAL
+# seconds logs the endpoints that took the most time and that ran the most
+# queries per request to the levelhub.metrics logger. The long-poll endpoints
+# of REQUEST_METRICS_LONG_POLL spend most of their time waiting and are left
+# out of the time ranking.
+#############################################################################
+
+logger = logging.getLogger('levelhub.metrics')
+
+# Upper bounds of the histogram buckets, the last bucket has no bound
+WALL_TIME_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+QUERY_COUNT_BUCKETS = [1, 2, 5, 10, 20, 50, 100]
+
+_local = threading.local()
+_lock = threading.Lock()
+_endpoints = {}
+_last_report = [time.time()]
+
+
+def enabled():
+    return getattr(settings, 'REQUEST_METRICS', False)
+
+
+# Whether to count the queries of a request. Counting them needs the debug
+# cursor, which keeps every query of the request in memory.
+def sample_queries():
+    if settings.DEBUG:
+        return True
+    rate = getattr(settings, 'REQUEST_METRICS_QUERY_SAMPLE_RATE', 0)
+    return bool(rate) and random.random() * rate < 1
+
+
+# Start measuring the serialization time of the current request
+def start():
+    _local.serialize_seconds = 0.0
+
+
+# Add the time spent encoding a response to the current request
+def serialized(seconds):
+    if hasattr(_local, 'serialize_seconds'):
+        _local.serialize_seconds += seconds
+
+
+def serialize_seconds():
+    return getattr(_local, 'serialize_seconds', 0.0)
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.query_requests = 0
+        self.wall_seconds = 0.0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.queries = 0
+        self.max_wall_seconds = 0.0
+        self.max_queries = 0
+        self.wall_time_histogram = [0] * (len(WALL_TIME_BUCKETS_MS) + 1)
+        self.query_count_histogram = [0] * (len(QUERY_COUNT_BUCKETS) + 1)
+
+    # queries and db_seconds are None for the requests whose queries were not
+    # sampled
+    def add(self, wall_seconds, db_seconds, serialize_seconds, queries):
+        self.requests += 1
+        self.wall_seconds += wall_seconds
+        self.serialize_seconds += serialize_seconds
+        self.max_wall_seconds = max(self.max_wall_seconds, wall_seconds)
+        self.wall_time_histogram[bisect_left(WALL_TIME_BUCKETS_MS, wall_seconds * 1000.0)] += 1
+        if queries is not None:
+            self.query_requests += 1
+            self.db_seconds += db_seconds
+            self.queries += queries
+            self.max_queries = max(self.max_queries, queries)
+            self.query_count_histogram[bisect_left(QUERY_COUNT_BUCKETS, queries)] += 1
+
+    def dictify(self):
+        n = self.requests
+        # The query means are over the sampled requests
+        n_sampled = self.query_requests or 1
+        return {'requests': n,
+                'query_requests': self.query_requests,
+                'mean_wall_ms': self.wall_seconds * 1000.0 / n,
+                'max_wall_ms': self.max_wall_seconds * 1000.0,
+                'mean_db_ms': self.db_seconds * 1000.0 / n_sampled,
+                'mean_serialize_ms': self.serialize_seconds * 1000.0 / n,
+                'mean_queries': float(self.queries) / n_sampled,
+                'max_queries': self.max_queries,
+                'wall_time_histogram': self.wall_time_histogram[:],
+                'query_count_histogram': self.query_count_histogram[:]}
+
+
+def record(endpoint, wall_seconds, db_seconds, serialize_seconds, queries):
+    with _lock:
+        if endpoint not in _endpoints:
+            _endpoints[endpoint] = EndpointStats()
+        _endpoints[endpoint].add(wall_seconds, db_seconds, serialize_seconds, queries)
+        due = time.time() - _last_report[0] >= settings.REQUEST_METRICS_REPORT_INTERVAL
+        if due:
+            _last_report[0] = time.time()
+    if due:
+        logger.info(report())
+
+
+# {endpoint: stats dict} of the requests recorded by this process
+def snapshot():
+    with _lock:
+        return dict((endpoint, stats.dictify()) for endpoint, stats in _endpoints.items())
+
+
+def reset():
+    with _lock:
+        _endpoints.clear()
+
+
+def _long_poll(endpoint):
+    return endpoint.split(' ', 1)[-1] in getattr(settings, 'REQUEST_METRICS_LONG_POLL', ())
+
+
+# The endpoints with the most total wall time, long polls aside, and with the
+# most queries per request, top_n of each
+def report(top_n=None):
+    top_n = top_n or settings.REQUEST_METRICS_TOP
+    stats = snapshot()
+    slow = sorted([item for item in stats.items() if not _long_poll(item[0])],
+                  key=lambda item: -item[1]['mean_wall_ms'] * item[1]['requests'])[:top_n]
+    chatty = sorted([item for item in stats.items() if item[1]['query_requests']],
+                    key=lambda item: -item[1]['mean_queries'])[:top_n]
+
+    lines = ['Slowest endpoints by total time',
+             '  %-32s %8s %10s %10s %9s %9s %8s' % ('endpoint', 'requests', 'mean ms', 'max ms', 'db ms',
+                                                   'json ms', 'queries')]
+    for endpoint, s in slow:
+        lines.append('  %-32s %8d %10.2f %10.2f %9.2f %9.2f %8.1f'
+                     % (endpoint, s['requests'], s['mean_wall_ms'], s['max_wall_ms'], s['mean_db_ms'],
+                        s['mean_serialize_ms'], s['mean_queries']))
+    lines.append('Chattiest endpoints by queries per request')
+    lines.append('  %-32s %8s %8s %8s  %s' % ('endpoint', 'sampled', 'mean', 'max',
+                                            'histogram <=%s,more' % ','.join(map(str, QUERY_COUNT_BUCKETS))))
+    for endpoint, s in chatty:
+        lines.append('  %-32s %8d %8.1f %8d  %s' % (endpoint, s['query_requests'], s['mean_queries'],
+                                                   s['max_queries'],
+                                                   ' '.join(map(str, s['query_count_histogram']))))
+    return '\n'.join(lines)
@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.contrib import auth
+from django.utils.functional import SimpleLazyObject
+
+from levelhub import usercache
+
+
+class CachedAuthentication(object):
+    """
+        Sets request.user like django.contrib.auth's AuthenticationMiddleware
+        but takes the user from the cache, see levelhub.usercache.
+    """
+
+    def process_request(self, request):
+        request.user = SimpleLazyObject(lambda: usercache.get_user(request))
+        return None
+
+
+class SessionRenewal(object):
+    """
+        Sessions expire SESSION_COOKIE_AGE seconds after they were last
+        saved. The sessions of logged in users are saved again once every
+        SESSION_RENEW_INTERVAL seconds, so they only expire after
+        SESSION_COOKIE_AGE seconds without any request, and abandoned ones
+        are removed by 'manage.py clearsessions'.
+    """
+
+    def process_request(self, request):
+        session = request.session
+        if auth.SESSION_KEY in session \
+                and session.get('renewed', 0) < time.time() - settings.SESSION_RENEW_INTERVAL:
+            session['renewed'] = int(time.time())
+        return None
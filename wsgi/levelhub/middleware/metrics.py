@@ -0,0 +1,78 @@
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from levelhub import metrics
+
+
+class RequestMetrics(object):
+    """
+        Measures the wall time and the JSON encoding time of every request,
+        and the SQL queries and their time of the sampled ones, and records
+        them in levelhub.metrics under the method and URL name of the
+        request. In debug mode every request is sampled and the measures are
+        also sent in X-Levelhub-* response headers, which for a streamed
+        response only cover the work done before the streaming started.
+
+        Must be the first middleware so that the others are measured too.
+    """
+
+    def process_request(self, request):
+        if not metrics.enabled():
+            return None
+        metrics.start()
+        request.metrics_state = {'start': time.time(), 'connections': {}}
+        if not metrics.sample_queries():
+            return None
+        # Query counting and timing relies on the debug cursors of the
+        # connections, which record every query in connection.queries
+        for connection in connections.all():
+            request.metrics_state['connections'][connection.alias] = (connection.use_debug_cursor,
+                                                                      len(connection.queries))
+            connection.use_debug_cursor = True
+        return None
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'metrics_state'):
+            return response
+        if settings.DEBUG and request.metrics_state['connections']:
+            wall_seconds, db_seconds, serialize_seconds, queries = self.measure(request)
+            response['X-Levelhub-Queries'] = str(queries)
+            response['X-Levelhub-DB-Time'] = '%.2f' % (db_seconds * 1000.0)
+            response['X-Levelhub-Serialize-Time'] = '%.2f' % (serialize_seconds * 1000.0)
+            response['X-Levelhub-Wall-Time'] = '%.2f' % (wall_seconds * 1000.0)
+        if response.streaming:
+            response.streaming_content = self.finish_after(request, response.streaming_content)
+        else:
+            self.finish(request)
+        return response
+
+    # Return the wall time, database time, serialization time and number of
+    # queries of the request so far. The database time and the number of
+    # queries are None if the queries of the request are not sampled.
+    def measure(self, request):
+        state = request.metrics_state
+        if not state['connections']:
+            return time.time() - state['start'], None, metrics.serialize_seconds(), None
+        db_seconds = 0.0
+        queries = 0
+        for connection in connections.all():
+            if connection.alias in state['connections']:
+                new_queries = connection.queries[state['connections'][connection.alias][1]:]
+                queries += len(new_queries)
+                db_seconds += sum(float(query['time']) for query in new_queries)
+        return time.time() - state['start'], db_seconds, metrics.serialize_seconds(), queries
+
+    def finish(self, request):
+        resolver_match = getattr(request, 'resolver_match', None)
+        url_name = resolver_match.url_name if resolver_match and resolver_match.url_name else 'unresolved'
+        metrics.record('%s %s' % (request.method, url_name), *self.measure(request))
+        for connection in connections.all():
+            if connection.alias in request.metrics_state['connections']:
+                connection.use_debug_cursor = request.metrics_state['connections'][connection.alias][0]
+
+    def finish_after(self, request, chunks):
+        for chunk in chunks:
+            yield chunk
+        self.finish(request)
@@ -0,0 +1,85 @@
+import cProfile
+import random
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import connections
+
+from levelhub import profiles
+
+
+class SampledProfiler(object):
+    """
+        Profiles one in PROFILE_SAMPLE_RATE requests, and the requests that
+        carry a valid X-Levelhub-Profile token (see 'manage.py profiles
+        --token'), with cProfile. The profile is saved to PROFILE_DIR together
+        with the endpoint and the queries of the request, see
+        levelhub.profiles. The long polls of REQUEST_METRICS_LONG_POLL are
+        only profiled with a token, since they mostly wait and would keep
+        their queries in memory all along.
+    """
+
+    def process_request(self, request):
+        if not self.wanted(request):
+            return None
+        request.profile_state = {'start': time.time(), 'connections': {}}
+        for connection in connections.all():
+            request.profile_state['connections'][connection.alias] = (connection.use_debug_cursor,
+                                                                      len(connection.queries))
+            connection.use_debug_cursor = True
+        request.profiler = cProfile.Profile()
+        request.profiler.enable()
+        return None
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'profiler'):
+            return response
+        if response.streaming:
+            response.streaming_content = self.finish_after(request, response, response.streaming_content)
+        else:
+            self.finish(request, response)
+        return response
+
+    def wanted(self, request):
+        token = request.META.get('HTTP_X_LEVELHUB_PROFILE')
+        if token:
+            try:
+                profiles.check_token(token)
+                return True
+            except signing.BadSignature:
+                pass
+        rate = settings.PROFILE_SAMPLE_RATE
+        if not rate or random.random() * rate >= 1:
+            return False
+        try:
+            url_name = resolve(request.path_info).url_name
+        except Resolver404:
+            return True
+        return url_name not in getattr(settings, 'REQUEST_METRICS_LONG_POLL', ())
+
+    def finish(self, request, response):
+        request.profiler.disable()
+        state = request.profile_state
+        queries = []
+        for connection in connections.all():
+            if connection.alias in state['connections']:
+                use_debug_cursor, n_queries = state['connections'][connection.alias]
+                queries.extend(dict(query, database=connection.alias) for query in connection.queries[n_queries:])
+                connection.use_debug_cursor = use_debug_cursor
+        resolver_match = getattr(request, 'resolver_match', None)
+        profiles.save(request.profiler,
+                      {'endpoint': resolver_match.url_name if resolver_match and resolver_match.url_name
+                       else 'unresolved',
+                       'method': request.method,
+                       'path': request.get_full_path(),
+                       'status': response.status_code,
+                       'user_id': request.user.id if hasattr(request, 'user') else None,
+                       'wall_ms': (time.time() - state['start']) * 1000.0,
+                       'queries': queries})
+
+    def finish_after(self, request, response, chunks):
+        for chunk in chunks:
+            yield chunk
+        self.finish(request, response)
@@ -0,0 +1,16 @@
+from levelhub import notify
+
+
+class PulseNotifications(object):
+    """
+        Sends the pulse notifications raised inside transactions during the
+        request once the view has returned, when the transactions are over.
+    """
+
+    def process_request(self, request):
+        notify.flush()
+        return None
+
+    def process_response(self, request, response):
+        notify.flush()
+        return response
@@ -0,0 +1,44 @@
+import time
+
+from django.conf import settings
+
+from levelhub import routers
+
+
+class ReplicaRouting(object):
+    """
+        Routes the reads of GET and HEAD requests to the read replica, see
+        levelhub.routers. Any other request pins the client to the primary
+        for REPLICA_PIN_SECONDS with a cookie, so that the client reads its
+        own writes while the replica catches up.
+    """
+
+    def process_request(self, request):
+        if not routers.enabled():
+            return None
+        if request.method in ('GET', 'HEAD'):
+            try:
+                pinned = float(request.COOKIES.get(settings.REPLICA_PIN_COOKIE, 0)) > time.time()
+            except ValueError:
+                pinned = False
+            routers.use_replica(not pinned)
+        else:
+            routers.pin_primary()
+        return None
+
+    def process_response(self, request, response):
+        if not routers.enabled():
+            return response
+        if request.method not in ('GET', 'HEAD'):
+            response.set_cookie(settings.REPLICA_PIN_COOKIE, str(time.time() + settings.REPLICA_PIN_SECONDS),
+                                max_age=settings.REPLICA_PIN_SECONDS, httponly=True)
+        if response.streaming:
+            response.streaming_content = self.finish_after(response.streaming_content)
+        else:
+            routers.pin_primary()
+        return response
+
+    def finish_after(self, chunks):
+        for chunk in chunks:
+            yield chunk
+        routers.pin_primary()
@@ -2,9 +2,14 @@ import json
 from datetime import datetime
 
 from django.db import models
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
+from django.utils import timezone
 
-from levelhub.utils import utcnow
+from levelhub import dbtuning, usercache
+from levelhub.utils import format_datetime, utcnow
 from levelhub.consts import *
 
 
@@ -14,6 +19,11 @@ class UserProfile(models.Model):
     website = models.URLField(blank=True)
     about = models.CharField(max_length=1024)
     data = models.TextField(default=JSON_NULL)
+    # When the data behind the user's lesson lists, lesson requests and message
+    # feed last changed, maintained by levelhub.stamps
+    lessons_modified = models.DateTimeField(default=utcnow)
+    requests_modified = models.DateTimeField(default=utcnow)
+    messages_modified = models.DateTimeField(default=utcnow)
 
     def __unicode__(self):
         return '%d - %s' % (self.user.id, self.user.username)
@@ -35,30 +45,73 @@ class UserProfile(models.Model):
         return d
 
 
+# Identity map of serialized user profiles, shared by everything serialized for
+# one request. Each profile is loaded and serialized at most once. Profiles can
+# be loaded in bulk ahead of time with load(), get() fetches the missing ones.
+# The returned dicts are shared and must not be modified.
+class ProfileMap(object):
+    def __init__(self):
+        self._profiles = {}
+
+    # user_ids can be a list or a queryset that yields user ids
+    def load(self, user_ids):
+        if not isinstance(user_ids, QuerySet):
+            user_ids = set(user_id for user_id in user_ids if user_id not in self._profiles)
+            if not user_ids:
+                return
+            # Remember users without profile so they are not looked up again
+            for user_id in user_ids:
+                self._profiles[user_id] = None
+        for profile in UserProfile.objects.select_related('user').filter(user__in=user_ids):
+            if self._profiles.get(profile.user_id) is None:
+                self._profiles[profile.user_id] = profile.dictify()
+
+    # Serialized profile of the user or None if the user has no profile
+    def get(self, user_id):
+        if user_id not in self._profiles:
+            self.load([user_id])
+        return self._profiles[user_id]
+
+
 class Lesson(models.Model):
     teacher = models.ForeignKey(User)
     name = models.CharField(max_length=64)
     description = models.CharField(max_length=1024)
     status = models.IntegerField(default=LESSON_ACTIVE)
     creation_time = models.DateTimeField(default=utcnow)
+    # Time of the last change, used by /j/sync/. Writes made with
+    # QuerySet.update() must set it themselves.
+    update_time = models.DateTimeField(auto_now=True, db_index=True)
     data = models.TextField(default=JSON_NULL)
+    # Number of active registrations, maintained by levelhub.counters
+    active_reg_count = models.IntegerField(default=0)
 
     def __unicode__(self):
         return '%d - %s' % (self.id, self.name)
 
-    def dictify(self, update_with=None):
+    def dictify(self, update_with=None, profiles=None):
+        if profiles is None:
+            profiles = ProfileMap()
         d = {'lesson_id': self.id,
-             'teacher': self.teacher.get_profile().dictify(),
+             'teacher': profiles.get(self.teacher_id),
              'name': self.name,
              'description': self.description,
              'status': self.status,
-             'creation_time': self.creation_time,
+             'creation_time': format_datetime(self.creation_time),
              'data': self.data}
         if update_with is not None:
             d.update(update_with)
         return d
 
 
+# Sort key of a student in a roster, the lower cased display name. Members who
+# gave no name are shown by their username.
+def student_sort_name(first_name, last_name, username=None):
+    if username is not None and first_name == '' and last_name == '':
+        return username.lower()
+    return ' '.join([first_name, last_name]).lower()
+
+
 class LessonReg(models.Model):
     lesson = models.ForeignKey(Lesson)
     student = models.ForeignKey(User, null=True, blank=True)
@@ -66,8 +119,29 @@ class LessonReg(models.Model):
     student_last_name = models.CharField(max_length=30)
     status = models.IntegerField(default=LESSON_REG_ACTIVE)
     creation_time = models.DateTimeField(default=utcnow)
+    update_time = models.DateTimeField(auto_now=True, db_index=True)
     daytimes = models.CharField(max_length=512)  # comma separated class times
     data = models.TextField(default=JSON_NULL)
+    # Number of reg logs and of those not used yet, maintained by levelhub.counters
+    total_logs = models.IntegerField(default=0)
+    unused_logs = models.IntegerField(default=0)
+    # Sort key of the student in the roster, set when the registration is
+    # created and kept up to date by student_renamed
+    sort_name = models.CharField(max_length=64, default='')
+
+    class Meta:
+        index_together = [['lesson', 'status'],
+                          ['student', 'status'],
+                          ['lesson', 'status', 'sort_name']]
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            if self.student_id is None:
+                self.sort_name = student_sort_name(self.student_first_name, self.student_last_name)
+            else:
+                self.sort_name = student_sort_name(self.student.first_name, self.student.last_name,
+                                                   self.student.username)
+        super(LessonReg, self).save(*args, **kwargs)
 
     def __unicode__(self):
         if self.student is not None:
@@ -75,14 +149,16 @@ class LessonReg(models.Model):
         else:
             return '%d - %s - %s %s' % (self.id, self.lesson.name, self.student_first_name, self.student_last_name)
 
-    def dictify(self, update_with=None):
+    def dictify(self, update_with=None, profiles=None):
+        if profiles is None:
+            profiles = ProfileMap()
         d = {'reg_id': self.id,
-             'lesson_id': self.lesson.id,
-             'student': self.student.get_profile().dictify() if self.student else None,
+             'lesson_id': self.lesson_id,
+             'student': profiles.get(self.student_id) if self.student_id is not None else None,
              'student_first_name': self.student_first_name,
              'student_last_name': self.student_last_name,
              'status': self.status,
-             'creation_time': self.creation_time,
+             'creation_time': format_datetime(self.creation_time),
              'daytimes': self.daytimes,
              'data': self.data}
         if update_with is not None:
@@ -94,16 +170,20 @@ class LessonRegLog(models.Model):
     lesson_reg = models.ForeignKey(LessonReg)
     use_time = models.DateTimeField(null=True, blank=True)
     creation_time = models.DateTimeField(default=utcnow)
+    update_time = models.DateTimeField(auto_now=True, db_index=True)
     data = models.TextField(default=JSON_NULL)
 
+    class Meta:
+        index_together = [['lesson_reg', 'use_time']]
+
     def __unicode__(self):
         return '%d - %s - %s' % (self.id, self.lesson_reg, self.use_time)
 
     def dictify(self):
         d = {'rlog_id': self.id,
-             'lesson_reg_id': self.lesson_reg.id,
-             'use_time': self.use_time,
-             'creation_time': self.creation_time,
+             'lesson_reg_id': self.lesson_reg_id,
+             'use_time': format_datetime(self.use_time),
+             'creation_time': format_datetime(self.creation_time),
              'data': self.data}
         return d
 
@@ -112,16 +192,19 @@ class Message(models.Model):
     sender = models.ForeignKey(User)
     body = models.TextField(max_length=256)
     creation_time = models.DateTimeField(default=utcnow)
+    update_time = models.DateTimeField(auto_now=True, db_index=True)
     data = models.TextField(default=JSON_NULL)
 
     def __unicode__(self):
         return '%d - %s - %s' % (self.id, self.body, self.sender)
 
-    def dictify(self):
+    def dictify(self, profiles=None):
+        if profiles is None:
+            profiles = ProfileMap()
         d = {'message_id': self.id,
-             'sender': self.sender.get_profile().dictify(),
+             'sender': profiles.get(self.sender_id),
              'body': self.body,
-             'creation_time': self.creation_time,
+             'creation_time': format_datetime(self.creation_time),
              'data': self.data}
         return d
 
@@ -130,12 +213,17 @@ class LessonMessage(models.Model):
     lesson = models.ForeignKey(Lesson)  # the lesson for receiving the message
     message = models.ForeignKey(Message)
 
+    class Meta:
+        index_together = [['lesson', 'message']]
+
     def __unicode__(self):
         return '%d - %s - %s' % (self.id, self.lesson, self.message)
 
-    def dictify(self):
-        d = {'lesson': self.lesson.dictify(),
-             'message': self.message.dictify()}
+    def dictify(self, profiles=None):
+        if profiles is None:
+            profiles = ProfileMap()
+        d = {'lesson': self.lesson.dictify(profiles=profiles),
+             'message': self.message.dictify(profiles)}
         return d
 
 
@@ -143,12 +231,17 @@ class UserMessage(models.Model):
     user = models.ForeignKey(User)  # the recipient user of the message
     message = models.ForeignKey(Message)
 
+    class Meta:
+        index_together = [['user', 'message']]
+
     def __unicode__(self):
         return '%d - %s - %s' % (self.id, self.user, self.message)
 
-    def dictify(self):
-        d = {'user': self.user.dictify(),
-             'message': self.message.dictify()}
+    def dictify(self, profiles=None):
+        if profiles is None:
+            profiles = ProfileMap()
+        d = {'user': profiles.get(self.user_id),
+             'message': self.message.dictify(profiles)}
         return d
 
 
@@ -161,17 +254,64 @@ class LessonRequest(models.Model):
     daytimes = models.CharField(max_length=512)
     is_new = models.BooleanField(default=True)
     creation_time = models.DateTimeField(default=utcnow)
+    update_time = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        index_together = [['receiver', 'is_new', 'status'],
+                          ['sender', 'is_new', 'status']]
 
     def __unicode__(self):
         return '%s -> %s [%d]' % (self.sender.username, self.receiver.username, self.status)
 
-    def dictify(self):
+    def dictify(self, profiles=None):
+        if profiles is None:
+            profiles = ProfileMap()
         d = {'req_id': self.id,
-             'sender': self.sender.get_profile().dictify(),
-             'receiver': self.receiver.get_profile().dictify(),
-             'lesson': self.lesson.dictify(),
+             'sender': profiles.get(self.sender_id),
+             'receiver': profiles.get(self.receiver_id),
+             'lesson': self.lesson.dictify(profiles=profiles),
              'message': self.message,
              'status': self.status,
              'daytimes': self.daytimes,
-             'creation_time': self.creation_time}
+             'creation_time': format_datetime(self.creation_time)}
         return d
+
+
+# Deletion of an object the user could see, kept for a while so that /j/sync/
+# can report it. kind is one of the SYNC_* constants.
+class Tombstone(models.Model):
+    user = models.ForeignKey(User)
+    kind = models.CharField(max_length=16)
+    object_id = models.IntegerField()
+    # utcnow() drops the microseconds a sync token is compared with
+    deletion_time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        index_together = [['user', 'deletion_time']]
+
+    def __unicode__(self):
+        return '%s %d deleted for %s' % (self.kind, self.object_id, self.user_id)
+
+
+# The registrations of a member are sorted by the member's name
+def student_renamed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & {'first_name', 'last_name', 'username'}:
+        return
+    sort_name = student_sort_name(instance.first_name, instance.last_name, instance.username)
+    LessonReg.objects.filter(student=instance).exclude(sort_name=sort_name).update(sort_name=sort_name)
+
+
+# Set the sort names of all the registrations
+def rebuild_reg_sort_names():
+    for user in User.objects.filter(id__in=LessonReg.objects.values('student')):
+        student_renamed(User, user)
+    for first_name, last_name in LessonReg.objects.filter(student=None) \
+            .values_list('student_first_name', 'student_last_name').distinct():
+        LessonReg.objects.filter(student=None, student_first_name=first_name, student_last_name=last_name) \
+            .update(sort_name=student_sort_name(first_name, last_name))
+
+
+connection_created.connect(dbtuning.setup_connection)
+post_save.connect(usercache.user_changed, sender=User)
+post_delete.connect(usercache.user_changed, sender=User)
+post_save.connect(student_renamed, sender=User)
@@ -0,0 +1,135 @@
+from collections import defaultdict
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_by_path
+
+
+# ############################################################################
+# Change notifications for the long-poll pulse
+#
+# Whenever the requests or messages version stamp of users is touched, the
+# users are notified through the backend named by settings.NOTIFY_BACKEND, and
+# the pulse requests waiting for them wake up. Notifications raised inside a
+# transaction are held until the request is over, see middleware.pulse, so a
+# woken up waiter reads committed stamps. A lost notification only delays the
+# answer, since waiters also recheck the stamps every PULSE_RECHECK_INTERVAL.
+#############################################################################
+
+class LocalBackend(object):
+    """
+    Notifies the threads or greenlets of the current process only
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = defaultdict(int)
+
+    def publish(self, user_ids):
+        with self._condition:
+            for user_id in user_ids:
+                self._versions[user_id] += 1
+            self._condition.notify_all()
+
+    def subscribe(self, user_id):
+        return LocalSubscription(self, user_id)
+
+
+class LocalSubscription(object):
+    def __init__(self, backend, user_id):
+        self._backend = backend
+        self._user_id = user_id
+        self._version = backend._versions.get(user_id, 0)
+
+    # Return True if the user was notified since the subscription was made or
+    # since the last wait that returned True
+    def wait(self, timeout):
+        condition = self._backend._condition
+        deadline = time.time() + timeout
+        with condition:
+            while self._backend._versions.get(self._user_id, 0) == self._version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                condition.wait(remaining)
+            self._version = self._backend._versions[self._user_id]
+            return True
+
+    def close(self):
+        pass
+
+
+class RedisBackend(object):
+    """
+    Notifies every process through Redis pub/sub channels
+    """
+
+    def __init__(self):
+        import redis
+        self._redis = redis.StrictRedis(**settings.NOTIFY_REDIS)
+
+    def _channel(self, user_id):
+        return 'levelhub:notify:%d' % user_id
+
+    def publish(self, user_ids):
+        pipeline = self._redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.publish(self._channel(user_id), '1')
+        pipeline.execute()
+
+    def subscribe(self, user_id):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._channel(user_id))
+        return RedisSubscription(pubsub)
+
+
+class RedisSubscription(object):
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self._pubsub.get_message(timeout=remaining) is not None:
+                return True
+
+    def close(self):
+        self._pubsub.close()
+
+
+_backend = None
+_pending = threading.local()
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        _backend = import_by_path(settings.NOTIFY_BACKEND)()
+    return _backend
+
+
+def subscribe(user_id):
+    return backend().subscribe(user_id)
+
+
+# Notify the users now, or once the request is over if a transaction is open
+def publish(user_ids):
+    if connection.in_atomic_block:
+        if not hasattr(_pending, 'user_ids'):
+            _pending.user_ids = set()
+        _pending.user_ids.update(user_ids)
+    elif user_ids:
+        backend().publish(user_ids)
+
+
+# Send the notifications held back during the request
+def flush():
+    user_ids = getattr(_pending, 'user_ids', None)
+    _pending.user_ids = set()
+    if user_ids:
+        backend().publish(user_ids)
@@ -0,0 +1,71 @@
+from datetime import datetime
+import json
+import os
+
+from django.conf import settings
+from django.core import signing
+
+
+# ############################################################################
+# Saved request profiles
+#
+# Each profile is a cProfile dump NAME.prof in settings.PROFILE_DIR with a
+# NAME.json beside it holding the endpoint, method, path, status, user, wall
+# time and the queries of the request. Only the PROFILE_KEEP newest profiles
+# are kept.
+#
+# Requests are profiled when sampled, see middleware.profiling, or when their
+# X-Levelhub-Profile header holds a token made by make_token, which is valid
+# for PROFILE_TOKEN_MAX_AGE seconds.
+#############################################################################
+
+TOKEN_SALT = 'levelhub.profiles'
+
+
+def make_token():
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+
+
+# Raise signing.BadSignature if the token is invalid or has expired
+def check_token(token):
+    signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=settings.PROFILE_TOKEN_MAX_AGE)
+
+
+def save(profiler, info):
+    if not os.path.isdir(settings.PROFILE_DIR):
+        os.makedirs(settings.PROFILE_DIR)
+    now = datetime.utcnow()
+    info = dict(info, time=now.strftime('%Y-%m-%d %H:%M:%SZ'))
+    name = '%s-%d-%s' % (now.strftime('%Y%m%d-%H%M%S-%f'), os.getpid(), info['endpoint'])
+    path = os.path.join(settings.PROFILE_DIR, name)
+    profiler.dump_stats(path + '.prof')
+    with open(path + '.json', 'w') as f:
+        json.dump(info, f)
+    prune()
+
+
+# Names of the saved profiles, oldest first
+def names():
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return []
+    return sorted(filename[:-len('.json')] for filename in os.listdir(settings.PROFILE_DIR)
+                  if filename.endswith('.json'))
+
+
+# Return the info of the named profile and the path of its cProfile dump
+def load(name):
+    path = os.path.join(settings.PROFILE_DIR, name)
+    with open(path + '.json') as f:
+        return json.load(f), path + '.prof'
+
+
+def delete(name):
+    for ext in ('.prof', '.json'):
+        path = os.path.join(settings.PROFILE_DIR, name + ext)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def prune():
+    for name in names()[:-settings.PROFILE_KEEP]:
+        delete(name)
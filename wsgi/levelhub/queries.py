@@ -0,0 +1,211 @@
+import base64
+from itertools import chain, groupby, islice
+import json
+
+from django.db.models import Count, Q
+
+from levelhub import routers
+from levelhub.models import ProfileMap, Lesson, LessonReg, LessonRegLog, LessonMessage, LessonRequest, UserMessage
+from levelhub.utils import format_datetime
+from levelhub.consts import *
+
+
+# ############################################################################
+# Batched read queries
+#
+# Everything in here runs a fixed number of SQL queries regardless of how
+# many lessons or registrations are involved. Related rows are loaded with
+# one aggregate (GROUP BY) or bulk query each and stitched together in Python.
+# Id sets are passed to the database as sub-queries rather than lists so large
+# accounts never hit the bound parameter limit of SQLite. User profiles are
+# bulk loaded into the ProfileMap of the request before serializing.
+#############################################################################
+
+
+# Number of active registrations keyed by lesson id. Lessons without any active
+# registration are absent from the result.
+def active_reg_counts(lessonregs):
+    rows = lessonregs.filter(status=LESSON_REG_ACTIVE).values('lesson').annotate(nregs=Count('id')).order_by()
+    return dict((row['lesson'], row['nregs']) for row in rows)
+
+
+# (total, unused) reg log counts keyed by registration id. COUNT(use_time)
+# skips NULLs, so both numbers come out of a single GROUP BY.
+def reg_log_counts(lesson_reg_logs):
+    rows = lesson_reg_logs.values('lesson_reg').annotate(total=Count('id'), used=Count('use_time')).order_by()
+    return dict((row['lesson_reg'], (row['total'], row['total'] - row['used'])) for row in rows)
+
+
+# Peek the lesson requests without changing their status. The count is cached
+# under a generation started by commits on the primary, so it is read there.
+def count_new_lesson_requests(user_id):
+    lesson_requests = LessonRequest.objects.using(routers.PRIMARY)
+    # As receiver
+    incoming_requests = lesson_requests.filter(
+        receiver=user_id, is_new=True, status__in=REQUEST_RECEIVER_NOTICE)
+    # As sender
+    outgoing_requests = lesson_requests.filter(
+        sender=user_id, is_new=True, status__in=REQUEST_SENDER_NOTICE)
+
+    return incoming_requests.count() + outgoing_requests.count()
+
+
+# Get a page of the lesson requests an user can view, newest first. The page
+# holds up to limit requests with an id lower than before.
+def query_lesson_requests(user, before=None, limit=REQUEST_PAGE_SIZE, profiles=None):
+    profiles = profiles or ProfileMap()
+    # As receiver or as sender
+    lesson_requests = LessonRequest.objects.filter(
+        (Q(receiver=user) & Q(status__in=REQUEST_RECEIVER_VIEWABLE))
+        | (Q(sender=user) & Q(status__in=REQUEST_SENDER_VIEWABLE)))
+    if before is not None:
+        lesson_requests = lesson_requests.filter(id__lt=before)
+    lesson_requests = list(lesson_requests.select_related('lesson').order_by('-id')[:limit])
+
+    profiles.load(chain.from_iterable((req.sender_id, req.receiver_id, req.lesson.teacher_id)
+                                      for req in lesson_requests))
+    return [req.dictify(profiles) for req in lesson_requests]
+
+
+# Get the lessons an user teaches. Anyone can view an user's teaches
+def query_teach_lessons(user, profiles=None):
+    profiles = profiles or ProfileMap()
+    lessons = Lesson.objects.filter(teacher=user, status=LESSON_ACTIVE)
+    return [lesson.dictify({'nregs': lesson.active_reg_count}, profiles) for lesson in lessons]
+
+
+# study lesson is different than teach lesson in that it contains a
+# sub-element pointing to the registration
+# Can only view one's own studies
+def query_study_lessons(user, profiles=None):
+    profiles = profiles or ProfileMap()
+    lesson_regs = LessonReg.objects.filter(student=user, status=LESSON_REG_ACTIVE)
+    profiles.load(Lesson.objects.filter(id__in=lesson_regs.values('lesson')).values('teacher'))
+
+    response = []
+    for lesson_reg in lesson_regs.select_related('lesson'):
+        lesson = lesson_reg.lesson
+        d = lesson.dictify({'nregs': lesson.active_reg_count}, profiles)
+        d['registration'] = {
+            'reg_id': lesson_reg.id,
+            'status': lesson_reg.status,
+            'creation_time': format_datetime(lesson_reg.creation_time),
+            'daytimes': lesson_reg.daytimes,
+            'data': lesson_reg.data,
+            'total': lesson_reg.total_logs,
+            'unused': lesson_reg.unused_logs,
+        }
+        response.append(d)
+    return response
+
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(str(cursor)))
+
+
+# Get the active registrations of a lesson sorted alphabetically by student.
+# Lesson managers also get the total and unused reg log counts.
+# If limit is given, at most limit registrations after the given (sort_name, reg_id)
+# position are returned together with the cursor for the next page, or None on
+# the last page. Otherwise a generator over the whole roster is returned.
+def query_lesson_regs(lesson, role, after=None, limit=None, profiles=None):
+    profiles = profiles or ProfileMap()
+    lesson_regs = LessonReg.objects.filter(lesson=lesson, status=LESSON_REG_ACTIVE)
+    # Sorted alphabetically by student, see models.student_sort_name
+    page = lesson_regs.order_by('sort_name', 'id')
+    if after is not None:
+        sort_name, reg_id = after
+        page = page.filter(Q(sort_name__gt=sort_name) | Q(sort_name=sort_name, id__gt=reg_id))
+
+    def dictify(lesson_reg):
+        # Lesson registrations can be viewed by student with less information
+        info_for_manager = None
+        if role == ROLE_LESSON_MANAGER:
+            info_for_manager = {'total': lesson_reg.total_logs, 'unused': lesson_reg.unused_logs}
+        return lesson_reg.dictify(info_for_manager, profiles)
+
+    # The whole roster is wanted. The registrations are serialized as they are
+    # iterated, loading the profiles of each chunk of them at once.
+    if limit is None:
+        def stream():
+            rows = page.iterator()
+            while True:
+                chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+                if not chunk:
+                    return
+                profiles.load([lesson_reg.student_id for lesson_reg in chunk if lesson_reg.student_id])
+                for lesson_reg in chunk:
+                    yield dictify(lesson_reg)
+        return stream()
+
+    page = list(page[:limit])
+    profiles.load([lesson_reg.student_id for lesson_reg in page if lesson_reg.student_id])
+    response = [dictify(lesson_reg) for lesson_reg in page]
+    next_cursor = None
+    if len(page) == limit:
+        next_cursor = encode_cursor(page[-1].sort_name, page[-1].id)
+    return response, next_cursor
+
+
+# Generator over the reg logs of a registration in creation order
+def query_lesson_reg_logs(lesson_reg):
+    return (lesson_reg_log.dictify() for lesson_reg_log
+            in LessonRegLog.objects.filter(lesson_reg=lesson_reg).order_by('id').iterator())
+
+
+def member_lesson_messages(user):
+    return LessonMessage.objects.filter(
+        Q(lesson__teacher=user, lesson__status=LESSON_ACTIVE)
+        | Q(lesson__in=LessonReg.objects.filter(student=user, status=LESSON_REG_ACTIVE).values('lesson')))
+
+
+# Get the ids of a page of the messages sent to the lessons an user teaches or
+# studies. The page holds up to limit messages older than msg_id, sorted by
+# decreasing id, or newer than msg_id if newer is True, sorted by increasing
+# id. A msg_id of None starts from the newest message. If since is given only
+# messages changed since then are included.
+# If inbox is True the messages are taken from the user's UserMessage inbox
+# (fan-out on write) instead of being looked up through the user's lessons.
+# Inbox rows can point at messages the user cannot see anymore until they are
+# pruned, so the page can hold more ids than dictify_lesson_messages returns.
+def query_lesson_message_ids(user, msg_id, newer, limit=MESSAGE_PAGE_SIZE, inbox=False, since=None):
+    feed = UserMessage.objects.filter(user=user) if inbox else member_lesson_messages(user)
+    if since is not None:
+        feed = feed.filter(message__update_time__gte=since)
+    if newer:
+        message_ids = feed.filter(message__gt=msg_id).order_by('message')
+    elif msg_id is not None:
+        message_ids = feed.filter(message__lt=msg_id).order_by('-message')
+    else:
+        message_ids = feed.order_by('-message')
+    message_ids = message_ids.values_list('message', flat=True)
+    return list((message_ids if inbox else message_ids.distinct())[:limit])
+
+
+# Get the messages of the given ids the user can see, grouped with the lessons
+# of the user each message is sent to and sorted by decreasing message id
+def dictify_lesson_messages(user, message_ids, profiles=None):
+    profiles = profiles or ProfileMap()
+    lesson_messages = list(member_lesson_messages(user).filter(message__in=message_ids)
+                           .select_related('message', 'lesson').order_by('-message', 'lesson'))
+    profiles.load(chain((lm.message.sender_id for lm in lesson_messages),
+                        (lm.lesson.teacher_id for lm in lesson_messages)))
+
+    # Find all lessons the message is sent to and group the display of lessons
+    response = []
+    for message, lesson_messages_of_message in groupby(lesson_messages, key=lambda lm: lm.message_id):
+        lesson_messages_of_message = list(lesson_messages_of_message)
+        message = lesson_messages_of_message[0].message
+        response.append({'message': message.dictify(profiles),
+                         'lessons': [lm.lesson.dictify(profiles=profiles) for lm in lesson_messages_of_message]})
+    return response
+
+
+# Get a page of the messages, see query_lesson_message_ids, with their lessons
+# and sorted by decreasing message id
+def query_lesson_messages(user, msg_id, newer, limit=MESSAGE_PAGE_SIZE, inbox=False, profiles=None, since=None):
+    return dictify_lesson_messages(user, query_lesson_message_ids(user, msg_id, newer, limit, inbox, since), profiles)
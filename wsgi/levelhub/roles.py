@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from levelhub import routers, viewcache
+from levelhub.models import LessonReg
+from levelhub.consts import *
+
+
+# ############################################################################
+# Roles of users in lessons
+#
+# The teacher of a lesson and the admin manage it, which is known from the
+# lesson alone. Whether anyone else is a student takes a query for the active
+# registrations, which is made for all the lessons of a check at once. Its
+# answers are cached per (user, lesson) under the roster generation of the
+# lesson (see levelhub.viewcache), so enrolling, derolling and quitting, which
+# all start a new roster generation, orphan the cached roles. They are only
+# cached with a ROLE_CACHE_TIMEOUT, i.e. in a cache shared by all processes,
+# where the new generation is seen at once. The query runs on the primary,
+# where those changes are committed, so that a role read from a lagging
+# replica is not cached under the new generation. Roles are also memoized on
+# the user object, i.e. for the rest of the request.
+#############################################################################
+
+def _role_key(user_id, lesson_id, generation):
+    return 'levelhub:role:%d:%d:%s' % (user_id, lesson_id, generation)
+
+
+# {lesson id: role} of the user in each of the lessons
+def roles_of_lessons(user, lessons):
+    memo = getattr(user, '_lesson_roles', None)
+    if memo is None:
+        memo = user._lesson_roles = {}
+
+    roles = {}
+    unknown = []
+    for lesson in lessons:
+        if lesson.id in memo:
+            roles[lesson.id] = memo[lesson.id]
+        elif user.username == 'admin' or lesson.teacher_id == user.id:
+            roles[lesson.id] = ROLE_LESSON_MANAGER
+        else:
+            unknown.append(lesson.id)
+
+    cached = settings.ROLE_CACHE_TIMEOUT
+    if unknown and cached:
+        generations = viewcache.generations('roster', unknown)
+        keys = dict((_role_key(user.id, lesson_id, generations[lesson_id]), lesson_id) for lesson_id in unknown)
+        for key, role in cache.get_many(keys.keys()).items():
+            roles[keys.pop(key)] = role
+        unknown = keys.values()
+
+    if unknown:
+        studied = set(LessonReg.objects.using(routers.PRIMARY)
+                      .filter(lesson__in=unknown, student=user, status=LESSON_REG_ACTIVE)
+                      .values_list('lesson', flat=True))
+        for lesson_id in unknown:
+            roles[lesson_id] = ROLE_LESSON_STUDENT if lesson_id in studied else ROLE_LESSON_NONE
+        if cached:
+            cache.set_many(dict((key, roles[lesson_id]) for key, lesson_id in keys.items()),
+                           settings.ROLE_CACHE_TIMEOUT)
+
+    memo.update(roles)
+    return roles
+
+
+def role_of_lesson(user, lesson):
+    return roles_of_lessons(user, [lesson])[lesson.id]
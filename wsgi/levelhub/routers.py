@@ -0,0 +1,72 @@
+from contextlib import contextmanager
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+
+# ############################################################################
+# Read replica routing
+#
+# With a 'replica' database configured, ReplicaRouter sends the reads of GET
+# and HEAD requests to it, see middleware.replica, and everything else to the
+# primary 'default' database. A request moves to the primary for good as soon
+# as it writes or opens a transaction, so it reads its own writes. After a
+# client writes, its reads also stay on the primary for REPLICA_PIN_SECONDS
+# to let the replica catch up, see middleware.replica.
+#
+# Whatever is cached under a generation of levelhub.viewcache or
+# levelhub.counters, or cached until a write drops it like the users of
+# levelhub.usercache, must be read from the primary: a generation is started
+# by a commit there, and rows read from a replica that lags behind it would be
+# cached under the new generation until it expires.
+#############################################################################
+
+PRIMARY = 'default'
+REPLICA = 'replica'
+
+_state = threading.local()
+
+
+def enabled():
+    return REPLICA in settings.DATABASES
+
+
+# Route the reads of the current thread to the replica or to the primary
+def use_replica(flag):
+    _state.use_replica = flag
+
+
+def pin_primary():
+    use_replica(False)
+
+
+# Route the reads of the current thread to the primary inside the block only.
+# The block must not write, since that pins the rest of the request.
+@contextmanager
+def primary_reads():
+    replica = getattr(_state, 'use_replica', False)
+    pin_primary()
+    try:
+        yield
+    finally:
+        use_replica(replica)
+
+
+def reads_from_replica():
+    return getattr(_state, 'use_replica', False) and not connections[PRIMARY].in_atomic_block
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return REPLICA if reads_from_replica() else PRIMARY
+
+    def db_for_write(self, model, **hints):
+        pin_primary()
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_syncdb(self, db, model):
+        return db == PRIMARY
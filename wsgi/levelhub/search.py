@@ -0,0 +1,186 @@
+import re
+
+from django.contrib.auth.models import User
+from django.db import connection, connections, router
+from django.db.models import Q
+
+from levelhub.models import ProfileMap, Lesson
+from levelhub.consts import *
+
+
+# ############################################################################
+# Full text search
+#
+# On SQLite lessons and users are indexed in FTS5 tables that use the source
+# tables as external content. Triggers on the source tables keep the indexes in
+# sync with every write, including bulk and raw SQL ones. Each word of a search
+# phrase is matched as a prefix and results are ranked with bm25. Other
+# database backends, SQLite libraries without FTS5 and databases where the
+# tables have not been installed yet fall back to substring matching with LIKE.
+#############################################################################
+
+LESSON_FTS = 'levelhub_lesson_fts'
+USER_FTS = 'levelhub_user_fts'
+
+# (fts table, source table, indexed columns, bm25 weight of each column)
+FTS_TABLES = [
+    (LESSON_FTS, 'levelhub_lesson', ['name', 'description'], [10.0, 1.0]),
+    (USER_FTS, 'auth_user', ['username', 'first_name', 'last_name'], [5.0, 2.0, 2.0]),
+]
+
+
+# {database alias: whether its SQLite library has FTS5} and the aliases whose
+# search tables are known to be installed
+_fts5 = {}
+_installed = set()
+
+
+# FTS5 is missing from SQLite before 3.9 and from the builds without
+# SQLITE_ENABLE_FTS5, e.g. the stock one of RHEL
+def fts5_available(conn=None):
+    conn = conn or connection
+    if conn.vendor != 'sqlite':
+        return False
+    if conn.alias not in _fts5:
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA compile_options')
+        _fts5[conn.alias] = 'ENABLE_FTS5' in [row[0] for row in cursor.fetchall()]
+    return _fts5[conn.alias]
+
+
+# Names of the existing triggers keeping the search tables in sync
+def _trigger_names(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN (%s)"
+                   % ', '.join("'%s_%s'" % (fts_table, suffix)
+                               for fts_table, _, _, _ in FTS_TABLES for suffix in ('ai', 'ad', 'au')))
+    return set(row[0] for row in cursor.fetchall())
+
+
+# Whether searches on the database use the search tables
+def fts_enabled(conn=None):
+    conn = conn or connection
+    if not fts5_available(conn):
+        return False
+    if conn.alias not in _installed:
+        if len(_trigger_names(conn.cursor())) < len(FTS_TABLES) * 3:
+            return False
+        _installed.add(conn.alias)
+    return True
+
+
+def _fts_sql(fts_table, source_table, columns):
+    cols = ', '.join(columns)
+    new_cols = ', '.join('new.%s' % c for c in columns)
+    old_cols = ', '.join('old.%s' % c for c in columns)
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='%s', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 1')" % (fts_table, cols, source_table),
+        "CREATE TRIGGER IF NOT EXISTS %s_ai AFTER INSERT ON %s BEGIN "
+        "INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END" % (fts_table, source_table, fts_table, cols, new_cols),
+        "CREATE TRIGGER IF NOT EXISTS %s_ad AFTER DELETE ON %s BEGIN "
+        "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s); END"
+        % (fts_table, source_table, fts_table, fts_table, cols, old_cols),
+        "CREATE TRIGGER IF NOT EXISTS %s_au AFTER UPDATE OF %s ON %s BEGIN "
+        "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.id, %s); "
+        "INSERT INTO %s(rowid, %s) VALUES (new.id, %s); END"
+        % (fts_table, cols, source_table, fts_table, fts_table, cols, old_cols, fts_table, cols, new_cols),
+    ]
+
+
+# Create the missing search tables and triggers and fill the tables that were
+# created or missed some of their triggers. Return the names of those tables.
+# Without FTS5 the triggers of a database made where it was available are
+# dropped, since they would make every write to their source tables fail.
+def install():
+    if connection.vendor != 'sqlite':
+        return []
+    cursor = connection.cursor()
+    triggers = _trigger_names(cursor)
+    if not fts5_available():
+        for name in triggers:
+            cursor.execute('DROP TRIGGER %s' % name)
+        return []
+    existing = connection.introspection.table_names(cursor)
+    filled = []
+    for fts_table, source_table, columns, _ in FTS_TABLES:
+        for sql in _fts_sql(fts_table, source_table, columns):
+            cursor.execute(sql)
+        if fts_table not in existing \
+                or any('%s_%s' % (fts_table, suffix) not in triggers for suffix in ('ai', 'ad', 'au')):
+            cursor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (fts_table, fts_table))
+            filled.append(fts_table)
+    return filled
+
+
+# Rebuild the search tables from their source tables
+def rebuild():
+    if not fts5_available():
+        return
+    install()
+    cursor = connection.cursor()
+    for fts_table, _, _, _ in FTS_TABLES:
+        cursor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (fts_table, fts_table))
+
+
+# FTS5 query matching every word of the phrase as a prefix, or None if the
+# phrase does not contain any word
+def match_query(phrase):
+    words = re.findall(r'\w+', phrase, re.UNICODE)
+    if not words:
+        return None
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def _ranked_ids(conn, fts_table, source_table, weights, query, where, params, offset, limit):
+    cursor = conn.cursor()
+    cursor.execute('SELECT s.id FROM %(fts)s JOIN %(source)s s ON s.id = %(fts)s.rowid '
+                   'WHERE %(fts)s MATCH %%s AND %(where)s '
+                   'ORDER BY bm25(%(fts)s, %(weights)s) LIMIT %%s OFFSET %%s'
+                   % {'fts': fts_table, 'source': source_table, 'where': where,
+                      'weights': ', '.join(str(w) for w in weights)},
+                   [query] + params + [limit, offset])
+    return [row[0] for row in cursor.fetchall()]
+
+
+# Active lessons matching the phrase, best match first
+def search_lessons(phrase, offset=0, limit=SEARCH_PAGE_SIZE, profiles=None):
+    profiles = profiles or ProfileMap()
+    conn = connections[router.db_for_read(Lesson)]
+    if fts_enabled(conn):
+        query = match_query(phrase)
+        if query is None:
+            return []
+        fts_table, source_table, _, weights = FTS_TABLES[0]
+        lesson_ids = _ranked_ids(conn, fts_table, source_table, weights, query, 's.status = %s', [LESSON_ACTIVE],
+                                 offset, limit)
+        lessons = Lesson.objects.in_bulk(lesson_ids)
+        lessons = [lessons[lesson_id] for lesson_id in lesson_ids if lesson_id in lessons]
+    else:
+        lessons = list(Lesson.objects.filter(Q(name__icontains=phrase) | Q(description__icontains=phrase),
+                                             status=LESSON_ACTIVE).order_by('id')[offset:offset + limit])
+
+    profiles.load(lesson.teacher_id for lesson in lessons)
+    return [lesson.dictify({'nregs': lesson.active_reg_count}, profiles) for lesson in lessons]
+
+
+# Profiles of the users matching the phrase, best match first. The admin and
+# the searching user are left out.
+def search_users(phrase, user, offset=0, limit=SEARCH_PAGE_SIZE, profiles=None):
+    profiles = profiles or ProfileMap()
+    conn = connections[router.db_for_read(User)]
+    if fts_enabled(conn):
+        query = match_query(phrase)
+        if query is None:
+            return []
+        fts_table, source_table, _, weights = FTS_TABLES[1]
+        user_ids = _ranked_ids(conn, fts_table, source_table, weights, query,
+                               "s.username != 'admin' AND s.id != %s", [user.id], offset, limit)
+    else:
+        user_ids = list(User.objects.filter(Q(username__icontains=phrase)
+                                            | Q(first_name__icontains=phrase)
+                                            | Q(last_name__icontains=phrase))
+                        .exclude(username='admin').exclude(id=user.id)
+                        .order_by('id').values_list('id', flat=True)[offset:offset + limit])
+
+    profiles.load(user_ids)
+    return [profiles.get(user_id) for user_id in user_ids if profiles.get(user_id) is not None]
@@ -61,13 +61,18 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'middleware.metrics.RequestMetrics',
+    'middleware.profiling.SampledProfiler',
+    'middleware.replica.ReplicaRouting',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'middleware.auth.CachedAuthentication',
+    'middleware.auth.SessionRenewal',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'middleware.crossdomainxhr.XsSharing',
+    'middleware.pulse.PulseNotifications',
 )
 
 # If you want configure the REDISCLOUD
@@ -86,8 +91,46 @@ if 'REDISCLOUD_URL' in os.environ and 'REDISCLOUD_PORT' in os.environ and 'REDIS
             }
         }
     }
-    MIDDLEWARE_CLASSES = ('django.middleware.cache.UpdateCacheMiddleware',) + MIDDLEWARE_CLASSES + (
-    'django.middleware.cache.FetchFromCacheMiddleware',)
+    # Seconds the pulse counters live in the cache. Redis is shared by all
+    # processes, so a count is dropped as soon as any of them changes the
+    # requests behind it, see levelhub.counters.
+    PULSE_CACHE_TIMEOUT = 60 * 60 * 24
+    # Seconds the per-user view cache entries and generations live in the cache
+    VIEW_CACHE_TIMEOUT = 60 * 60 * 24
+    # Seconds the roles of users in lessons live in the cache, see levelhub.roles
+    ROLE_CACHE_TIMEOUT = 60 * 60 * 24
+    # Long-poll pulse requests are woken up through Redis pub/sub from any process
+    NOTIFY_BACKEND = 'levelhub.notify.RedisBackend'
+    NOTIFY_REDIS = {'host': redis_server, 'port': int(redis_port), 'password': redis_password}
+    # Seconds the users of sessions live in the cache
+    USER_CACHE_TIMEOUT = 60 * 60 * 24
+    # Sessions are read from the database once and then from the cache
+    SESSION_STORE = os.environ.get('LEVELHUB_SESSION_STORE', 'cached_db')
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    # The local memory cache is private to each process and does not see the
+    # counter and view cache invalidations made by the others, so keep the
+    # drift short.
+    PULSE_CACHE_TIMEOUT = 30
+    VIEW_CACHE_TIMEOUT = 30
+    # Roles decide what users may do, so a role revoked by another process
+    # must not linger. 0 does not cache them.
+    ROLE_CACHE_TIMEOUT = 0
+    # Long-poll pulse requests are only woken up by writes of the same
+    # process. Those of other processes are seen at the next periodic recheck.
+    NOTIFY_BACKEND = 'levelhub.notify.LocalBackend'
+    USER_CACHE_TIMEOUT = 30
+    # A session cached by a process would stay valid there after a logout
+    # handled by another one
+    SESSION_STORE = os.environ.get('LEVELHUB_SESSION_STORE', 'db')
+
+# Streamed responses, e.g. whole rosters, larger than this many bytes are not
+# stored in the view cache, since caching them takes the whole response in memory
+VIEW_CACHE_MAX_BYTES = 256 * 1024
 
 ROOT_URLCONF = 'urls'
 
@@ -99,20 +142,61 @@ TEMPLATE_DIRS = (
 
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
-if ON_OPENSHIFT:
-    DATABASES = {
-        'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'db.sqlite3'),
-        }
+
+# Seconds a SQLite connection waits for a lock held by another one before it
+# fails with "database is locked"
+SQLITE_BUSY_TIMEOUT = 20
+
+# Pragmas run by every new SQLite connection, in order, see levelhub.dbtuning.
+# In WAL mode readers are not blocked by a writer. synchronous NORMAL is safe
+# with WAL, a power loss can only drop the last transactions. A negative
+# cache_size is in KiB.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16 * 1024),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+# A database configured by the environment variables starting with prefix:
+# ENGINE (SQLite by default), NAME, USER, PASSWORD, HOST, PORT and
+# CONN_MAX_AGE, the seconds a connection is kept open for the next requests.
+# Connections to server databases are kept for a minute by default, SQLite ones
+# are cheap to open and are closed after each request.
+def database_from_env(prefix, default_name):
+    engine = os.environ.get(prefix + 'ENGINE', 'django.db.backends.sqlite3')
+    sqlite = engine == 'django.db.backends.sqlite3'
+    database = {
+        'ENGINE': engine,
+        'NAME': os.environ.get(prefix + 'NAME', default_name),
+        'CONN_MAX_AGE': int(os.environ.get(prefix + 'CONN_MAX_AGE', 0 if sqlite else 60)),
     }
+    if sqlite:
+        database['OPTIONS'] = {'timeout': SQLITE_BUSY_TIMEOUT}
+    else:
+        for key in ('USER', 'PASSWORD', 'HOST', 'PORT'):
+            database[key] = os.environ.get(prefix + key, '')
+    return database
+
+if ON_OPENSHIFT:
+    DATABASES = {'default': database_from_env('LEVELHUB_DB_',
+                                              os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'db.sqlite3'))}
 else:
-    DATABASES = {
-        'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-        }
-    }
+    DATABASES = {'default': database_from_env('LEVELHUB_DB_', os.path.join(BASE_DIR, 'db.sqlite3'))}
+
+# A read replica of the default database, configured the same way by the
+# LEVELHUB_REPLICA_DB_* variables, takes the reads of GET requests, see
+# levelhub.routers. After a write a client reads from the primary for
+# REPLICA_PIN_SECONDS. Locally two SQLite files can stand in for the primary
+# and the replica, see 'manage.py copy_replica'.
+if 'LEVELHUB_REPLICA_DB_NAME' in os.environ:
+    DATABASES['replica'] = database_from_env('LEVELHUB_REPLICA_DB_', None)
+    # Tests run against the default database only
+    DATABASES['replica']['TEST_MIRROR'] = 'default'
+    DATABASE_ROUTERS = ['levelhub.routers.ReplicaRouter']
+REPLICA_PIN_SECONDS = 10
+REPLICA_PIN_COOKIE = 'levelhub_primary'
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
@@ -135,7 +219,70 @@ STATIC_URL = '/static/'
 
 # session related settings
 # SESSION_COOKIE_HTTPONLY = False
-SESSION_COOKIE_AGE = 315360000  # 10 years
+# Sessions live for a year after the last request, see middleware.auth
+SESSION_COOKIE_AGE = 60 * 60 * 24 * 365
+SESSION_RENEW_INTERVAL = 60 * 60 * 24 * 30
+# Where sessions are kept, set by the cache branches above:
+# 'db': in the database, read on every request.
+# 'cached_db': in the cache in front of the database, which is only read on a
+# cache miss. Needs a cache shared by all processes.
+# 'signed_cookies': in the session cookie, signed with SECRET_KEY. Nothing is
+# stored on the server, but a logout cannot revoke a copy of the cookie.
+SESSION_ENGINE = {'db': 'django.contrib.sessions.backends.db',
+                  'cached_db': 'django.contrib.sessions.backends.cached_db',
+                  'signed_cookies': 'django.contrib.sessions.backends.signed_cookies'}[SESSION_STORE]
 
 # User profile
-AUTH_PROFILE_MODULE = 'levelhub.UserProfile'
\ No newline at end of file
+AUTH_PROFILE_MODULE = 'levelhub.UserProfile'
+
+# How the lesson message feed is built.
+# 'read': messages are looked up through the user's lessons on every read.
+# 'write': a UserMessage inbox row is written for every recipient when a message
+# is posted, and reads scan the user's inbox only. Run 'manage.py backfill_inbox'
+# before switching an existing database to 'write'.
+MESSAGE_FANOUT = 'read'
+
+# JSON encoders for responses, in order of preference. The first one that is
+# installed is used. ujson and simplejson are optional C accelerated encoders,
+# json is the standard library fallback.
+JSON_BACKENDS = ('ujson', 'simplejson', 'json')
+
+# Per-endpoint request metrics, see levelhub.metrics. Each process logs a
+# report of its REQUEST_METRICS_TOP slowest and chattiest endpoints every
+# REQUEST_METRICS_REPORT_INTERVAL seconds. The queries of one in
+# REQUEST_METRICS_QUERY_SAMPLE_RATE requests are counted, which keeps them in
+# memory until the request ends, 0 counts none. In debug mode all are counted.
+# The long polls of REQUEST_METRICS_LONG_POLL are left out of the slowest.
+REQUEST_METRICS = True
+REQUEST_METRICS_REPORT_INTERVAL = 60 * 10
+REQUEST_METRICS_TOP = 10
+REQUEST_METRICS_QUERY_SAMPLE_RATE = 100
+REQUEST_METRICS_LONG_POLL = ('j_pulse',)
+
+# Request profiling, see levelhub.profiles. One in PROFILE_SAMPLE_RATE requests
+# is profiled, 0 only profiles the requests with an X-Levelhub-Profile token
+# made by 'manage.py profiles --token', valid for PROFILE_TOKEN_MAX_AGE seconds.
+# Only the PROFILE_KEEP newest profiles are kept in PROFILE_DIR.
+PROFILE_SAMPLE_RATE = 0
+PROFILE_TOKEN_MAX_AGE = 60 * 60 * 24
+PROFILE_KEEP = 200
+if ON_OPENSHIFT:
+    PROFILE_DIR = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'profiles')
+else:
+    PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'levelhub': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
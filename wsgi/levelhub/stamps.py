@@ -0,0 +1,86 @@
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+from levelhub import notify
+from levelhub.models import UserProfile, LessonRequest
+from levelhub.consts import *
+
+
+# ############################################################################
+# Per-user version stamps
+#
+# Each user profile records when the data behind the user's lesson lists,
+# lesson requests and message feed last changed. Writes touch the stamps of
+# every user whose view of the data they change, in the same transaction as
+# the write. GET views compare the stamps with the validators sent by the
+# client to answer conditional requests without running their queries.
+#############################################################################
+
+LESSONS = 'lessons_modified'
+REQUESTS = 'requests_modified'
+MESSAGES = 'messages_modified'
+
+
+# The requests and messages stamps drive the pulse, so the users are notified
+# when one of them moves
+def touch(user_ids, *stamps):
+    now = timezone.now()
+    UserProfile.objects.filter(user__in=user_ids).update(**dict((stamp, now) for stamp in stamps))
+    if REQUESTS in stamps or MESSAGES in stamps:
+        if isinstance(user_ids, QuerySet):
+            user_ids = [row['id'] for row in user_ids]
+        notify.publish(user_ids)
+
+
+# Ids of the teachers and active students of the lessons, as a sub-query
+def lesson_members(lesson_ids):
+    return User.objects.filter(Q(lesson__in=lesson_ids)
+                               | Q(lessonreg__lesson__in=lesson_ids, lessonreg__status=LESSON_REG_ACTIVE)) \
+        .values('id')
+
+
+# A lesson was updated or is about to be deleted. Its members see it in their
+# lesson lists and message feeds, and the parties of its requests in their
+# requests.
+def lesson_changed(lesson_id):
+    touch(lesson_members([lesson_id]), LESSONS, MESSAGES)
+    parties = LessonRequest.objects.filter(lesson=lesson_id).values_list('sender', 'receiver')
+    touch(set(user_id for pair in parties for user_id in pair), REQUESTS)
+
+
+# Registrations of the lesson were added or deactivated, which changes its
+# number of registrations. Members who joined or left also find their lesson
+# lists and message feeds changed.
+def roster_changed(lesson_id, *student_ids):
+    touch(lesson_members([lesson_id]), LESSONS)
+    if student_ids:
+        touch([student_id for student_id in student_ids if student_id is not None], LESSONS, MESSAGES)
+
+
+# Registrations or their reg logs changed, which shows in the study lists of
+# their students
+def lesson_regs_changed(lesson_regs):
+    touch([lesson_reg.student_id for lesson_reg in lesson_regs if lesson_reg.student_id is not None], LESSONS)
+
+
+def requests_changed(*user_ids):
+    touch([user_id for user_id in user_ids if user_id is not None], REQUESTS)
+
+
+# Messages sent to the lessons were posted or deleted
+def messages_changed(lesson_ids):
+    touch(lesson_members(lesson_ids), MESSAGES)
+
+
+# Time of the latest change among the given (user_id, stamp) pairs, or None if
+# one of the users has no profile
+def last_modified(*user_stamps):
+    fields = sorted(set(stamp for _, stamp in user_stamps))
+    rows = UserProfile.objects.filter(user__in=set(user_id for user_id, _ in user_stamps)) \
+        .values_list('user', *fields)
+    values = dict((row[0], dict(zip(fields, row[1:]))) for row in rows)
+    if any(user_id not in values for user_id, _ in user_stamps):
+        return None
+    return max(values[user_id][stamp] for user_id, stamp in user_stamps)
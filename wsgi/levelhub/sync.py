@@ -0,0 +1,171 @@
+import calendar
+from datetime import datetime, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.timezone import utc
+
+from levelhub.models import ProfileMap, Lesson, LessonReg, LessonRegLog, LessonMessage, LessonRequest, Tombstone
+from levelhub.queries import decode_cursor, encode_cursor, dictify_lesson_messages, query_lesson_message_ids, \
+    query_lesson_messages
+from levelhub.stamps import lesson_members
+from levelhub.consts import *
+
+
+# ############################################################################
+# Delta sync for offline clients
+#
+# Lessons, registrations, reg logs, requests and messages carry the time of
+# their last change in update_time. A sync token holds the time a sync was
+# made, moved back by SYNC_OVERLAP so that writes still being committed while
+# it ran are sent again by the next sync. Clients must therefore apply the
+# changes as upserts. Deletions are recorded as tombstones for every user who
+# could see the deleted object and are kept for SYNC_TOMBSTONE_DAYS. The
+# registrations, reg logs and requests of a deleted lesson are deleted with it
+# and have no tombstones of their own.
+#
+# A delta sends the messages changed since the token oldest first, at most
+# MAX_PAGE_SIZE of them. When more may have changed the token keeps its time
+# and also holds the id of the last message sent, and the next sync goes on
+# after it. Messages posted to a lesson before the user joined it never
+# change, so a delta only flags that the feed has to be reloaded.
+#############################################################################
+
+def encode_token(time, after_msg_id=None):
+    seconds = calendar.timegm(time.utctimetuple()) + time.microsecond / 1e6
+    return encode_cursor(seconds) if after_msg_id is None else encode_cursor(seconds, after_msg_id)
+
+
+# Return the time of the token and the id of the last message sent by the
+# sync that made it, or None if it sent all the changed messages. Raise
+# ValueError or TypeError if the token is invalid.
+def decode_token(token):
+    values = decode_cursor(token)
+    if len(values) not in (1, 2):
+        raise ValueError('Invalid sync token')
+    after_msg_id = int(values[1]) if len(values) == 2 else None
+    return datetime.utcfromtimestamp(float(values[0])).replace(tzinfo=utc), after_msg_id
+
+
+# Record the deletion of the objects for the users
+def bury(kind, object_ids, user_ids):
+    user_ids = set(user_ids)
+    Tombstone.objects.bulk_create([Tombstone(user_id=user_id, kind=kind, object_id=object_id)
+                                   for object_id in object_ids for user_id in user_ids])
+
+
+# A lesson is about to be deleted
+def lesson_deleted(lesson):
+    parties = LessonRequest.objects.filter(lesson=lesson).values_list('sender', 'receiver')
+    user_ids = set(user_id for pair in parties for user_id in pair)
+    user_ids.update(lesson_members([lesson.id]).values_list('id', flat=True))
+    bury(SYNC_LESSON, [lesson.id], user_ids)
+
+
+# A message is about to be deleted
+def message_deleted(message):
+    user_ids = set(lesson_members(LessonMessage.objects.filter(message=message).values('lesson'))
+                   .values_list('id', flat=True))
+    user_ids.add(message.sender_id)
+    bury(SYNC_MESSAGE, [message.id], user_ids)
+
+
+def prune_tombstones():
+    Tombstone.objects.filter(deletion_time__lt=timezone.now() - timedelta(days=SYNC_TOMBSTONE_DAYS)).delete()
+
+
+# Everything the user can see that changed since the given time, or all of it
+# if since is None or older than the kept tombstones. On a full sync only the
+# newest page of messages is sent, older ones are paged through the message
+# feed as usual. A delta sync sends up to MAX_PAGE_SIZE of the messages changed
+# since, oldest first after the message id after_msg_id. more_messages tells
+# the client to sync again at once for the rest. reload_messages tells it that
+# the user joined lessons whose older messages are only in the message feed.
+def query_sync(user, since, after_msg_id=None, inbox=False, profiles=None):
+    profiles = profiles or ProfileMap()
+    now = timezone.now()
+    if since is not None and since < now - timedelta(days=SYNC_TOMBSTONE_DAYS):
+        since = None
+
+    def changed(queryset):
+        return queryset if since is None else queryset.filter(update_time__gte=since)
+
+    study_lesson_ids = LessonReg.objects.filter(student=user, status=LESSON_REG_ACTIVE).values('lesson')
+
+    # The roster of every lesson taught and the user's own registrations.
+    # A full sync only has the active ones, a delta also the deactivated ones.
+    lesson_regs = changed(LessonReg.objects.filter(Q(lesson__teacher=user, lesson__status=LESSON_ACTIVE)
+                                                   | Q(student=user)))
+    if since is None:
+        lesson_regs = lesson_regs.filter(status=LESSON_REG_ACTIVE)
+    lesson_regs = list(lesson_regs.select_related('lesson'))
+
+    # Lessons that changed, and the ones the user joined
+    lessons = Lesson.objects.filter(Q(teacher=user) | Q(id__in=study_lesson_ids), status=LESSON_ACTIVE)
+    if since is not None:
+        lessons = lessons.filter(Q(update_time__gte=since)
+                                 | Q(id__in=[lesson_reg.lesson_id for lesson_reg in lesson_regs
+                                             if lesson_reg.student_id == user.id]))
+    lessons = list(lessons)
+
+    lesson_reg_logs = list(changed(LessonRegLog.objects.filter(
+        Q(lesson_reg__lesson__teacher=user, lesson_reg__lesson__status=LESSON_ACTIVE) | Q(lesson_reg__student=user),
+        lesson_reg__status=LESSON_REG_ACTIVE)).order_by('id'))
+
+    # Requests that stopped being viewable by the user are sent as deleted
+    lesson_requests = list(changed(LessonRequest.objects.filter(Q(receiver=user) | Q(sender=user)))
+                           .select_related('lesson').order_by('id'))
+    viewable_requests, hidden_request_ids = [], []
+    for req in lesson_requests:
+        if (req.receiver_id == user.id and req.status in REQUEST_RECEIVER_VIEWABLE) \
+                or (req.sender_id == user.id and req.status in REQUEST_SENDER_VIEWABLE):
+            viewable_requests.append(req)
+        else:
+            hidden_request_ids.append(req.id)
+
+    profiles.load([lesson.teacher_id for lesson in lessons]
+                  + [lesson_reg.student_id for lesson_reg in lesson_regs if lesson_reg.student_id]
+                  + [user_id for req in viewable_requests
+                     for user_id in (req.sender_id, req.receiver_id, req.lesson.teacher_id)])
+
+    token = encode_token(now - timedelta(seconds=SYNC_OVERLAP))
+    more_messages = reload_messages = False
+    if since is None:
+        messages = query_lesson_messages(user, None, False, inbox=inbox, profiles=profiles)
+    else:
+        # The page is over the message ids, some of which may be left out
+        # of the messages sent, see query_lesson_message_ids
+        message_ids = query_lesson_message_ids(user, after_msg_id or 0, True, MAX_PAGE_SIZE, inbox=inbox,
+                                               since=since)
+        messages = dictify_lesson_messages(user, message_ids, profiles)
+        if len(message_ids) == MAX_PAGE_SIZE:
+            more_messages = True
+            token = encode_token(since, message_ids[-1])
+        # Creation times have no microseconds
+        joined_since = since.replace(microsecond=0)
+        reload_messages = any(lesson_reg.student_id == user.id and lesson_reg.status == LESSON_REG_ACTIVE
+                              and lesson_reg.creation_time >= joined_since for lesson_reg in lesson_regs)
+
+    deleted = dict((kind, []) for kind in (SYNC_LESSON, SYNC_REG_LOG, SYNC_REQUEST, SYNC_MESSAGE))
+    if since is not None:
+        for kind, object_id in Tombstone.objects.filter(user=user, deletion_time__gte=since) \
+                .values_list('kind', 'object_id'):
+            deleted[kind].append(object_id)
+        deleted[SYNC_REQUEST].extend(hidden_request_ids)
+
+    def dictify_reg(lesson_reg):
+        info_for_manager = None
+        if lesson_reg.lesson.teacher_id == user.id:
+            info_for_manager = {'total': lesson_reg.total_logs, 'unused': lesson_reg.unused_logs}
+        return lesson_reg.dictify(info_for_manager, profiles)
+
+    return {'sync_token': token,
+            'full': since is None,
+            'lessons': [lesson.dictify({'nregs': lesson.active_reg_count}, profiles) for lesson in lessons],
+            'regs': [dictify_reg(lesson_reg) for lesson_reg in lesson_regs],
+            'reg_logs': [lesson_reg_log.dictify() for lesson_reg_log in lesson_reg_logs],
+            'requests': [req.dictify(profiles) for req in viewable_requests],
+            'messages': messages,
+            'more_messages': more_messages,
+            'reload_messages': reload_messages,
+            'deleted': deleted}
@@ -0,0 +1,138 @@
+import bisect
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+
+from levelhub import counters, inbox
+from levelhub.models import UserProfile, Lesson, LessonReg, LessonRegLog, Message, LessonMessage, LessonRequest, \
+    student_sort_name
+from levelhub.consts import *
+
+
+# ############################################################################
+# Synthetic data for benchmarks
+#
+# Rows are bulk inserted, so this is meant to run against an empty scratch
+# database (e.g. a test database) and not against real data.
+#
+# Activity is skewed the way it is in real use: teachers, lessons and message
+# senders are picked from Zipf distributions, so a few of them account for
+# most of the rows, and lesson sizes follow a Pareto distribution around the
+# requested mean. A skew of 0 picks uniformly and gives every lesson the same
+# size.
+#############################################################################
+
+SYNTHETIC_PREFIX = 'synthetic'
+
+# Share of registrations of non-member students, and of messages sent to
+# several lessons at once
+NON_MEMBER_RATIO = 0.05
+MULTI_LESSON_MESSAGE_RATIO = 0.1
+
+
+def _new_ids(model, **kwargs):
+    return list(model.objects.filter(**kwargs).order_by('id').values_list('id', flat=True))
+
+
+# Return a function picking one of the items, the first ones most often. The
+# chance of the item of rank r is proportional to 1 / r ** skew.
+def _zipf_picker(rnd, items, skew):
+    cumulative = []
+    total = 0.0
+    for rank in range(1, len(items) + 1):
+        total += 1.0 / rank ** skew
+        cumulative.append(total)
+    return lambda: items[bisect.bisect(cumulative, rnd.random() * total)]
+
+
+def _lesson_size(rnd, mean, skew, n_users):
+    if not skew:
+        return min(mean, n_users)
+    # A Pareto distribution with shape 2 has twice its scale as mean
+    return max(1, min(int(rnd.paretovariate(2.0) * mean / 2.0), n_users))
+
+
+def seed(n_users=2000, n_lessons=500, regs_per_lesson=20, logs_per_reg=20, n_requests=5000, n_messages=5000,
+         skew=1.0, password=None, random_seed=0):
+    rnd = random.Random(random_seed)
+    now = '2014-07-01 12:00:00Z'
+    # Hashing is slow on purpose, so every user shares one hash
+    password = make_password(password) if password is not None else '!'
+
+    User.objects.bulk_create([User(username='%s%d' % (SYNTHETIC_PREFIX, i), first_name='First%d' % i,
+                                   last_name='Last%d' % i, password=password, last_login=now, date_joined=now)
+                              for i in range(n_users)])
+    user_ids = _new_ids(User, username__startswith=SYNTHETIC_PREFIX)
+    UserProfile.objects.bulk_create([UserProfile(user_id=user_id) for user_id in user_ids])
+
+    # Rank users and lessons in random order, so that the popular ones are
+    # spread over the id range
+    ranked_user_ids = rnd.sample(user_ids, len(user_ids))
+    pick_user = _zipf_picker(rnd, ranked_user_ids, skew)
+    Lesson.objects.bulk_create([Lesson(teacher_id=pick_user(), name='Lesson %d' % i,
+                                       description='Synthetic lesson number %d' % i, creation_time=now)
+                                for i in range(n_lessons)])
+    lesson_ids = _new_ids(Lesson)
+    teacher_of = dict(Lesson.objects.values_list('id', 'teacher'))
+    pick_lesson = _zipf_picker(rnd, rnd.sample(lesson_ids, len(lesson_ids)), skew)
+
+    # bulk_create does not call save(), which sets the sort names
+    sort_names = dict((row[0], student_sort_name(*row[1:])) for row in User.objects.filter(
+        username__startswith=SYNTHETIC_PREFIX).values_list('id', 'first_name', 'last_name', 'username'))
+    lesson_regs = []
+    for lesson_id in lesson_ids:
+        for student_id in rnd.sample(user_ids, _lesson_size(rnd, regs_per_lesson, skew, len(user_ids))):
+            lesson_reg = LessonReg(lesson_id=lesson_id, student_id=student_id, creation_time=now,
+                                   status=LESSON_REG_ACTIVE if rnd.random() < 0.9 else LESSON_REG_QUIT,
+                                   sort_name=sort_names[student_id])
+            if rnd.random() < NON_MEMBER_RATIO:
+                lesson_reg.student_id = None
+                lesson_reg.student_first_name = 'Guest%d' % student_id
+                lesson_reg.student_last_name = 'Student%d' % lesson_id
+                lesson_reg.sort_name = student_sort_name(lesson_reg.student_first_name, lesson_reg.student_last_name)
+            lesson_regs.append(lesson_reg)
+    LessonReg.objects.bulk_create(lesson_regs)
+    reg_ids = _new_ids(LessonReg)
+
+    lesson_reg_logs = []
+    for reg_id in reg_ids:
+        n_used = rnd.randint(0, logs_per_reg)
+        lesson_reg_logs.extend(LessonRegLog(lesson_reg_id=reg_id, creation_time=now,
+                                            use_time=now if i < n_used else None)
+                               for i in range(logs_per_reg))
+    LessonRegLog.objects.bulk_create(lesson_reg_logs)
+
+    # Accepting or rejecting a request changes its status in place, so the
+    # student sends the requests to join and to quit and keeps sending them
+    # once answered, and the teacher sends the other ones
+    lesson_requests = []
+    for _ in range(n_requests):
+        lesson_id = pick_lesson()
+        status = rnd.choice(REQUEST_RECEIVER_NOTICE + REQUEST_SENDER_NOTICE)
+        teacher_id, other_id = teacher_of[lesson_id], rnd.choice(user_ids)
+        if status in (REQUEST_JOIN, REQUEST_QUIT, REQUEST_JOIN_ACCEPTED, REQUEST_JOIN_REJECTED):
+            sender_id, receiver_id = other_id, teacher_id
+        else:
+            sender_id, receiver_id = teacher_id, other_id
+        lesson_requests.append(LessonRequest(sender_id=sender_id, receiver_id=receiver_id, lesson_id=lesson_id,
+                                             message='Synthetic request', creation_time=now, status=status,
+                                             is_new=rnd.random() < 0.3))
+    LessonRequest.objects.bulk_create(lesson_requests)
+
+    # Most messages are posted by the teacher of their first lesson
+    message_lessons = []
+    for _ in range(n_messages):
+        n_targets = rnd.randint(2, 3) if rnd.random() < MULTI_LESSON_MESSAGE_RATIO else 1
+        message_lessons.append(sorted(set(pick_lesson() for _ in range(n_targets))))
+    Message.objects.bulk_create([Message(sender_id=teacher_of[targets[0]] if rnd.random() < 0.8 else pick_user(),
+                                         body='Synthetic message %d' % i, creation_time=now)
+                                 for i, targets in enumerate(message_lessons)])
+    LessonMessage.objects.bulk_create([LessonMessage(lesson_id=lesson_id, message_id=message_id)
+                                       for message_id, targets in zip(_new_ids(Message), message_lessons)
+                                       for lesson_id in targets])
+
+    counters.rebuild_active_reg_counts()
+    counters.rebuild_reg_log_counters()
+    if inbox.fanout_on_write():
+        inbox.backfill()
@@ -0,0 +1,1154 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from importlib import import_module
+import json
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.urlresolvers import resolve
+from django.db import connections, router
+from django.db.backends.sqlite3.base import DatabaseWrapper as SqliteDatabaseWrapper
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.utils import timezone
+
+from levelhub import counters, dbtuning, inbox, metrics, profiles, routers, stamps, synthetic, usercache, viewcache
+from levelhub.management.commands.bench_endpoints import percentile
+from levelhub.management.commands.profiles import statement
+from levelhub.models import ProfileMap, UserProfile, Lesson, LessonReg, LessonRegLog, Message, LessonMessage, \
+    UserMessage, LessonRequest, rebuild_reg_sort_names, student_sort_name
+from levelhub.roles import role_of_lesson, roles_of_lessons
+from levelhub.utils import format_datetime, json_array_chunks, json_backends, load_json_backend
+from levelhub.queries import decode_cursor, query_teach_lessons, query_study_lessons, query_lesson_regs, query_lesson_messages, \
+    query_lesson_requests
+from levelhub.consts import *
+
+
+def make_user(username):
+    user = User.objects.create_user(username, password='test')
+    UserProfile(user=user).save()
+    return user
+
+
+# A test client logged in as the user, middleware.crossdomainxhr needs a host
+def make_client(username):
+    client = Client(HTTP_HOST='testserver')
+    client.login(username=username, password='test')
+    return client
+
+
+# The lesson lists run the same number of queries whatever the number of lessons
+class LessonListQueriesTest(TestCase):
+    SIZES = [1, 10, 500]
+
+    def make_lessons(self, teacher, n):
+        Lesson.objects.bulk_create([Lesson(teacher=teacher, name='Lesson %d' % i, description='')
+                                    for i in range(n)])
+        return Lesson.objects.filter(teacher=teacher)
+
+    def test_teach_lessons(self):
+        for n in self.SIZES:
+            teacher = make_user('teacher%d' % n)
+            self.make_lessons(teacher, n)
+            # The lessons and the teacher's profile
+            with self.assertNumQueries(2):
+                lessons = query_teach_lessons(teacher)
+            self.assertEqual(len(lessons), n)
+
+    def test_study_lessons(self):
+        for n in self.SIZES:
+            # Each lesson has a teacher of its own
+            teachers = [make_user('teacher%d-%d' % (n, i)) for i in range(min(n, 10))]
+            lessons = []
+            for i, teacher in enumerate(teachers):
+                lessons.extend(self.make_lessons(teacher, n // len(teachers) + (i < n % len(teachers))))
+            student = make_user('student%d' % n)
+            LessonReg.objects.bulk_create([LessonReg(lesson=lesson, student=student) for lesson in lessons])
+            # The profiles of the teachers and the registrations with their lessons
+            with self.assertNumQueries(2):
+                lessons = query_study_lessons(student)
+            self.assertEqual(len(lessons), n)
+            self.assertEqual(set(lesson['teacher']['username'] for lesson in lessons),
+                             set(teacher.username for teacher in teachers))
+
+
+class ProfileMapQueriesTest(TestCase):
+    def setUp(self):
+        self.users = [make_user('user%d' % i) for i in range(3)]
+        # A user without profile
+        self.no_profile = User.objects.create_user('noprofile', password='test')
+
+    def test_load_repeated_and_missing_users(self):
+        profiles = ProfileMap()
+        user_ids = [user.id for user in self.users]
+        with self.assertNumQueries(1):
+            profiles.load(user_ids + user_ids + [self.no_profile.id, 10 ** 6])
+        with self.assertNumQueries(0):
+            for user in self.users:
+                self.assertEqual(profiles.get(user.id)['username'], user.username)
+            self.assertIsNone(profiles.get(self.no_profile.id))
+            self.assertIsNone(profiles.get(10 ** 6))
+            profiles.load(user_ids)
+
+    def test_get_loads_each_user_once(self):
+        profiles = ProfileMap()
+        with self.assertNumQueries(2):
+            for _ in range(3):
+                self.assertEqual(profiles.get(self.users[0].id)['username'], 'user0')
+                self.assertIsNone(profiles.get(self.no_profile.id))
+
+    def test_load_queryset(self):
+        profiles = ProfileMap()
+        with self.assertNumQueries(1):
+            profiles.load(User.objects.values('id'))
+        with self.assertNumQueries(0):
+            self.assertEqual(profiles.get(self.users[2].id)['username'], 'user2')
+
+
+# Every serialized list loads the profiles it shows at once, however many
+# times each user appears in it
+class SerializationQueriesTest(TestCase):
+    def setUp(self):
+        self.teachers = [make_user('teacher%d' % i) for i in range(3)]
+        self.students = [make_user('student%d' % i) for i in range(10)]
+        self.lessons = [Lesson.objects.create(teacher=teacher, name='Lesson', description='')
+                        for teacher in self.teachers]
+        for lesson in self.lessons:
+            LessonReg.objects.bulk_create([LessonReg(lesson=lesson, student=student) for student in self.students])
+            LessonReg(lesson=lesson, student_first_name='Non', student_last_name='Member').save()
+            LessonRequest.objects.bulk_create([LessonRequest(sender=student, receiver=lesson.teacher, lesson=lesson,
+                                                             status=REQUEST_JOIN) for student in self.students])
+        self.student = self.students[0]
+        for i in range(20):
+            message = Message.objects.create(sender=self.teachers[i % 3], body='Message %d' % i)
+            LessonMessage.objects.bulk_create([LessonMessage(lesson=lesson, message=message)
+                                               for lesson in self.lessons[:i % 3 + 1]])
+        inbox.backfill()
+
+    def test_lesson_lists(self):
+        profiles = ProfileMap()
+        with self.assertNumQueries(2):
+            self.assertEqual(len(query_study_lessons(self.student, profiles)), 3)
+        # The teacher's profile is already loaded
+        with self.assertNumQueries(1):
+            self.assertEqual(len(query_teach_lessons(self.teachers[0], profiles)), 1)
+
+    def test_lesson_requests(self):
+        # The requests with their lessons and the profiles
+        with self.assertNumQueries(2):
+            self.assertEqual(len(query_lesson_requests(self.teachers[0])), 10)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(query_lesson_requests(self.student)), 3)
+
+    def test_roster(self):
+        # The registrations and the profiles
+        with self.assertNumQueries(2):
+            response, _ = query_lesson_regs(self.lessons[0], ROLE_LESSON_MANAGER, limit=MAX_PAGE_SIZE)
+        self.assertEqual(len(response), 11)
+        with self.assertNumQueries(2):
+            self.assertEqual(len(list(query_lesson_regs(self.lessons[0], ROLE_LESSON_STUDENT))), 11)
+
+    def test_streamed_roster(self):
+        User.objects.bulk_create([User(username='member%d' % i) for i in range(STREAM_CHUNK_SIZE + 10)])
+        members = User.objects.filter(username__startswith='member')
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in members])
+        LessonReg.objects.bulk_create([LessonReg(lesson=self.lessons[1], student=user) for user in members])
+        regs = query_lesson_regs(self.lessons[1], ROLE_LESSON_STUDENT)
+        # The registrations, then the profiles of each chunk of them as it is reached
+        with self.assertNumQueries(2):
+            next(regs)
+        with self.assertNumQueries(0):
+            for _ in range(STREAM_CHUNK_SIZE - 1):
+                next(regs)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(list(regs)), 21)
+
+    def test_messages(self):
+        # The ids of the page, the messages with their lessons and the profiles
+        for inbox_feed in (False, True):
+            with self.assertNumQueries(3):
+                response = query_lesson_messages(self.student, None, False, limit=15, inbox=inbox_feed)
+            self.assertEqual(len(response), 15)
+            self.assertEqual(sum(len(item['lessons']) for item in response), 30)
+
+
+# Rosters are sorted by the lower cased display names of the students, the same
+# way for names beyond ASCII, whole or a page at a time
+class RosterOrderTest(TestCase):
+    def setUp(self):
+        self.teacher = make_user('teacher')
+        self.lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        for username, first_name, last_name in [('emile', u'\xe9mile', u'Zola'), ('zed', u'', u''),
+                                                ('alice', u'alice', u'Smith'), ('oscar', u'\xd6scar', u'Brown'),
+                                                ('bob', u'Bob', u'\xc5berg')]:
+            user = make_user(username)
+            user.first_name, user.last_name = first_name, last_name
+            user.save()
+            LessonReg(lesson=self.lesson, student=user).save()
+        LessonReg(lesson=self.lesson, student_first_name=u'\xc4rger', student_last_name=u'Guest').save()
+        LessonReg(lesson=self.lesson, student_first_name=u'Carl', student_last_name=u'Guest').save()
+
+    def names(self, regs):
+        return [reg['student']['display_name'] if reg['student']
+                else u' '.join([reg['student_first_name'], reg['student_last_name']]) for reg in regs]
+
+    def expected(self):
+        return sorted(self.names(query_lesson_regs(self.lesson, ROLE_LESSON_MANAGER)), key=lambda name: name.lower())
+
+    def pages(self, limit):
+        names, after = [], None
+        while True:
+            regs, cursor = query_lesson_regs(self.lesson, ROLE_LESSON_MANAGER, after=after, limit=limit)
+            names.extend(self.names(regs))
+            if cursor is None:
+                return names
+            after = decode_cursor(cursor)
+
+    def test_order(self):
+        names = self.names(query_lesson_regs(self.lesson, ROLE_LESSON_MANAGER))
+        self.assertEqual(names, [u'alice Smith', u'Bob \xc5berg', u'Carl Guest', u'zed', u'\xc4rger Guest',
+                                 u'\xe9mile Zola', u'\xd6scar Brown'])
+        self.assertEqual(names, self.expected())
+        self.assertEqual(self.pages(2), names)
+
+    def test_renamed_student(self):
+        user = User.objects.get(username='zed')
+        user.first_name = u'Aaron'
+        user.save()
+        # Logging in saves the user without renaming
+        User.objects.get(username='alice').save(update_fields=['last_login'])
+        names = self.pages(3)
+        self.assertEqual(names[0], u'Aaron ')
+        self.assertEqual(names, self.expected())
+
+    # upgrade_db fills the sort names of a database from before them
+    def test_rebuild(self):
+        names = self.pages(MAX_PAGE_SIZE)
+        LessonReg.objects.update(sort_name='')
+        rebuild_reg_sort_names()
+        self.assertEqual(self.pages(2), names)
+
+
+# Every installed JSON backend encodes responses the same way as the standard
+# library, datetimes included
+class JsonEncodingTest(TestCase):
+    payload = {'name': u'\xc9mile', 'count': 3, 'ratio': 0.5, 'none': None, 'list': [1, 'two', {'three': True}],
+               'time': datetime(2014, 6, 22, 15, 30, tzinfo=timezone.utc), 'local': datetime(2014, 6, 22, 15, 30)}
+    expected = dict(payload, time='2014-06-22 15:30:00Z', local='2014-06-22 15:30:00')
+
+    def test_format_datetime(self):
+        self.assertEqual(format_datetime(self.payload['time']), '2014-06-22 15:30:00Z')
+        self.assertEqual(format_datetime(self.payload['local']), '2014-06-22 15:30:00')
+        self.assertEqual(format_datetime('2014-06-22 15:30:00Z'), '2014-06-22 15:30:00Z')
+        self.assertIsNone(format_datetime(None))
+
+    def test_backends(self):
+        backends = json_backends()
+        self.assertEqual(backends[-1][0], 'json')
+        for name, dumps in backends:
+            self.assertEqual(json.loads(dumps(self.payload)), self.expected, name)
+            self.assertEqual(json.loads(dumps([self.payload])), [self.expected], name)
+
+    def test_missing_backend(self):
+        self.assertRaises(ImportError, load_json_backend, 'no_such_json')
+        with self.settings(JSON_BACKENDS=('no_such_json', 'json')):
+            self.assertEqual([name for name, _ in json_backends()], ['json'])
+
+    def test_array_chunks(self):
+        items = [{'item': i} for i in range(5)]
+        chunks = list(json_array_chunks(iter(items), chunk_size=2))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(json.loads(''.join(chunks)), items)
+        self.assertEqual(''.join(json_array_chunks(iter([]))), '[]')
+
+
+# The synthetic data is consistent, reproducible from its seed and as skewed as
+# asked for
+class SyntheticSeedTest(TestCase):
+    sizes = {'n_users': 40, 'n_lessons': 8, 'regs_per_lesson': 5, 'logs_per_reg': 3, 'n_requests': 30,
+             'n_messages': 20}
+
+    def signature(self):
+        return sorted((lesson.name, lesson.teacher.username, lesson.active_reg_count,
+                       LessonMessage.objects.filter(lesson=lesson).count())
+                      for lesson in Lesson.objects.select_related('teacher'))
+
+    def test_seed(self):
+        synthetic.seed(password='pw', **self.sizes)
+        self.assertEqual([model.objects.count() for model in (User, Lesson, LessonRequest, Message)], [40, 8, 30, 20])
+        self.assertEqual(LessonRegLog.objects.count(), LessonReg.objects.count() * 3)
+        self.assertTrue(User.objects.order_by('?')[0].check_password('pw'))
+        self.assertEqual(counters.rebuild_active_reg_counts(check_only=True), [])
+        self.assertEqual(counters.rebuild_reg_log_counters(check_only=True), [])
+        for lesson_request in LessonRequest.objects.select_related('lesson'):
+            teacher_id = lesson_request.lesson.teacher_id
+            if lesson_request.status in (REQUEST_JOIN, REQUEST_QUIT, REQUEST_JOIN_ACCEPTED, REQUEST_JOIN_REJECTED):
+                self.assertEqual(lesson_request.receiver_id, teacher_id)
+            else:
+                self.assertEqual(lesson_request.sender_id, teacher_id)
+        for lesson_reg in LessonReg.objects.select_related('student'):
+            if lesson_reg.student:
+                self.assertEqual(lesson_reg.sort_name, student_sort_name(lesson_reg.student.first_name,
+                                                                         lesson_reg.student.last_name,
+                                                                         lesson_reg.student.username))
+            else:
+                self.assertEqual(lesson_reg.sort_name, student_sort_name(lesson_reg.student_first_name,
+                                                                         lesson_reg.student_last_name))
+
+    def test_reproducible(self):
+        synthetic.seed(random_seed=7, **self.sizes)
+        signature = self.signature()
+        User.objects.all().delete()
+        synthetic.seed(random_seed=7, **self.sizes)
+        self.assertEqual(self.signature(), signature)
+
+    def test_uniform(self):
+        synthetic.seed(skew=0, **self.sizes)
+        self.assertEqual(set(LessonReg.objects.values('lesson').annotate(n=Count('id')).values_list('n', flat=True)),
+                         {5})
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual([percentile(values, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+
+
+# Each request is recorded under its endpoint, with its queries when they are
+# sampled, and the report ranks the endpoints
+class RequestMetricsTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.teacher = make_user('teacher')
+        self.lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        self.client = make_client('teacher')
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_sampled_queries(self):
+        with self.settings(REQUEST_METRICS_QUERY_SAMPLE_RATE=1):
+            for _ in range(2):
+                self.client.get('/j/process_lessons/', {'category': 'all'})
+        stats = metrics.snapshot()['GET j_process_lessons']
+        self.assertEqual((stats['requests'], stats['query_requests']), (2, 2))
+        self.assertGreater(stats['mean_queries'], 0)
+        self.assertEqual(sum(stats['wall_time_histogram']), 2)
+        self.assertEqual(sum(stats['query_count_histogram']), 2)
+
+    def test_unsampled_queries(self):
+        with self.settings(REQUEST_METRICS_QUERY_SAMPLE_RATE=0):
+            self.client.get('/j/process_lessons/', {'category': 'all'})
+        stats = metrics.snapshot()['GET j_process_lessons']
+        self.assertEqual((stats['requests'], stats['query_requests'], stats['max_queries']), (1, 0, 0))
+
+    # A streamed response is recorded once it has been sent
+    def test_streamed_response(self):
+        response = self.client.get('/j/process_lesson_regs/', {'lesson_id': self.lesson.id})
+        self.assertTrue(response.streaming)
+        self.assertNotIn('GET j_process_lesson_regs', metrics.snapshot())
+        ''.join(response.streaming_content)
+        self.assertEqual(metrics.snapshot()['GET j_process_lesson_regs']['requests'], 1)
+
+    def test_debug_headers(self):
+        with self.settings(DEBUG=True):
+            response = self.client.get('/j/process_lessons/', {'category': 'all'})
+        self.assertGreater(int(response['X-Levelhub-Queries']), 0)
+        self.assertIn('X-Levelhub-Wall-Time', response)
+        with self.settings(DEBUG=False):
+            self.assertNotIn('X-Levelhub-Queries', self.client.get('/j/process_lessons/', {'category': 'all'}))
+
+    def test_report(self):
+        metrics.record('GET j_pulse', 25.0, None, 0.0, None)
+        metrics.record('GET j_slow', 1.0, 0.5, 0.01, 30)
+        metrics.record('GET j_fast', 0.01, 0.001, 0.0, 2)
+        slowest, chattiest = metrics.report().split('Chattiest endpoints by queries per request')
+        # The long poll spends its time waiting
+        self.assertNotIn('j_pulse', slowest)
+        self.assertLess(slowest.index('j_slow'), slowest.index('j_fast'))
+        self.assertNotIn('j_pulse', chattiest)
+        self.assertLess(chattiest.index('j_slow'), chattiest.index('j_fast'))
+        self.assertNotIn('j_fast', metrics.report(top_n=1).split('Chattiest')[0])
+
+
+# Requests are profiled when sampled or when they carry a token, long polls
+# only with a token, and only the newest profiles are kept
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        self.teacher = make_user('teacher')
+        self.lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        self.client = make_client('teacher')
+
+    def endpoints(self):
+        return [profiles.load(name)[0]['endpoint'] for name in profiles.names()]
+
+    def test_token(self):
+        with self.settings(PROFILE_DIR=self.profile_dir, PROFILE_SAMPLE_RATE=0):
+            self.client.get('/j/process_lessons/', {'category': 'all'})
+            self.client.get('/j/process_lessons/', {'category': 'all'}, HTTP_X_LEVELHUB_PROFILE='forged')
+            self.assertEqual(profiles.names(), [])
+            self.client.get('/j/process_lessons/', {'category': 'all'}, HTTP_X_LEVELHUB_PROFILE=profiles.make_token())
+            [name] = profiles.names()
+            info, path = profiles.load(name)
+        self.assertEqual((info['endpoint'], info['method'], info['status'], info['user_id']),
+                         ('j_process_lessons', 'GET', 200, self.teacher.id))
+        self.assertTrue(info['queries'])
+        self.assertTrue(pstats.Stats(path).total_calls)
+
+    def test_sampled(self):
+        with self.settings(PROFILE_DIR=self.profile_dir, PROFILE_SAMPLE_RATE=1):
+            self.client.get('/j/process_lessons/', {'category': 'all'})
+            self.client.get('/j/pulse/')
+            self.assertEqual(self.endpoints(), ['j_process_lessons'])
+            self.client.get('/j/pulse/', HTTP_X_LEVELHUB_PROFILE=profiles.make_token())
+            self.assertEqual(self.endpoints(), ['j_process_lessons', 'j_pulse'])
+
+    # A streamed response is profiled once it has been sent
+    def test_streamed_response(self):
+        with self.settings(PROFILE_DIR=self.profile_dir, PROFILE_SAMPLE_RATE=1):
+            response = self.client.get('/j/process_lesson_regs/', {'lesson_id': self.lesson.id})
+            self.assertEqual(profiles.names(), [])
+            ''.join(response.streaming_content)
+            self.assertEqual(self.endpoints(), ['j_process_lesson_regs'])
+
+    def test_prune(self):
+        with self.settings(PROFILE_DIR=self.profile_dir, PROFILE_SAMPLE_RATE=1, PROFILE_KEEP=2):
+            for category in ('all', 'teach', 'study'):
+                self.client.get('/j/process_lessons/', {'category': category})
+            self.assertEqual([profiles.load(name)[0]['path'] for name in profiles.names()],
+                             ['/j/process_lessons/?category=teach', '/j/process_lessons/?category=study'])
+
+    # The summary groups the queries that only differ by their parameters
+    def test_statement(self):
+        self.assertEqual(statement("QUERY = u'SELECT * FROM t WHERE id = %s' - PARAMS = (1,)"),
+                         'SELECT * FROM t WHERE id = %s')
+        self.assertEqual(statement("SELECT * FROM t WHERE id = 5 AND name = 'it''s'"),
+                         'SELECT * FROM t WHERE id = ? AND name = ?')
+
+
+# New SQLite connections run the tuning pragmas, so a reader is not blocked by
+# a transaction writing to the same file
+class SqliteTuningTest(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'db.sqlite3')
+
+    def connect(self):
+        connection = SqliteDatabaseWrapper(dict(settings.DATABASES['default'], NAME=self.path,
+                                                OPTIONS={'timeout': settings.SQLITE_BUSY_TIMEOUT}), 'tuning')
+        self.addCleanup(connection.close)
+        connection.ensure_connection()
+        return connection
+
+    def test_pragmas(self):
+        values = dbtuning.pragmas(self.connect())
+        self.assertEqual(values['journal_mode'], 'wal')
+        self.assertEqual(values['synchronous'], 1)
+        self.assertEqual(values['cache_size'], -16 * 1024)
+        self.assertEqual(values['temp_store'], 2)
+        self.assertEqual(values['busy_timeout'], settings.SQLITE_BUSY_TIMEOUT * 1000)
+
+    def test_reader_not_blocked_by_writer(self):
+        writer, reader = self.connect().connection, self.connect().connection
+        writer.execute('CREATE TABLE t (x integer)')
+        writer.execute('INSERT INTO t VALUES (1)')
+        writer.execute('BEGIN IMMEDIATE')
+        writer.execute('INSERT INTO t VALUES (2)')
+        self.assertEqual(reader.execute('SELECT count(*) FROM t').fetchone()[0], 1)
+        writer.execute('COMMIT')
+        self.assertEqual(reader.execute('SELECT count(*) FROM t').fetchone()[0], 2)
+
+    def test_database_from_env(self):
+        project_settings = import_module(os.environ['DJANGO_SETTINGS_MODULE'])
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        database = project_settings.database_from_env('TEST_DB_', 'default.sqlite3')
+        self.assertEqual((database['NAME'], database['CONN_MAX_AGE'], database['OPTIONS']),
+                         ('default.sqlite3', 0, {'timeout': settings.SQLITE_BUSY_TIMEOUT}))
+        os.environ.update({'TEST_DB_ENGINE': 'django.db.backends.postgresql_psycopg2', 'TEST_DB_NAME': 'levelhub',
+                           'TEST_DB_USER': 'levelhub'})
+        database = project_settings.database_from_env('TEST_DB_', 'default.sqlite3')
+        self.assertEqual((database['NAME'], database['USER'], database['CONN_MAX_AGE']), ('levelhub', 'levelhub', 60))
+        self.assertNotIn('OPTIONS', database)
+
+
+# The user of a session is read once and then taken from the cache until the
+# user is saved or deleted, and the sessions in use are renewed
+class SessionUserTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = make_user('user')
+
+    def request(self, backend='django.contrib.auth.backends.ModelBackend'):
+        request = RequestFactory().get('/')
+        request.session = {auth.SESSION_KEY: self.user.id, auth.BACKEND_SESSION_KEY: backend}
+        return request
+
+    def test_cached_user(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(usercache.get_user(self.request()), self.user)
+        with self.assertNumQueries(0):
+            user = usercache.get_user(self.request())
+        self.assertEqual(user, self.user)
+        self.assertEqual(user.backend, 'django.contrib.auth.backends.ModelBackend')
+
+    def test_saved_and_deleted_user(self):
+        usercache.get_user(self.request())
+        self.user.first_name = 'Renamed'
+        self.user.save()
+        self.assertEqual(usercache.get_user(self.request()).first_name, 'Renamed')
+        self.user.delete()
+        self.assertFalse(usercache.get_user(self.request()).is_authenticated())
+
+    def test_no_user(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        self.assertFalse(usercache.get_user(request).is_authenticated())
+        self.assertFalse(usercache.get_user(self.request(backend='unknown.Backend')).is_authenticated())
+
+    def test_session_renewal(self):
+        client = make_client('user')
+        client.get('/j/process_lessons/', {'category': 'all'})
+        renewed = client.session['renewed']
+        self.assertAlmostEqual(renewed, time.time(), delta=5)
+        # Renewed at most once in SESSION_RENEW_INTERVAL
+        session = client.session
+        session['renewed'] = renewed - 10
+        session.save()
+        client.get('/j/process_lessons/', {'category': 'all'})
+        self.assertEqual(client.session['renewed'], renewed - 10)
+        session['renewed'] = renewed - settings.SESSION_RENEW_INTERVAL - 1
+        session.save()
+        client.get('/j/process_lessons/', {'category': 'all'})
+        self.assertAlmostEqual(client.session['renewed'], time.time(), delta=5)
+
+
+def post_json(client, url, data):
+    return client.post(url, json.dumps(data), content_type='application/json')
+
+
+# Shorten how long the pulse waits for a change, in the views module the
+# URLconf serves it from
+@contextmanager
+def pulse_wait_timeout(seconds):
+    module = sys.modules[resolve('/j/pulse/').func.__module__]
+    timeout, module.PULSE_WAIT_TIMEOUT = module.PULSE_WAIT_TIMEOUT, seconds
+    try:
+        yield
+    finally:
+        module.PULSE_WAIT_TIMEOUT = timeout
+
+
+# A student who joins a lesson sees its earlier messages whether the feed is
+# read through the lessons or from the inbox, also after leaving and rejoining
+class InboxJoinTest(TestCase):
+    def setUp(self):
+        self.teacher = make_user('teacher')
+        self.student = make_user('student')
+        self.lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        self.message_ids = []
+        for i in range(3):
+            message = Message.objects.create(sender=self.teacher, body='Message %d' % i)
+            LessonMessage.objects.create(lesson=self.lesson, message=message)
+            self.message_ids.insert(0, message.id)
+        inbox.backfill()
+        self.teacher_client = make_client('teacher')
+        self.student_client = make_client('student')
+
+    # The feed served in the current MESSAGE_FANOUT mode
+    def feed(self):
+        return [item['message']['message_id'] for item in query_lesson_messages(
+            self.student, None, False, limit=MAX_PAGE_SIZE, inbox=inbox.fanout_on_write())]
+
+    def join(self):
+        post_json(self.student_client, '/j/process_lesson_requests/', {'action': 'join', 'lesson_id': self.lesson.id,
+                                                                       'message': ''})
+        lesson_request = LessonRequest.objects.get(sender=self.student, status=REQUEST_JOIN)
+        response = post_json(self.teacher_client, '/j/process_lesson_requests/',
+                             {'action': 'accept', 'req_id': lesson_request.id})
+        self.assertEqual(response.status_code, 200)
+        lesson_request.delete()
+
+    def enroll(self):
+        post_json(self.teacher_client, '/j/process_lesson_requests/',
+                  {'action': 'enroll', 'lesson_id': self.lesson.id, 'student_id': self.student.id,
+                   'message': '', 'daytimes': ''})
+        lesson_request = LessonRequest.objects.get(receiver=self.student, status=REQUEST_ENROLL)
+        response = post_json(self.student_client, '/j/process_lesson_requests/',
+                             {'action': 'accept', 'req_id': lesson_request.id})
+        self.assertEqual(response.status_code, 200)
+        lesson_request.delete()
+
+    def quit(self):
+        lesson_reg = LessonReg.objects.get(student=self.student, status=LESSON_REG_ACTIVE)
+        response = post_json(self.student_client, '/j/process_lesson_requests/',
+                             {'action': 'quit', 'reg_id': lesson_reg.id})
+        self.assertEqual(response.status_code, 200)
+        # The teacher dismisses the notice, which would be taken for a duplicate of the next join
+        post_json(self.teacher_client, '/j/process_lesson_requests/',
+                  {'action': 'dismiss', 'req_id': LessonRequest.objects.get(status=REQUEST_QUIT).id})
+
+    def test_join_leave_and_rejoin(self):
+        feeds = {}
+        for fanout in ('read', 'write'):
+            with self.settings(MESSAGE_FANOUT=fanout):
+                feeds[fanout] = []
+                for join in (self.join, self.enroll):
+                    join()
+                    feeds[fanout].append(self.feed())
+                    self.quit()
+                    feeds[fanout].append(self.feed())
+        self.assertEqual(feeds['read'], [self.message_ids, [], self.message_ids, []])
+        self.assertEqual(feeds['write'], feeds['read'])
+
+
+# A reg log batch is applied as a whole or not at all, see
+# views.apply_reg_log_actions
+class RegLogBatchTest(TestCase):
+    USE_TIME = '2014-06-22 15:30:00Z'
+
+    def setUp(self):
+        self.teacher = make_user('teacher')
+        self.other = make_user('other')
+        lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        other_lesson = Lesson.objects.create(teacher=self.other, name='Other', description='')
+        self.reg = LessonReg.objects.create(lesson=lesson, student_first_name='Non', student_last_name='Member')
+        self.quit_reg = LessonReg.objects.create(lesson=lesson, student_first_name='Gone', student_last_name='Away',
+                                                 status=LESSON_REG_QUIT)
+        self.other_reg = LessonReg.objects.create(lesson=other_lesson, student_first_name='Non',
+                                                  student_last_name='Member')
+        LessonRegLog.objects.bulk_create([LessonRegLog(lesson_reg=self.reg, use_time=self.USE_TIME if i < 2 else None)
+                                          for i in range(4)])
+        LessonRegLog.objects.create(lesson_reg=self.other_reg)
+        self.log_ids = list(LessonRegLog.objects.filter(lesson_reg=self.reg).order_by('id').values_list('id', flat=True))
+        counters.rebuild_reg_log_counters()
+        self.client = make_client('teacher')
+
+    def post(self, actions):
+        response = post_json(self.client, '/j/process_lesson_reg_logs/', actions)
+        if response.status_code == 400 and not response.content.startswith('{'):
+            return response.status_code, None
+        return response.status_code, [result['result'] for result in json.loads(response.content)['main']]
+
+    def logs(self):
+        return list(LessonRegLog.objects.filter(lesson_reg=self.reg).order_by('id').values_list('id', 'use_time'))
+
+    def counts(self):
+        return tuple(LessonReg.objects.filter(id=self.reg.id).values_list('total_logs', 'unused_logs')[0])
+
+    def test_failed_action_applies_nothing(self):
+        logs = self.logs()
+        for failing, status, result in [({'action': 'update', 'rlog_id': 10 ** 6, 'use_time': None, 'data': ''},
+                                         404, 'not_found'),
+                                        ({'action': 'delete', 'rlog_id': self.other_reg.lessonreglog_set.get().id},
+                                         403, 'forbidden'),
+                                        ({'action': 'create', 'reg_id': self.quit_reg.id, 'use_time': None,
+                                          'data': ''}, 404, 'not_found'),
+                                        ({'action': 'undo'}, 400, 'invalid_action')]:
+            self.assertEqual(self.post([{'action': 'create', 'reg_id': self.reg.id, 'use_time': None, 'data': ''},
+                                        {'action': 'delete', 'rlog_id': self.log_ids[0]},
+                                        failing]),
+                             (status, ['not_applied', 'not_applied', result]))
+        self.assertEqual(self.logs(), logs)
+        self.assertEqual(self.counts(), (4, 2))
+
+    def test_repeated_actions_on_a_log(self):
+        self.assertEqual(self.post([{'action': 'update', 'rlog_id': self.log_ids[2], 'use_time': self.USE_TIME,
+                                     'data': {'note': 'first'}},
+                                    {'action': 'update', 'rlog_id': self.log_ids[2], 'use_time': None,
+                                     'data': ['second']},
+                                    {'action': 'update', 'rlog_id': self.log_ids[3], 'use_time': self.USE_TIME,
+                                     'data': ''},
+                                    {'action': 'delete', 'rlog_id': self.log_ids[3]},
+                                    {'action': 'create', 'reg_id': self.reg.id, 'use_time': None, 'data': ''}]),
+                         (200, ['ok'] * 5))
+        log_ids = [log_id for log_id, _ in self.logs()]
+        self.assertEqual(log_ids[:3], self.log_ids[:3])
+        self.assertEqual(len(log_ids), 4)
+        log = LessonRegLog.objects.get(id=self.log_ids[2])
+        self.assertIsNone(log.use_time)
+        # Stored as a single update would store it
+        self.assertEqual(log.data, unicode([u'second']))
+        # A log deleted earlier in the batch is gone
+        self.assertEqual(self.post([{'action': 'delete', 'rlog_id': self.log_ids[0]},
+                                    {'action': 'delete', 'rlog_id': self.log_ids[0]}]),
+                         (404, ['not_applied', 'not_found']))
+
+    def test_counters_follow_the_batch(self):
+        self.post([{'action': 'create', 'reg_id': self.reg.id, 'use_time': None, 'data': ''},
+                   {'action': 'create', 'reg_id': self.reg.id, 'use_time': self.USE_TIME, 'data': ''},
+                   {'action': 'update', 'rlog_id': self.log_ids[0], 'use_time': None, 'data': ''},
+                   {'action': 'update', 'rlog_id': self.log_ids[2], 'use_time': self.USE_TIME, 'data': ''},
+                   {'action': 'update', 'rlog_id': self.log_ids[3], 'use_time': self.USE_TIME, 'data': ''},
+                   {'action': 'delete', 'rlog_id': self.log_ids[1]}])
+        self.assertEqual(self.counts(), (5, 2))
+        self.assertEqual(counters.rebuild_reg_log_counters(check_only=True), [])
+
+    def test_batch_size_limit(self):
+        create = {'action': 'create', 'reg_id': self.reg.id, 'use_time': None, 'data': ''}
+        self.assertEqual(self.post([create] * (MAX_REG_LOG_BATCH + 1)), (400, None))
+        self.assertEqual(self.post([create] * MAX_REG_LOG_BATCH), (200, ['ok'] * MAX_REG_LOG_BATCH))
+        self.assertEqual(self.counts(), (4 + MAX_REG_LOG_BATCH, 2 + MAX_REG_LOG_BATCH))
+
+
+# Cached views are served from the cache until a write changes the data behind
+# them, after which the next GET shows the change
+class ViewCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = make_user('teacher')
+        self.student = make_user('student')
+        self.lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        self.reg = LessonReg.objects.create(lesson=self.lesson, student=self.student, daytimes='Mon')
+        LessonRegLog.objects.create(lesson_reg=self.reg)
+        counters.rebuild_reg_log_counters()
+        counters.rebuild_active_reg_counts()
+        self.teacher_client = make_client('teacher')
+        self.student_client = make_client('student')
+
+    def get(self, client, url, data):
+        response = client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        content = ''.join(response.streaming_content) if response.streaming else response.content
+        return json.loads(content)['main']
+
+    # The main part of the response, which must be the same when it is got
+    # again from the cache
+    def cached(self, view, client, url, data):
+        main = self.get(client, url, data)
+        hits = viewcache.stats()[view][0]
+        self.assertEqual(self.get(client, url, data), main)
+        self.assertEqual(viewcache.stats()[view][0], hits + 1)
+        return main
+
+    def roster(self):
+        return self.cached('lesson_regs', self.teacher_client, '/j/process_lesson_regs/', {'lesson_id': self.lesson.id})
+
+    def reg_logs(self):
+        return self.cached('lesson_reg_logs', self.student_client, '/j/process_lesson_reg_logs/',
+                           {'reg_id': self.reg.id})
+
+    def post_reg_logs(self, actions):
+        self.assertEqual(post_json(self.teacher_client, '/j/process_lesson_reg_logs/', actions).status_code, 200)
+
+    def test_roster(self):
+        self.assertEqual([reg['daytimes'] for reg in self.roster()], ['Mon'])
+        post_json(self.teacher_client, '/j/process_lesson_regs/', {'reg_id': self.reg.id, 'daytimes': 'Tue'})
+        self.assertEqual([reg['daytimes'] for reg in self.roster()], ['Tue'])
+        post_json(self.teacher_client, '/j/process_lesson_requests/',
+                  {'action': 'enroll', 'lesson_id': self.lesson.id, 'first_name': 'Non', 'last_name': 'Member',
+                   'daytimes': 'Wed'})
+        self.assertEqual([reg['daytimes'] for reg in self.roster()], ['Wed', 'Tue'])
+        post_json(self.teacher_client, '/j/process_lesson_requests/', {'action': 'deroll', 'reg_id': self.reg.id})
+        self.assertEqual([reg['daytimes'] for reg in self.roster()], ['Wed'])
+
+    def test_roster_log_counts(self):
+        self.assertEqual([(reg['total'], reg['unused']) for reg in self.roster()], [(1, 1)])
+        self.post_reg_logs([{'action': 'create', 'reg_id': self.reg.id, 'use_time': None, 'data': '{}'}])
+        self.assertEqual([(reg['total'], reg['unused']) for reg in self.roster()], [(2, 2)])
+
+    def test_reg_logs(self):
+        rlog_id = self.reg_logs()[0]['rlog_id']
+        self.post_reg_logs([{'action': 'update', 'rlog_id': rlog_id, 'use_time': None, 'data': '{"note": 1}'}])
+        self.assertEqual([reg_log['data'] for reg_log in self.reg_logs()], ['{"note": 1}'])
+        self.post_reg_logs([{'action': 'delete', 'rlog_id': rlog_id}])
+        self.assertEqual(self.reg_logs(), [])
+
+    def test_lessons(self):
+        lessons = self.cached('lessons', self.student_client, '/j/process_lessons/', {'category': 'study'})
+        self.assertEqual([lesson['name'] for lesson in lessons], ['Lesson'])
+        post_json(self.teacher_client, '/j/process_lessons/',
+                  {'action': 'update', 'lesson_id': self.lesson.id, 'name': 'Renamed', 'description': ''})
+        lessons = self.cached('lessons', self.student_client, '/j/process_lessons/', {'category': 'study'})
+        self.assertEqual([lesson['name'] for lesson in lessons], ['Renamed'])
+
+    # Streamed responses over the size cap are not kept
+    def test_size_cap(self):
+        with self.settings(VIEW_CACHE_MAX_BYTES=10):
+            hits, misses = viewcache.stats()['lesson_regs']
+            for _ in range(2):
+                self.get(self.teacher_client, '/j/process_lesson_regs/', {'lesson_id': self.lesson.id})
+            self.assertEqual(viewcache.stats()['lesson_regs'], (hits, misses + 2))
+
+
+class DeltaSyncTest(TestCase):
+    def setUp(self):
+        self.teacher = make_user('teacher')
+        self.student = make_user('student')
+        self.lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        LessonReg.objects.create(lesson=self.lesson, student=self.student)
+        self.teacher_client = make_client('teacher')
+        self.student_client = make_client('student')
+
+    def sync(self, client, token=None):
+        response = client.get('/j/sync/', {'token': token} if token else {})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['main']
+
+    def post_messages(self, lesson, n):
+        Message.objects.bulk_create([Message(sender=lesson.teacher, body='Message %d' % i) for i in range(n)])
+        message_ids = list(Message.objects.order_by('-id').values_list('id', flat=True)[:n])
+        LessonMessage.objects.bulk_create([LessonMessage(lesson=lesson, message_id=message_id)
+                                           for message_id in message_ids])
+        return sorted(message_ids)
+
+    # Follow the sync tokens until all changed messages have been sent
+    def sync_messages(self, token):
+        pages = []
+        while True:
+            delta = self.sync(self.student_client, token)
+            pages.append(sorted(item['message']['message_id'] for item in delta['messages']))
+            token = delta['sync_token']
+            if not delta['more_messages']:
+                return pages
+
+    def test_changed_messages_are_paged(self):
+        token = self.sync(self.student_client)['sync_token']
+        message_ids = self.post_messages(self.lesson, MAX_PAGE_SIZE + 10)
+        self.assertEqual(self.sync_messages(token), [message_ids[:MAX_PAGE_SIZE], message_ids[MAX_PAGE_SIZE:]])
+
+    def test_inbox_rows_of_unseen_messages_do_not_end_the_paging(self):
+        other_lesson = Lesson.objects.create(teacher=self.teacher, name='Other', description='')
+        token = self.sync(self.student_client)['sync_token']
+        # Inbox rows left behind for messages of a lesson the student is not in
+        unseen_ids = self.post_messages(other_lesson, MAX_PAGE_SIZE)
+        UserMessage.objects.bulk_create([UserMessage(user=self.student, message_id=message_id)
+                                         for message_id in unseen_ids])
+        message_ids = self.post_messages(self.lesson, 3)
+        inbox.backfill()
+        with self.settings(MESSAGE_FANOUT='write'):
+            self.assertEqual(self.sync_messages(token), [[], message_ids])
+
+    def test_deletions(self):
+        token = self.sync(self.teacher_client)['sync_token']
+        message_id = self.post_messages(self.lesson, 1)[0]
+        reg_log = LessonRegLog.objects.create(lesson_reg=LessonReg.objects.get(student=self.student))
+        other_lesson = Lesson.objects.create(teacher=self.teacher, name='Other', description='')
+        post_json(self.student_client, '/j/process_lesson_requests/',
+                  {'action': 'join', 'lesson_id': other_lesson.id, 'message': ''})
+        lesson_request = LessonRequest.objects.get(status=REQUEST_JOIN)
+        delta = self.sync(self.teacher_client, token)
+        self.assertEqual([req['req_id'] for req in delta['requests']], [lesson_request.id])
+        self.assertEqual([log['rlog_id'] for log in delta['reg_logs']], [reg_log.id])
+
+        post_json(self.teacher_client, '/j/process_lesson_requests/', {'action': 'accept', 'req_id': lesson_request.id})
+        post_json(self.teacher_client, '/j/process_lesson_messages/', {'action': 'delete', 'message_id': message_id})
+        post_json(self.teacher_client, '/j/process_lesson_reg_logs/', [{'action': 'delete', 'rlog_id': reg_log.id}])
+        delta = self.sync(self.teacher_client, token)
+        # The answered request is only viewable by the student who sent it
+        self.assertEqual(delta['requests'], [])
+        self.assertEqual(delta['deleted'], {SYNC_LESSON: [], SYNC_REG_LOG: [reg_log.id],
+                                            SYNC_REQUEST: [lesson_request.id], SYNC_MESSAGE: [message_id]})
+        delta = self.sync(self.student_client, token)
+        self.assertEqual([req['status'] for req in delta['requests']], [REQUEST_JOIN_ACCEPTED])
+        self.assertEqual(delta['deleted'][SYNC_MESSAGE], [message_id])
+        self.assertEqual(delta['deleted'][SYNC_REG_LOG], [reg_log.id])
+
+    def test_joined_lessons_reload_the_messages(self):
+        other_lesson = Lesson.objects.create(teacher=self.teacher, name='Other', description='')
+        self.post_messages(other_lesson, 3)
+        # Out of the overlap of the token, joins within it are flagged again
+        LessonReg.objects.update(creation_time=timezone.now() - timedelta(hours=1))
+        token = self.sync(self.student_client)['sync_token']
+        self.assertFalse(self.sync(self.student_client, token)['reload_messages'])
+        LessonReg.objects.create(lesson=other_lesson, student=self.student)
+        delta = self.sync(self.student_client, token)
+        self.assertTrue(delta['reload_messages'])
+        self.assertIn(other_lesson.id, [lesson['lesson_id'] for lesson in delta['lessons']])
+        self.assertFalse(self.sync(self.teacher_client, token)['reload_messages'])
+
+
+# The requests are read a page at a time, newest first, and only the requests
+# of a page are marked read
+class RequestInboxTest(TestCase):
+    url = '/j/process_lesson_requests/'
+
+    def setUp(self):
+        self.teacher = make_user('teacher')
+        students = [make_user('student%d' % i) for i in range(6)]
+        lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        LessonRequest.objects.bulk_create([LessonRequest(sender=student, receiver=self.teacher, lesson=lesson,
+                                                         status=REQUEST_JOIN) for student in students])
+        # The teacher's own enroll is viewable and stays new, a deroll notice
+        # is only shown to its receiver
+        LessonRequest.objects.create(sender=self.teacher, receiver=students[0], lesson=lesson, status=REQUEST_ENROLL)
+        LessonRequest.objects.create(sender=self.teacher, receiver=students[1], lesson=lesson, status=REQUEST_DEROLL)
+        self.viewable = list(LessonRequest.objects.exclude(status=REQUEST_DEROLL).order_by('-id')
+                             .values_list('id', flat=True))
+        self.client = make_client('teacher')
+
+    def page(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return [request['req_id'] for request in json.loads(response.content)['main']]
+
+    def new_ids(self):
+        return set(LessonRequest.objects.filter(is_new=True).exclude(status=REQUEST_DEROLL)
+                   .values_list('id', flat=True))
+
+    def test_pages(self):
+        pages = [self.page(limit=3)]
+        while len(pages[-1]) == 3:
+            pages.append(self.page(limit=3, before=pages[-1][-1]))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), self.viewable)
+        self.assertEqual(self.page(), self.viewable)
+
+    def test_marks_page_read(self):
+        own_enroll = LessonRequest.objects.get(status=REQUEST_ENROLL).id
+        first = self.page(limit=3)
+        self.assertIn(own_enroll, first)
+        self.assertEqual(self.new_ids(), set(self.viewable) - set(first) | {own_enroll})
+        self.page()
+        self.assertEqual(self.new_ids(), {own_enroll})
+
+    def test_bad_page(self):
+        for params in ({'limit': 0}, {'limit': MAX_PAGE_SIZE + 1}, {'limit': 'ten'}, {'before': 'last'}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+
+
+# Polls of the requests are answered with 304 until something changes, also
+# right after the poll that marked them read
+class ConditionalRequestsTest(TestCase):
+    url = '/j/process_lesson_requests/'
+
+    def setUp(self):
+        self.teacher = make_user('teacher')
+        self.student = make_user('student')
+        self.lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        self.student_client = make_client('student')
+        self.teacher_client = make_client('teacher')
+        self.send_join()
+
+    def send_join(self):
+        LessonRequest.objects.all().delete()
+        response = post_json(self.student_client, self.url, {'action': 'join', 'lesson_id': self.lesson.id,
+                                                             'message': ''})
+        self.assertEqual(response.status_code, 200)
+
+    def pulse(self, token=None):
+        response = self.teacher_client.get('/j/pulse/', {'token': token} if token else {})
+        return json.loads(response.content)['main']
+
+    def test_etag(self):
+        response = self.teacher_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['main']), 1)
+        self.assertFalse(LessonRequest.objects.get().is_new)
+        etag = response['ETag']
+        self.assertEqual(self.teacher_client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.send_join()
+        self.assertEqual(self.teacher_client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_if_modified_since(self):
+        self.teacher_client.get(self.url)
+        # Last-Modified is only sent for stamps of earlier seconds
+        UserProfile.objects.update(requests_modified=timezone.now() - timedelta(hours=1))
+        response = self.teacher_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        last_modified = response['Last-Modified']
+        self.assertEqual(self.teacher_client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.send_join()
+        self.assertEqual(self.teacher_client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_pulse_stamp(self):
+        token = self.pulse()['token']
+        # Reading the requests moves the pulse, so the teacher's other clients
+        # see the count go down
+        response = self.teacher_client.get(self.url)
+        pulse = self.pulse(token)
+        self.assertTrue(pulse['changed'])
+        # Nothing moves it by the next poll, which is answered with 304
+        self.assertEqual(self.teacher_client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        with pulse_wait_timeout(0):
+            self.assertFalse(self.pulse(pulse['token'])['changed'])
+
+
+# The pulse answers as soon as the user's stamps move past the token, or with
+# no change once it timed out
+class PulseTest(TestCase):
+    def setUp(self):
+        self.user = make_user('user')
+        self.client = make_client('user')
+
+    def pulse(self, token=None):
+        start = time.time()
+        response = self.client.get('/j/pulse/', {'token': token} if token else {})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['main'], time.time() - start
+
+    def test_pulse(self):
+        pulse, elapsed = self.pulse()
+        self.assertFalse(pulse['token'] is None)
+        self.assertLess(elapsed, 0.5)
+        with pulse_wait_timeout(0.5):
+            self.assertFalse(self.pulse(pulse['token'])[0]['changed'])
+        stamps.requests_changed(self.user.id)
+        changed, elapsed = self.pulse(pulse['token'])
+        self.assertTrue(changed['changed'])
+        self.assertNotEqual(changed['token'], pulse['token'])
+        self.assertLess(elapsed, 0.5)
+
+    # Nothing can change without a profile, the pulse must not spin
+    def test_user_without_profile(self):
+        UserProfile.objects.all().delete()
+        with pulse_wait_timeout(0.5):
+            for token in (None, 'stale'):
+                pulse, elapsed = self.pulse(token)
+                self.assertEqual(pulse, {'token': None, 'changed': False})
+                self.assertGreaterEqual(elapsed, 0.5)
+
+
+class RolesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = make_user('teacher')
+        self.student = make_user('student')
+        self.lessons = [Lesson.objects.create(teacher=self.teacher, name='Lesson %d' % i, description='')
+                        for i in range(3)]
+        self.reg = LessonReg.objects.create(lesson=self.lessons[0], student=self.student)
+        LessonReg.objects.create(lesson=self.lessons[1], student=self.student, status=LESSON_REG_QUIT)
+
+    # A user object of its own, as in a new request
+    def fresh(self, user):
+        return User.objects.get(id=user.id)
+
+    def test_roles_of_lessons(self):
+        student = self.fresh(self.student)
+        # One query for the registrations of all the lessons
+        with self.assertNumQueries(1):
+            self.assertEqual(roles_of_lessons(student, self.lessons), {self.lessons[0].id: ROLE_LESSON_STUDENT,
+                                                                       self.lessons[1].id: ROLE_LESSON_NONE,
+                                                                       self.lessons[2].id: ROLE_LESSON_NONE})
+        with self.assertNumQueries(0):
+            self.assertEqual(set(roles_of_lessons(self.teacher, self.lessons).values()), {ROLE_LESSON_MANAGER})
+            # Memoized on the user object
+            self.assertEqual(role_of_lesson(student, self.lessons[0]), ROLE_LESSON_STUDENT)
+
+    def test_roles_are_cached_per_roster_generation(self):
+        students = [self.fresh(self.student) for _ in range(4)]
+        with self.settings(ROLE_CACHE_TIMEOUT=60):
+            with self.assertNumQueries(1):
+                roles_of_lessons(students[0], self.lessons)
+                self.assertEqual(roles_of_lessons(students[1], self.lessons)[self.lessons[0].id],
+                                 ROLE_LESSON_STUDENT)
+            viewcache.roster_changed(self.lessons[0].id)
+            with self.assertNumQueries(1):
+                roles_of_lessons(students[2], self.lessons)
+        # Without a shared cache every request looks them up
+        with self.assertNumQueries(1):
+            roles_of_lessons(students[3], self.lessons)
+
+    def test_deroll_revokes_access_at_once(self):
+        student_client = make_client('student')
+        url = '/j/process_lesson_regs/?lesson_id=%d' % self.lessons[0].id
+        self.assertEqual(student_client.get(url).status_code, 200)
+        # Another process derolls the student, the new roster generation is
+        # only in its own cache
+        generation = viewcache.generation('roster', self.lessons[0].id)
+        response = post_json(make_client('teacher'), '/j/process_lesson_requests/',
+                             {'action': 'deroll', 'reg_id': self.reg.id})
+        self.assertEqual(response.status_code, 200)
+        cache.set('levelhub:generation:roster:%d' % self.lessons[0].id, generation)
+        self.assertEqual(student_client.get(url).status_code, 403)
+
+
+# Reads routed as in production to a replica that lags behind, i.e. an
+# in-memory copy of the test database taken by snapshot_replica() that the
+# later writes of the test do not reach. The transaction of a TestCase would
+# keep every read on the primary.
+class ReplicaTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        settings.DATABASES[routers.REPLICA] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        self.routers = router.routers
+        router.routers = [routers.ReplicaRouter()]
+
+    def tearDown(self):
+        router.routers = self.routers
+        self.drop_replica()
+        del settings.DATABASES[routers.REPLICA]
+        routers.pin_primary()
+
+    def drop_replica(self):
+        if hasattr(connections._connections, routers.REPLICA):
+            del connections[routers.REPLICA]
+
+    def snapshot_replica(self):
+        self.drop_replica()
+        primary, replica = connections[routers.PRIMARY], connections[routers.REPLICA]
+        primary.ensure_connection()
+        replica.ensure_connection()
+        # The search tables cannot be dumped, the replica searches with LIKE
+        replica.connection.executescript('\n'.join(statement for statement in primary.connection.iterdump()
+                                                   if '_fts' not in statement))
+
+    def get(self, client, url, data=None):
+        response = client.get(url, data or {})
+        content = ''.join(response.streaming_content) if response.streaming else response.content
+        return response, json.loads(content) if response.status_code == 200 else None
+
+
+class ReplicaRoutingTest(ReplicaTestCase):
+    def setUp(self):
+        super(ReplicaRoutingTest, self).setUp()
+        self.teacher = make_user('teacher')
+        self.student = make_user('student')
+        self.lesson = Lesson.objects.create(teacher=self.teacher, name='Lesson', description='')
+        self.client = make_client('teacher')
+        self.student_client = make_client('student')
+        self.snapshot_replica()
+
+    def search(self, client, phrase):
+        _, body = self.get(client, '/j/lesson_search', {'phrase': phrase})
+        return [lesson['name'] for lesson in body['main']]
+
+    def test_gets_read_replica_until_pinned_by_a_write(self):
+        Lesson.objects.create(teacher=self.teacher, name='Unreplicated', description='')
+        self.assertEqual(self.search(self.client, 'Unreplicated'), [])
+
+        response = self.client.post('/j/process_lessons/', json.dumps({'action': 'create', 'name': 'Posted',
+                                                                        'description': ''}),
+                                    content_type='application/json')
+        self.assertIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+        self.assertEqual(self.search(self.client, 'Unreplicated'), ['Unreplicated'])
+        # Other clients are not pinned
+        self.assertEqual(self.search(self.student_client, 'Unreplicated'), [])
+
+        del self.client.cookies[settings.REPLICA_PIN_COOKIE]
+        self.assertEqual(self.search(self.client, 'Unreplicated'), [])
+
+    def test_pulse_count_is_read_from_primary(self):
+        LessonRequest.objects.create(sender=self.student, receiver=self.teacher, lesson=self.lesson,
+                                     status=REQUEST_JOIN)
+        counters.new_lesson_requests_changed(self.teacher.id)
+        _, body = self.get(self.client, '/j/lesson_search', {'phrase': 'Lesson'})
+        self.assertEqual(body['pulse']['n_new_requests'], 1)
+        with self.assertNumQueries(0, using=routers.PRIMARY):
+            self.assertEqual(counters.new_lesson_requests(self.teacher.id), 1)
+
+    def test_cached_user_is_read_from_primary(self):
+        self.teacher.first_name = 'Renamed'
+        self.teacher.save()
+        self.get(self.client, '/j/lesson_search', {'phrase': 'Lesson'})
+        self.assertEqual(cache.get(usercache._user_key(self.teacher.id)).first_name, 'Renamed')
+
+    def test_roster_cached_after_join_is_read_from_primary(self):
+        LessonReg.objects.create(lesson=self.lesson, student=self.student)
+        viewcache.roster_changed(self.lesson.id)
+        for _ in range(2):
+            response, body = self.get(self.student_client, '/j/process_lesson_regs/', {'lesson_id': self.lesson.id})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([reg['student']['username'] for reg in body['main']], ['student'])
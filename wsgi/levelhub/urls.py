@@ -18,6 +18,8 @@ urlpatterns = patterns('',
     url(r'^j/process_lesson_regs/$', 'views.process_lesson_regs', name='j_process_lesson_regs'),
     url(r'^j/process_lesson_reg_logs/$', 'views.process_lesson_reg_logs', name='j_process_lesson_reg_logs'),
     url(r'^j/process_lesson_messages/$', 'views.process_lesson_messages', name='j_process_lesson_messages'),
+    url(r'^j/sync/$', 'views.process_sync', name='j_sync'),
+    url(r'^j/pulse/$', 'views.process_pulse', name='j_pulse'),
 
     url(r'^j/user_search$', 'views.user_search', name='j_user_search'),
     url(r'^j/lesson_search$', 'views.lesson_search', name='j_lesson_search'),
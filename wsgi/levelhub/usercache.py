@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+
+from levelhub import routers
+
+
+# ############################################################################
+# Authenticated user cache
+#
+# The user of a session is kept in the cache for USER_CACHE_TIMEOUT seconds,
+# so authenticated requests do not fetch it from auth_user every time, see
+# middleware.auth. Saving or deleting a user drops it from the cache.
+#############################################################################
+
+def _user_key(user_id):
+    return 'levelhub:user:%s' % user_id
+
+
+# The user of the request's session, or an AnonymousUser. A user missing from
+# the cache is read from the primary, since a replica may not have the last
+# change that dropped it.
+def get_user(request):
+    try:
+        user_id = request.session[auth.SESSION_KEY]
+        backend_path = request.session[auth.BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+
+    key = _user_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        with routers.primary_reads():
+            user = auth.get_user(request)
+        if user.is_authenticated():
+            cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+    else:
+        user.backend = backend_path
+    return user
+
+
+def user_changed(sender, instance, **kwargs):
+    cache.delete(_user_key(instance.pk))
@@ -1,8 +1,14 @@
 from datetime import datetime
+from importlib import import_module
 import json
+import time
 
+from django.conf import settings
 from django.utils.timezone import utc
 
+from levelhub import metrics
+from levelhub.consts import STREAM_CHUNK_SIZE
+
 def utcnow():
     return datetime.strftime(datetime.utcnow(), "%Y-%m-%d %H:%M:%SZ")
 
@@ -10,13 +16,93 @@ def now():
     return datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
 
 
-class DateEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            if obj.tzinfo == utc:
-                return obj.strftime('%Y-%m-%d %H:%M:%SZ')
-            else:
-                return obj.strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            return json.JSONEncoder.default(self, obj)
+# Format a datetime the way the API returns it: UTC ones end with a Z, naive
+# ones do not. Anything else, e.g. the strings utcnow() assigns before a save or
+# None, is returned unchanged. dictify methods format their datetimes with this
+# so the JSON encoders never have to call back into Python for them.
+def format_datetime(value):
+    if isinstance(value, datetime):
+        s = '%04d-%02d-%02d %02d:%02d:%02d' % (value.year, value.month, value.day,
+                                               value.hour, value.minute, value.second)
+        return s + 'Z' if value.tzinfo == utc else s
+    return value
+
+
+# ############################################################################
+# JSON encoding
+#
+# Responses are encoded by the first module in settings.JSON_BACKENDS that can
+# be imported, so a C accelerated encoder is used when one is installed and
+# the standard library json module otherwise. Values an encoder cannot handle
+# are passed to json_default if the encoder supports it. Encoders without such
+# a hook fail on them instead and the standard library encodes the payload.
+#############################################################################
+
+def json_default(obj):
+    if isinstance(obj, datetime):
+        return format_datetime(obj)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=json_default)
+
+
+# Return the dumps function of the named backend. Raise ImportError if the
+# backend is not installed.
+def load_json_backend(name):
+    if name == 'json':
+        return _stdlib_dumps
+    module = import_module(name)
+    if name == 'ujson':
+        def dumps(obj):
+            try:
+                return module.dumps(obj)
+            except (TypeError, OverflowError):
+                return _stdlib_dumps(obj)
+    else:
+        def dumps(obj):
+            return module.dumps(obj, default=json_default)
+    return dumps
+
+
+# (name, dumps function) of every installed backend in settings.JSON_BACKENDS
+def json_backends():
+    backends = []
+    for name in settings.JSON_BACKENDS:
+        try:
+            backends.append((name, load_json_backend(name)))
+        except ImportError:
+            pass
+    return backends
+
+
+_json_dumps = None
+
+
+def json_dumps(obj):
+    global _json_dumps
+    if _json_dumps is None:
+        backends = json_backends()
+        _json_dumps = backends[0][1] if backends else _stdlib_dumps
+    start = time.time()
+    s = _json_dumps(obj)
+    metrics.serialized(time.time() - start)
+    return s
+
 
+# Encode the items as a JSON array in chunks of chunk_size items, so the items
+# can come from a generator and are never all held in memory at once
+def json_array_chunks(items, chunk_size=STREAM_CHUNK_SIZE):
+    chunk = []
+    separator = '['
+    for item in items:
+        chunk.append(json_dumps(item))
+        if len(chunk) == chunk_size:
+            yield separator + ','.join(chunk)
+            chunk = []
+            separator = ','
+    if chunk:
+        yield separator + ','.join(chunk)
+        separator = ','
+    yield ']' if separator == ',' else '[]'
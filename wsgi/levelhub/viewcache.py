@@ -0,0 +1,123 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# ############################################################################
+# Per-user view cache
+#
+# The encoded main part of some GET responses is cached under a key made of
+# the view, the requesting user, the query string and the generation of the
+# data behind the response. The pulse is never cached. A generation is either
+# a version stamp kept in the database (see levelhub.stamps) or a token kept
+# in the cache that the writes replace, which orphans every entry made for the
+# old token. Writes must invalidate after their transaction has committed, so
+# that no reader can cache data older than the new token.
+#
+# Hits and misses are counted per view in the cache, see the viewcache_stats
+# management command.
+#############################################################################
+
+CACHED_VIEWS = ['lessons', 'lesson_regs', 'lesson_reg_logs']
+
+# Seconds the hit and miss counts are kept
+STATS_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _generation_key(kind, object_id):
+    return 'levelhub:generation:%s:%d' % (kind, object_id)
+
+
+# Current generation of the data of one object, e.g. ('roster', lesson_id).
+# A generation that is missing from the cache starts anew.
+def generation(kind, object_id):
+    key = _generation_key(kind, object_id)
+    token = cache.get(key)
+    if token is None:
+        cache.add(key, uuid.uuid4().hex, settings.VIEW_CACHE_TIMEOUT)
+        token = cache.get(key)
+    return token
+
+
+# {object id: current generation} of the data of several objects of a kind
+def generations(kind, object_ids):
+    keys = dict((_generation_key(kind, object_id), object_id) for object_id in object_ids)
+    tokens = dict((keys[key], token) for key, token in cache.get_many(keys.keys()).items())
+    for object_id in keys.values():
+        if object_id not in tokens:
+            tokens[object_id] = generation(kind, object_id)
+    return tokens
+
+
+def invalidate(kind, object_id):
+    cache.set(_generation_key(kind, object_id), uuid.uuid4().hex, settings.VIEW_CACHE_TIMEOUT)
+
+
+# The registrations of a lesson were added, changed or deactivated
+def roster_changed(lesson_id):
+    invalidate('roster', lesson_id)
+
+
+# The reg logs of a registration changed, which also changes its log counts
+# in the roster
+def reg_logs_changed(lesson_reg):
+    invalidate('reg_logs', lesson_reg.id)
+    invalidate('roster', lesson_reg.lesson_id)
+
+
+def view_key(view, request, generation):
+    return 'levelhub:view:%s:%d:%s' % (view, request.user.id,
+                                       hashlib.md5('%s|%s' % (request.get_full_path(), generation)).hexdigest())
+
+
+def _count(view, outcome):
+    key = 'levelhub:viewcache:%s:%s' % (outcome, view)
+    if not cache.add(key, 1, STATS_TIMEOUT):
+        try:
+            cache.incr(key)
+        except ValueError:
+            pass
+
+
+def get(view, key):
+    value = cache.get(key)
+    _count(view, 'hits' if value is not None else 'misses')
+    return value
+
+
+def store(key, value):
+    cache.set(key, value, settings.VIEW_CACHE_TIMEOUT)
+
+
+# Pass the chunks of a streamed response through and cache them joined once
+# the last one has been sent. Responses larger than VIEW_CACHE_MAX_BYTES are
+# not cached, so streaming them keeps its bounded memory.
+def caching_chunks(key, chunks):
+    sent = []
+    size = 0
+    for chunk in chunks:
+        if sent is not None:
+            size += len(chunk)
+            if size > settings.VIEW_CACHE_MAX_BYTES:
+                sent = None
+            else:
+                sent.append(chunk)
+        yield chunk
+    if sent is not None:
+        store(key, ''.join(sent))
+
+
+# {view: (hits, misses)} of every cached view
+def stats():
+    counts = cache.get_many(['levelhub:viewcache:%s:%s' % (outcome, view)
+                             for view in CACHED_VIEWS for outcome in ('hits', 'misses')])
+    return dict((view, (counts.get('levelhub:viewcache:hits:%s' % view, 0),
+                        counts.get('levelhub:viewcache:misses:%s' % view, 0)))
+                for view in CACHED_VIEWS)
+
+
+def reset_stats():
+    cache.delete_many(['levelhub:viewcache:%s:%s' % (outcome, view)
+                       for view in CACHED_VIEWS for outcome in ('hits', 'misses')])
@@ -1,21 +1,33 @@
-from itertools import chain, groupby
+import calendar
+from collections import defaultdict
+import hashlib
+from itertools import chain
 import json
+import time
 
 import django
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.http import HttpResponseNotFound, HttpResponseForbidden, HttpResponseBadRequest
 from django.shortcuts import render_to_response, render
 from django.template import RequestContext
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import patch_cache_control
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 
+from levelhub import counters, inbox, notify, routers, search, stamps, sync, viewcache
 from levelhub.forms import UserSignupForm, UserForm
 from levelhub.models import UserProfile, Lesson, LessonReg, LessonRegLog, Message, LessonMessage, UserMessage, \
-    LessonRequest
-from levelhub.utils import DateEncoder
+    LessonRequest, ProfileMap
+from levelhub.roles import role_of_lesson, roles_of_lessons
+from levelhub.queries import decode_cursor, query_teach_lessons, query_study_lessons, query_lesson_regs, \
+    query_lesson_reg_logs, query_lesson_messages, query_lesson_requests
+from levelhub.utils import json_array_chunks, json_dumps
 from levelhub.consts import *
 
 
@@ -48,13 +60,98 @@ def add_header(func):
 # information, such as number of new requests. So a notification can be displayed
 # at user side.
 def pack_json_response(request, d, add_pulse=True):
+    return pack_encoded_response(request, json_dumps(d), add_pulse)
+
+
+def pulse_prefix(request):
+    pulse = {'n_new_requests': counters.new_lesson_requests(request.user.id)}
+    return '{"pulse": %s, "main": ' % json_dumps(pulse)
+
+
+# Same as pack_json_response for a main part that is already encoded
+def pack_encoded_response(request, main, add_pulse=True):
+    if add_pulse:
+        main = pulse_prefix(request) + main + '}'
+    return HttpResponse(main, content_type='application/json')
+
+
+# Same as pack_json_response for a list of items, e.g. a generator over a
+# queryset iterator, that is encoded and sent in chunks while it is iterated.
+# The pulse is computed and sent first. If cache_key is given the encoded list
+# is also stored in the view cache once it has been sent.
+def stream_json_response(request, items, add_pulse=True, cache_key=None):
+    chunks = json_array_chunks(items)
+    if cache_key is not None:
+        chunks = viewcache.caching_chunks(cache_key, chunks)
     if add_pulse:
-        j = json.dumps({'pulse': {'n_new_requests': peek_lesson_requests(request.user)},
-                        'main': d},
-                       cls=DateEncoder)
+        chunks = chain([pulse_prefix(request)], chunks, ['}'])
+    return StreamingHttpResponse(chunks, content_type='application/json')
+
+
+# Serve the main part of a GET response from the per-user view cache, or make
+# it with make_main and cache it. generation identifies the version of the
+# data behind the response, None bypasses the cache. With stream the main
+# part must be a list and is streamed on a miss.
+def cached_json_response(request, view, generation, make_main, stream=False):
+    if generation is None:
+        main = make_main()
+        return stream_json_response(request, main) if stream else pack_json_response(request, main)
+
+    key = viewcache.view_key(view, request, generation)
+    main = viewcache.get(view, key)
+    if main is not None:
+        return pack_encoded_response(request, main)
+    # The response is cached under the generation, so it must not be read from
+    # a replica that has not caught up with the change that started it
+    routers.pin_primary()
+    if stream:
+        return stream_json_response(request, make_main(), cache_key=key)
+    main = json_dumps(make_main())
+    viewcache.store(key, main)
+    return pack_encoded_response(request, main)
+
+
+# Answer a conditional GET with 304 if nothing behind the response changed
+# since the client got it, otherwise return the response of make_response.
+# stamp is the time of the last change as returned by stamps.last_modified,
+# None disables the check. The ETag also covers the query string, so each
+# page or category is validated on its own. A view whose response moves its
+# own stamp passes stamped, make_response then returns the response together
+# with the stamp it was made at.
+def conditional_response(request, stamp, make_response, stamped=False):
+    if stamp is None:
+        return make_response()[0] if stamped else make_response()
+
+    etag, last_modified = validators(request, stamp)
+    if 'HTTP_IF_NONE_MATCH' in request.META:
+        not_modified = etag in parse_etags(request.META['HTTP_IF_NONE_MATCH'])
     else:
-        j = json.dumps(d)
-    return HttpResponse(j, content_type='application/json')
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+        not_modified = if_modified_since is not None and last_modified <= if_modified_since
+
+    if not_modified:
+        response = HttpResponseNotModified()
+    elif stamped:
+        response, stamp = make_response()
+        if stamp is None:
+            return response
+        etag, last_modified = validators(request, stamp)
+    else:
+        response = make_response()
+    if response.status_code in (200, 304):
+        response['ETag'] = quote_etag(etag)
+        # Last-Modified has a resolution of one second. A change later in the
+        # same second would not move it, so it is only sent for earlier stamps.
+        if last_modified < int(time.time()):
+            response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+# ETag and Last-Modified of the response at the stamp
+def validators(request, stamp):
+    etag = hashlib.md5('%d|%s|%s' % (request.user.id, request.get_full_path(), stamp.isoformat())).hexdigest()
+    return etag, calendar.timegm(stamp.utctimetuple())
 
 
 def user_get(user_id):
@@ -73,19 +170,11 @@ def lesson_get(lesson_id):
 
 def lesson_reg_get(**kwargs):
     try:
-        return LessonReg.objects.get(status=LESSON_REG_ACTIVE, **kwargs)
+        return LessonReg.objects.select_related('lesson').get(status=LESSON_REG_ACTIVE, **kwargs)
     except LessonReg.DoesNotExist:
         return None
 
 
-def lesson_reg_log_get(**kwargs):
-    try:
-        a = LessonRegLog.objects.get(**kwargs)
-        return a
-    except LessonRegLog.DoesNotExist:
-        return None
-
-
 def lesson_request_get(**kwargs):
     try:
         return LessonRequest.objects.get(**kwargs)
@@ -100,59 +189,21 @@ def message_get(message_id):
         return None
 
 
-def role_of_lesson(user, lesson):
-    if user.username in [lesson.teacher.username, 'admin']:
-        return ROLE_LESSON_MANAGER
-    elif lesson_reg_get(lesson=lesson, student=user):
-        return ROLE_LESSON_STUDENT
-    else:
-        return ROLE_LESSON_NONE
-
+# The identity map of the user profiles serialized for the request
+def request_profiles(request):
+    if not hasattr(request, 'profiles'):
+        request.profiles = ProfileMap()
+    return request.profiles
 
-# Peek the lesson requests without changing their status
-def peek_lesson_requests(user):
-    # As receiver
-    incoming_requests = LessonRequest.objects.filter(
-        receiver=user, is_new=True, status__in=REQUEST_RECEIVER_NOTICE)
-    # As sender
-    outgoing_requests = LessonRequest.objects.filter(
-        sender=user, is_new=True, status__in=REQUEST_SENDER_NOTICE)
-
-    return incoming_requests.count() + outgoing_requests.count()
-
-
-# Get the lessons an user teaches. Anyone can view an user's teaches
-def query_teach_lessons(user):
-    lessons = Lesson.objects.filter(teacher=user, status=LESSON_ACTIVE)
-    response = []
-    for lesson in lessons:
-        nregs = LessonReg.objects.filter(lesson=lesson, status=LESSON_REG_ACTIVE).count()
-        response.append(lesson.dictify({'nregs': nregs}))
-    return response
 
-
-# study lesson is different than teach lesson in that it contains a
-# sub-element pointing to the registration
-# Can only view one's own studies
-def query_study_lessons(user):
-    lesson_regs = LessonReg.objects.filter(student=user, status=LESSON_REG_ACTIVE)
-    response = []
-    for lesson_reg in lesson_regs:
-        lesson = lesson_reg.lesson
-        nregs = LessonReg.objects.filter(lesson=lesson, status=LESSON_REG_ACTIVE).count()
-        d = lesson.dictify({'nregs': nregs})
-        lesson_reg_logs = LessonRegLog.objects.filter(lesson_reg=lesson_reg)
-        d['registration'] = {
-            'reg_id': lesson_reg.id,
-            'status': lesson_reg.status,
-            'creation_time': lesson_reg.creation_time,
-            'daytimes': lesson_reg.daytimes,
-            'data': lesson_reg.data,
-            'total': lesson_reg_logs.count(),
-            'unused': lesson_reg_logs.filter(use_time=None).count(),
-        }
-        response.append(d)
-    return response
+# Parse the page size requested by a client. Return None if it is not a
+# number between 1 and MAX_PAGE_SIZE.
+def page_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return None
+    return size if 0 < size <= MAX_PAGE_SIZE else None
 
 
 #############################################################################
@@ -236,33 +287,34 @@ def user_logout(request):
         return HttpResponseRedirect('/')
 
 
+# Parse the offset and limit of a search request. Return None if invalid.
+def search_page(request):
+    limit = page_size(request.GET.get('limit', SEARCH_PAGE_SIZE))
+    try:
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        return None
+    if not limit or offset < 0:
+        return None
+    return offset, limit
+
+
 @login_required
 def user_search(request):
-    phrase = request.GET['phrase']
-    users = User.objects.filter(Q(username__contains=phrase)
-                                | Q(first_name__contains=phrase)
-                                | Q(last_name__contains=phrase)
-                                & ~Q(username='admin')
-                                & ~Q(username=request.user.username))
-    response = []
-    for user in users:
-        response.append(user.get_profile().dictify())
-
-    return pack_json_response(request, response)
+    page = search_page(request)
+    if not page:
+        return HttpResponseBadRequest('Invalid offset or limit')
+    return pack_json_response(request, search.search_users(request.GET['phrase'], request.user, *page,
+                                                                 profiles=request_profiles(request)))
 
 
 @login_required
 def lesson_search(request):
-    phrase = request.GET['phrase']
-    lessons = Lesson.objects.filter(Q(name__contains=phrase)
-                                    | Q(description__contains=phrase)
-                                    & Q(status=LESSON_ACTIVE))
-    response = []
-    for lesson in lessons:
-        nregs = LessonReg.objects.filter(lesson=lesson, status=LESSON_REG_ACTIVE).count()
-        response.append(lesson.dictify({'nregs': nregs}))
-
-    return pack_json_response(request, response)
+    page = search_page(request)
+    if not page:
+        return HttpResponseBadRequest('Invalid offset or limit')
+    return pack_json_response(request, search.search_lessons(request.GET['phrase'], *page,
+                                                                   profiles=request_profiles(request)))
 
 
 # POST to create, update or delete a lesson
@@ -277,7 +329,9 @@ def process_lessons(request):
         action = data['action']
 
         if 'create' == action:
-            Lesson(teacher=user, name=data['name'], description=data['description']).save()
+            with transaction.atomic():
+                Lesson(teacher=user, name=data['name'], description=data['description']).save()
+                stamps.touch([user.id], stamps.LESSONS)
 
         elif 'update' == action:
             lesson = lesson_get(data['lesson_id'])
@@ -288,7 +342,9 @@ def process_lessons(request):
                 return HttpResponseForbidden('No permission to update lesson')
             lesson.name = data['name']
             lesson.description = data['description']
-            lesson.save()
+            with transaction.atomic():
+                lesson.save()
+                stamps.lesson_changed(lesson.id)
 
         elif 'delete' == action:
             lesson = lesson_get(data['lesson_id'])
@@ -297,20 +353,31 @@ def process_lessons(request):
             role = role_of_lesson(user, lesson)
             if role != ROLE_LESSON_MANAGER:
                 return HttpResponseForbidden('No permission to update lesson')
-            lesson.delete()
+            with transaction.atomic():
+                stamps.lesson_changed(lesson.id)
+                sync.lesson_deleted(lesson)
+                inbox.lesson_left(lesson.id)
+                # The requests of the lesson are deleted with it
+                parties = set(chain.from_iterable(LessonRequest.objects.filter(lesson=lesson)
+                                                  .values_list('sender', 'receiver')))
+                lesson.delete()
+            counters.new_lesson_requests_changed(*parties)
 
         else:
             return HttpResponseBadRequest('Invalid action')
 
-        return HttpResponse(json.dumps({}),
-                            content_type='application/json')
+        return pack_json_response(request, {}, add_pulse=False)
 
     else:  # get teach and study lessons for the requesting user
         lesson_category = request.GET['category']
 
+        # The version stamp of the lists is also their view cache generation
         if lesson_category == 'all':
-            return pack_json_response(request, {'teach': query_teach_lessons(user),
-                                                'study': query_study_lessons(user)})
+            profiles = request_profiles(request)
+            stamp = stamps.last_modified((user.id, stamps.LESSONS), (user.id, stamps.REQUESTS))
+            return conditional_response(request, stamp, lambda: cached_json_response(
+                request, 'lessons', stamp, lambda: {'teach': query_teach_lessons(user, profiles),
+                                                    'study': query_study_lessons(user, profiles)}))
 
         elif lesson_category == 'teach':
             # If a user_id is specified, use the user_id, otherwise use
@@ -319,10 +386,14 @@ def process_lessons(request):
                 user = user_get(request.GET['user_id'])
                 if not user:
                     return HttpResponseNotFound('User does not exist')
-            return pack_json_response(request, query_teach_lessons(user))
+            stamp = stamps.last_modified((user.id, stamps.LESSONS), (request.user.id, stamps.REQUESTS))
+            return conditional_response(request, stamp, lambda: cached_json_response(
+                request, 'lessons', stamp, lambda: query_teach_lessons(user, request_profiles(request))))
 
         elif lesson_category == 'study':
-            return pack_json_response(request, query_study_lessons(request.user))
+            stamp = stamps.last_modified((user.id, stamps.LESSONS), (user.id, stamps.REQUESTS))
+            return conditional_response(request, stamp, lambda: cached_json_response(
+                request, 'lessons', stamp, lambda: query_study_lessons(user, request_profiles(request))))
 
         else:
             return HttpResponseBadRequest('Invalid lesson category')
@@ -366,12 +437,18 @@ def process_lesson_requests(request):
                               daytimes=data['daytimes'],
                               status=REQUEST_ENROLL,
                               is_new=True).save()
+                stamps.requests_changed(user.id, student.id)
+                counters.new_lesson_requests_changed(student.id)
 
             else:  # non-member enroll
-                LessonReg(lesson=lesson,
-                          student_first_name=data['first_name'],
-                          student_last_name=data['last_name'],
-                          daytimes=data['daytimes']).save()
+                with transaction.atomic():
+                    LessonReg(lesson=lesson,
+                              student_first_name=data['first_name'],
+                              student_last_name=data['last_name'],
+                              daytimes=data['daytimes']).save()
+                    counters.lesson_reg_activated(lesson.id)
+                    stamps.roster_changed(lesson.id)
+                viewcache.roster_changed(lesson.id)
 
         elif 'join' == action:
 
@@ -396,6 +473,8 @@ def process_lesson_requests(request):
                           message=data['message'],
                           status=REQUEST_JOIN,
                           is_new=True).save()
+            stamps.requests_changed(user.id, teacher.id)
+            counters.new_lesson_requests_changed(teacher.id)
 
         elif 'deroll' == action:
 
@@ -406,16 +485,27 @@ def process_lesson_requests(request):
             if role_of_lesson(user, lesson_reg.lesson) != ROLE_LESSON_MANAGER:
                 return HttpResponseForbidden('No permission to disenroll student')
 
-            if lesson_reg.student:  # Create notice for members
-                LessonRequest(sender=user,
-                              receiver=lesson_reg.student,
-                              lesson=lesson_reg.lesson,
-                              status=REQUEST_DEROLL,
-                              is_new=True).save()
-            # This request is a notice only, i.e. the receiver only gets to dismiss the
-            # message without the options for accept or reject
-            lesson_reg.status = LESSON_REG_DEROLL
-            lesson_reg.save()
+            with transaction.atomic():
+                # Only the first of concurrent derolls and quits deactivates the registration
+                if not LessonReg.objects.filter(id=lesson_reg.id, status=LESSON_REG_ACTIVE) \
+                        .update(status=LESSON_REG_DEROLL, update_time=timezone.now()):
+                    return HttpResponseNotFound('Lesson registration does not exist')
+                if lesson_reg.student:  # Create notice for members
+                    LessonRequest(sender=user,
+                                  receiver=lesson_reg.student,
+                                  lesson=lesson_reg.lesson,
+                                  status=REQUEST_DEROLL,
+                                  is_new=True).save()
+                # This request is a notice only, i.e. the receiver only gets to dismiss the
+                # message without the options for accept or reject
+                counters.lesson_reg_deactivated(lesson_reg.lesson_id)
+                if lesson_reg.student_id:
+                    inbox.lesson_left(lesson_reg.lesson_id, lesson_reg.student_id)
+                stamps.roster_changed(lesson_reg.lesson_id, lesson_reg.student_id)
+                stamps.requests_changed(user.id, lesson_reg.student_id)
+            viewcache.roster_changed(lesson_reg.lesson_id)
+            if lesson_reg.student_id:
+                counters.new_lesson_requests_changed(lesson_reg.student_id)
 
         elif 'quit' == action:
 
@@ -428,14 +518,22 @@ def process_lesson_requests(request):
 
             teacher = lesson_reg.lesson.teacher
 
-            LessonRequest(sender=user,
-                          receiver=teacher,
-                          lesson=lesson_reg.lesson,
-                          status=REQUEST_QUIT,
-                          is_new=True).save()
-            # This is also a notice only
-            lesson_reg.status = LESSON_REG_QUIT
-            lesson_reg.save()
+            with transaction.atomic():
+                if not LessonReg.objects.filter(id=lesson_reg.id, status=LESSON_REG_ACTIVE) \
+                        .update(status=LESSON_REG_QUIT, update_time=timezone.now()):
+                    return HttpResponseNotFound('Lesson registration does not exist')
+                # This is also a notice only
+                LessonRequest(sender=user,
+                              receiver=teacher,
+                              lesson=lesson_reg.lesson,
+                              status=REQUEST_QUIT,
+                              is_new=True).save()
+                counters.lesson_reg_deactivated(lesson_reg.lesson_id)
+                inbox.lesson_left(lesson_reg.lesson_id, user.id)
+                stamps.roster_changed(lesson_reg.lesson_id, user.id)
+                stamps.requests_changed(user.id, teacher.id)
+            viewcache.roster_changed(lesson_reg.lesson_id)
+            counters.new_lesson_requests_changed(teacher.id)
 
         elif 'accept' == action or 'reject' == action:
 
@@ -449,26 +547,38 @@ def process_lesson_requests(request):
             if lesson_request.status not in REQUEST_ACCEPT_OR_REJECT:
                 return HttpResponseBadRequest('The request can only be dismissed')
 
-            if lesson_request.status == REQUEST_ENROLL:
-                if action == 'accept':
-                    lesson_request.status = REQUEST_ENROLL_ACCEPTED
-                    LessonReg(lesson=lesson_request.lesson,
-                              student=lesson_request.receiver,
-                              daytimes=lesson_request.daytimes).save()
+            with transaction.atomic():
+                if lesson_request.status == REQUEST_ENROLL:
+                    if action == 'accept':
+                        lesson_request.status = REQUEST_ENROLL_ACCEPTED
+                        LessonReg(lesson=lesson_request.lesson,
+                                  student=lesson_request.receiver,
+                                  daytimes=lesson_request.daytimes).save()
+                        counters.lesson_reg_activated(lesson_request.lesson_id)
+                        inbox.lesson_joined(lesson_request.lesson_id, lesson_request.receiver_id)
+                        stamps.roster_changed(lesson_request.lesson_id, lesson_request.receiver_id)
+                    else:
+                        lesson_request.status = REQUEST_ENROLL_REJECTED
+                elif lesson_request.status == REQUEST_JOIN:
+                    if action == 'accept':
+                        lesson_request.status = REQUEST_JOIN_ACCEPTED
+                        LessonReg(lesson=lesson_request.lesson,
+                                  student=lesson_request.sender).save()
+                        counters.lesson_reg_activated(lesson_request.lesson_id)
+                        inbox.lesson_joined(lesson_request.lesson_id, lesson_request.sender_id)
+                        stamps.roster_changed(lesson_request.lesson_id, lesson_request.sender_id)
+                    else:
+                        lesson_request.status = REQUEST_JOIN_REJECTED
                 else:
-                    lesson_request.status = REQUEST_ENROLL_REJECTED
-            elif lesson_request.status == REQUEST_JOIN:
-                if action == 'accept':
-                    lesson_request.status = REQUEST_JOIN_ACCEPTED
-                    LessonReg(lesson=lesson_request.lesson,
-                              student=lesson_request.sender).save()
-                else:
-                    lesson_request.status = REQUEST_JOIN_REJECTED
-            else:
-                return HttpResponseBadRequest('Invalid request status')
+                    return HttpResponseBadRequest('Invalid request status')
 
-            lesson_request.is_new = True
-            lesson_request.save()
+                lesson_request.is_new = True
+                lesson_request.save()
+                stamps.requests_changed(lesson_request.sender_id, lesson_request.receiver_id)
+            if action == 'accept':
+                viewcache.roster_changed(lesson_request.lesson_id)
+            # The request turns from a notice to the receiver into one to the sender
+            counters.new_lesson_requests_changed(lesson_request.sender_id, lesson_request.receiver_id)
 
         elif 'dismiss' == action:
 
@@ -480,7 +590,12 @@ def process_lesson_requests(request):
                 and user.username == lesson_request.sender.username) \
                     or (lesson_request.status in REQUEST_RECEIVER_DISMISS
                         and user.username == lesson_request.receiver.username):
-                lesson_request.delete()
+                with transaction.atomic():
+                    sync.bury(SYNC_REQUEST, [lesson_request.id], [lesson_request.sender_id, lesson_request.receiver_id])
+                    lesson_request.delete()
+                    stamps.requests_changed(lesson_request.sender_id, lesson_request.receiver_id)
+                if lesson_request.is_new:
+                    counters.new_lesson_requests_changed(user.id)
             else:
                 return HttpResponseForbidden('No permission to dismiss the request')
 
@@ -490,14 +605,41 @@ def process_lesson_requests(request):
         return pack_json_response(request, {})
 
     else:  # method is GET
-        # As receiver
-        all_requests = LessonRequest.objects.filter(
-            (Q(receiver=user) & Q(status__in=REQUEST_RECEIVER_VIEWABLE))
-            | (Q(sender=user) & Q(status__in=REQUEST_SENDER_VIEWABLE))).order_by("-id")
-        # Mark requests as read exclude those sent by the user as requests to enroll or join
-        all_requests.filter(is_new=True).exclude(sender=user, status__in=[REQUEST_ENROLL, REQUEST_JOIN]).update(is_new=False)
-        response = [req.dictify() for req in all_requests]
-        return pack_json_response(request, response)
+        limit = page_size(request.GET.get('limit', REQUEST_PAGE_SIZE))
+        if not limit:
+            return HttpResponseBadRequest('Invalid page size')
+
+        before = None
+        if request.GET.get('before'):
+            try:
+                before = int(request.GET['before'])
+            except ValueError:
+                return HttpResponseBadRequest('Invalid cursor')
+
+        return conditional_response(request, stamps.last_modified((user.id, stamps.REQUESTS)),
+                                    lambda: read_lesson_requests(request, before, limit), stamped=True)
+
+
+# Get the page of requests right before the before id, newest first, and mark
+# them as read. Returns the response with the requests stamp after the marking,
+# which is what the client's next poll is compared with.
+def read_lesson_requests(request, before, limit):
+    user = request.user
+    # Mark requests of the page as read exclude those sent by the user as requests to enroll or join
+    with transaction.atomic():
+        # The profile row is locked first so no other change to the user's
+        # requests can come between the page and the stamp
+        list(UserProfile.objects.select_for_update().filter(user=user).values_list('id'))
+        response = query_lesson_requests(user, before, limit, request_profiles(request))
+        n_read = LessonRequest.objects.filter(id__in=[d['req_id'] for d in response], is_new=True) \
+            .exclude(sender=user, status__in=[REQUEST_ENROLL, REQUEST_JOIN]).update(is_new=False)
+        if n_read:
+            # The pulse goes down
+            stamps.requests_changed(user.id)
+        stamp = stamps.last_modified((user.id, stamps.REQUESTS))
+    if n_read:
+        counters.new_lesson_requests_changed(user.id)
+    return pack_json_response(request, response), stamp
 
 
 # Get all registration of a lesson or update one lesson registration
@@ -521,7 +663,10 @@ def process_lesson_regs(request):
         lesson_reg.daytimes = data['daytimes']
         if 'data' in data:
             lesson_reg.data = data['data']
-        lesson_reg.save()
+        with transaction.atomic():
+            lesson_reg.save()
+            stamps.lesson_regs_changed([lesson_reg])
+        viewcache.roster_changed(lesson_reg.lesson_id)
         return pack_json_response(request, {})
 
     else:  # method is GET
@@ -533,74 +678,157 @@ def process_lesson_regs(request):
         if role == ROLE_LESSON_NONE:
             return HttpResponseForbidden('No permission view registrations of the lesson')
 
-        response = []
-        for lesson_reg in LessonReg.objects.filter(lesson=lesson, status=LESSON_REG_ACTIVE):
-            # Lesson registrations can be viewed by student with less information
-            info_for_manager = None
-            if role == ROLE_LESSON_MANAGER:
-                lesson_reg_logs = LessonRegLog.objects.filter(lesson_reg=lesson_reg)
-                total = lesson_reg_logs.count()
-                unused = lesson_reg_logs.filter(use_time=None).count()
-                info_for_manager = {'total': total, 'unused': unused}
-            response.append(lesson_reg.dictify(info_for_manager))
-
-        # sort student alphabetically
-        response.sort(key=lambda x: x['student']['display_name'].lower() if x['student'] else ' '.join(
-            [x['student_first_name'], x['student_last_name']]).lower())
-
-        return pack_json_response(request, response)
+        # Large rosters can be fetched page by page
+        if 'limit' in request.GET:
+            limit = page_size(request.GET['limit'])
+            if not limit:
+                return HttpResponseBadRequest('Invalid page size')
+            after = None
+            if request.GET.get('cursor'):
+                try:
+                    sort_name, reg_id = decode_cursor(request.GET['cursor'])
+                except (TypeError, ValueError):
+                    return HttpResponseBadRequest('Invalid cursor')
+                after = (sort_name, reg_id)
+
+            def make_page():
+                response, next_cursor = query_lesson_regs(lesson, role, after, limit, request_profiles(request))
+                return {'regs': response, 'next_cursor': next_cursor}
+            return cached_json_response(request, 'lesson_regs', viewcache.generation('roster', lesson.id), make_page)
+
+        return cached_json_response(request, 'lesson_regs', viewcache.generation('roster', lesson.id),
+                                    lambda: query_lesson_regs(lesson, role, profiles=request_profiles(request)),
+                                    stream=True)
+
+
+# HTTP status of each per item result of a reg log batch
+REG_LOG_RESULT_STATUS = {'ok': 200, 'not_found': 404, 'forbidden': 403, 'invalid_action': 400}
+
+
+# Apply a batch of reg log actions as a whole. All referenced registrations
+# and logs are fetched and authorized up front, then the creates, updates and
+# deletes are applied in bulk in one transaction. Logs are only created for
+# active registrations. If any action fails nothing is written and the valid
+# actions are reported as not applied. Return the HTTP status, i.e. the one of
+# the first failing action or 200, and a result for each action in order.
+def apply_reg_log_actions(user, actions):
+    lesson_reg_logs = LessonRegLog.objects.in_bulk(
+        [action['rlog_id'] for action in actions if action['action'] in ('update', 'delete')])
+    reg_ids = set(action['reg_id'] for action in actions if action['action'] == 'create')
+    reg_ids.update(lesson_reg_log.lesson_reg_id for lesson_reg_log in lesson_reg_logs.values())
+    lesson_regs = LessonReg.objects.select_related('lesson').in_bulk(reg_ids)
+    is_admin = user.username == 'admin'
+
+    def managed(lesson_reg_id):
+        return is_admin or lesson_regs[lesson_reg_id].lesson.teacher_id == user.id
+
+    # Replay the actions on the state of the logs they touch, so that a log
+    # updated or deleted more than once ends up as the last action left it
+    results = []
+    creates = []
+    logs = dict((rlog_id, {'use_time': log.use_time, 'data': log.data, 'deleted': False})
+                for rlog_id, log in lesson_reg_logs.items())
+    for action in actions:
+        if action['action'] == 'create':
+            result = {'action': 'create', 'reg_id': action['reg_id']}
+            if action['reg_id'] not in lesson_regs or lesson_regs[action['reg_id']].status != LESSON_REG_ACTIVE:
+                result['result'] = 'not_found'
+            elif not managed(action['reg_id']):
+                result['result'] = 'forbidden'
+            else:
+                result['result'] = 'ok'
+                creates.append(LessonRegLog(lesson_reg_id=action['reg_id'],
+                                            use_time=action['use_time'],
+                                            data=action['data']))
+        elif action['action'] in ('update', 'delete'):
+            result = {'action': action['action'], 'rlog_id': action['rlog_id']}
+            log = logs.get(action['rlog_id'])
+            if log is None or log['deleted']:
+                result['result'] = 'not_found'
+            elif not managed(lesson_reg_logs[action['rlog_id']].lesson_reg_id):
+                result['result'] = 'forbidden'
+            else:
+                result['result'] = 'ok'
+                if action['action'] == 'update':
+                    log.update(use_time=action['use_time'], data=action['data'], updated=True)
+                else:
+                    log['deleted'] = True
+        else:
+            result = {'action': action['action'], 'result': 'invalid_action'}
+        results.append(result)
+
+    failed = [result['result'] for result in results if result['result'] != 'ok']
+    if failed:
+        for result in results:
+            if result['result'] == 'ok':
+                result['result'] = 'not_applied'
+        return REG_LOG_RESULT_STATUS[failed[0]], results
+
+    # (change of total_logs, change of unused_logs) of each registration
+    changes = defaultdict(lambda: (0, 0))
+
+    def change(lesson_reg_id, total, unused):
+        changes[lesson_reg_id] = (changes[lesson_reg_id][0] + total, changes[lesson_reg_id][1] + unused)
+
+    for lesson_reg_log in creates:
+        change(lesson_reg_log.lesson_reg_id, 1, 1 if lesson_reg_log.use_time is None else 0)
+    deleted_ids = []
+    ids_by_update = defaultdict(list)
+    for rlog_id, log in logs.items():
+        old = lesson_reg_logs[rlog_id]
+        if log['deleted']:
+            deleted_ids.append(rlog_id)
+            change(old.lesson_reg_id, -1, -1 if old.use_time is None else 0)
+        elif log.get('updated'):
+            # Logs set to the same values are updated together. data can be
+            # any JSON value, so it is grouped by its encoding.
+            ids_by_update[(log['use_time'], json.dumps(log['data'], sort_keys=True))].append(rlog_id)
+            change(old.lesson_reg_id, 0, (log['use_time'] is None) - (old.use_time is None))
+
+    with transaction.atomic():
+        LessonRegLog.objects.bulk_create(creates)
+        for (use_time, data), rlog_ids in ids_by_update.items():
+            LessonRegLog.objects.filter(id__in=rlog_ids).update(use_time=use_time, data=json.loads(data),
+                                                                update_time=timezone.now())
+        LessonRegLog.objects.filter(id__in=deleted_ids).delete()
+        deleted_ids_by_reg = defaultdict(list)
+        for rlog_id in deleted_ids:
+            deleted_ids_by_reg[lesson_reg_logs[rlog_id].lesson_reg_id].append(rlog_id)
+        for reg_id, rlog_ids in deleted_ids_by_reg.items():
+            lesson_reg = lesson_regs[reg_id]
+            sync.bury(SYNC_REG_LOG, rlog_ids, [user_id for user_id in (lesson_reg.lesson.teacher_id,
+                                                                        lesson_reg.student_id) if user_id])
+        counters.reg_log_counts_changed(changes)
+        stamps.lesson_regs_changed([lesson_regs[reg_id] for reg_id in changes])
+    for reg_id in changes:
+        viewcache.reg_logs_changed(lesson_regs[reg_id])
+    return 200, results
 
 
 # GET all reg logs for the given registration
-# POST to create, update and delete reg logs for registration
+# POST a batch of actions to create, update and delete reg logs of registrations
 @login_required
 @csrf_exempt
 def process_lesson_reg_logs(request):
     user = request.user
 
     if request.method == 'POST':
-        data = json.loads(request.body)
-        for log in data:
-            if log['action'] == 'create':
-                lesson_reg = lesson_reg_get(id=log['reg_id'])
-                if not lesson_reg:
-                    return HttpResponseNotFound('Lesson registration does not exist')
-                if role_of_lesson(user, lesson_reg.lesson) != ROLE_LESSON_MANAGER:
-                    return HttpResponseForbidden('No permission to create lesson registration log')
-                LessonRegLog(lesson_reg=lesson_reg,
-                             use_time=log['use_time'],
-                             data=log['data']).save()
-            elif log['action'] == 'update':
-                lesson_reg_log = lesson_reg_log_get(id=log['rlog_id'])
-                if not lesson_reg_log:
-                    return HttpResponseNotFound('Lesson registration log does not exist')
-                if role_of_lesson(user, lesson_reg_log.lesson_reg.lesson) != ROLE_LESSON_MANAGER:
-                    return HttpResponseForbidden('No permission to update lesson registration log')
-                lesson_reg_log.use_time = log['use_time']
-                lesson_reg_log.data = log['data']
-                lesson_reg_log.save()
-            elif log['action'] == 'delete':
-                lesson_reg_log = lesson_reg_log_get(id=log['rlog_id'])
-                if not lesson_reg_log:
-                    return HttpResponseNotFound('Lesson registration log does not exist')
-                if role_of_lesson(user, lesson_reg_log.lesson_reg.lesson) != ROLE_LESSON_MANAGER:
-                    return HttpResponseForbidden('No permission to update lesson registration log')
-                lesson_reg_log.delete()
-            else:
-                return HttpResponseBadRequest('Invalid action')
-
-        return pack_json_response(request, {})
+        actions = json.loads(request.body)
+        if len(actions) > MAX_REG_LOG_BATCH:
+            return HttpResponseBadRequest('Too many actions in the batch')
+        status, results = apply_reg_log_actions(user, actions)
+        response = pack_json_response(request, results)
+        response.status_code = status
+        return response
 
     else:  # method is GET
         lesson_reg = lesson_reg_get(id=request.GET['reg_id'])
         if not lesson_reg:
             return HttpResponseNotFound('Lesson registration does not exist')
 
-        if role_of_lesson(user, lesson_reg.lesson) == ROLE_LESSON_MANAGER \
-                or (lesson_reg.student and user.username == lesson_reg.student.username):
-            response = [lesson_reg_log.dictify() for lesson_reg_log
-                        in LessonRegLog.objects.filter(lesson_reg=lesson_reg).order_by('id')]
-            return pack_json_response(request, response)
+        if lesson_reg.student_id == user.id or role_of_lesson(user, lesson_reg.lesson) == ROLE_LESSON_MANAGER:
+            return cached_json_response(request, 'lesson_reg_logs', viewcache.generation('reg_logs', lesson_reg.id),
+                                        lambda: query_lesson_reg_logs(lesson_reg), stream=True)
         else:
             return HttpResponseForbidden('No permission to view lesson registration logs')
 
@@ -616,22 +844,22 @@ def process_lesson_messages(request):
 
         if 'create' == action:
 
-            lessons = []
-            for lesson_id in data['lesson_ids']:
-                lesson = lesson_get(lesson_id)
-                if not lesson:
-                    return HttpResponseNotFound('Lesson does not exist')
-
-                role = role_of_lesson(user, lesson)
-                if role == ROLE_LESSON_NONE:
-                    return HttpResponseForbidden('No permission to post message')
-
-                lessons.append(lesson)
-
-            message = Message(sender=user, body=data['body'])
-            message.save()
-            LessonMessage.objects.bulk_create([LessonMessage(lesson=lesson, message=message)
-                                               for lesson in lessons])
+            lessons = Lesson.objects.filter(status=LESSON_ACTIVE).in_bulk(data['lesson_ids'])
+            if len(lessons) < len(set(data['lesson_ids'])):
+                return HttpResponseNotFound('Lesson does not exist')
+            roles = roles_of_lessons(user, lessons.values())
+            if ROLE_LESSON_NONE in roles.values():
+                return HttpResponseForbidden('No permission to post message')
+            lessons = lessons.values()
+
+            with transaction.atomic():
+                message = Message(sender=user, body=data['body'])
+                message.save()
+                LessonMessage.objects.bulk_create([LessonMessage(lesson=lesson, message=message)
+                                                   for lesson in lessons])
+                if inbox.fanout_on_write():
+                    inbox.fan_out(message, lessons)
+                stamps.messages_changed([lesson.id for lesson in lessons])
 
         elif 'delete' == action:
             message = message_get(data['message_id'])
@@ -639,7 +867,11 @@ def process_lesson_messages(request):
                 return HttpResponseNotFound('Message does not exist')
             if user.username not in [message.sender.username, 'admin']:
                 return HttpResponseForbidden('No permission to delete message')
-            message.delete()  # Any entries in LessonMessages are deleted as well by cascade
+            with transaction.atomic():
+                stamps.messages_changed(list(LessonMessage.objects.filter(message=message)
+                                             .values_list('lesson', flat=True)))
+                sync.message_deleted(message)
+                message.delete()  # Any entries in LessonMessages are deleted as well by cascade
 
         else:
             return HttpResponseBadRequest('Invalid action')
@@ -647,31 +879,64 @@ def process_lesson_messages(request):
         return pack_json_response(request, {})
 
     else:  # method is GET
-        msg_id = request.GET['msg_id']
-        action = request.GET['action']
+        limit = page_size(request.GET.get('limit', MESSAGE_PAGE_SIZE))
+        if not limit:
+            return HttpResponseBadRequest('Invalid page size')
 
-        teach_lessons = [lesson for lesson in Lesson.objects.filter(teacher=user, status=LESSON_ACTIVE)]
-        study_lessons = [lesson_reg.lesson for lesson_reg in
-                         LessonReg.objects.filter(student=user, status=LESSON_REG_ACTIVE)]
+        # Get the page of messages right after or before msg_id
+        return conditional_response(
+            request, stamps.last_modified((user.id, stamps.MESSAGES), (user.id, stamps.REQUESTS)),
+            lambda: pack_json_response(request, query_lesson_messages(
+                user, request.GET['msg_id'], request.GET['action'] == 'newer', limit,
+                inbox=inbox.fanout_on_write(), profiles=request_profiles(request))))
 
-        # Get all newer messages or 15 older messages
-        if action == 'newer':
-            lesson_messages = LessonMessage.objects.filter(message__gt=msg_id,
-                lesson__in=[lesson for lesson in chain(teach_lessons, study_lessons)]).order_by('message')
-        else:
-            lesson_messages = LessonMessage.objects.filter(message__lt=msg_id,
-                lesson__in=[lesson for lesson in chain(teach_lessons, study_lessons)]).order_by('message')[:15]
 
-        # Find all lessons the message is sent to and group the display of lessons
-        response = []
-        for message, lesson in groupby(lesson_messages, key=lambda lm: lm.message):
-            response.append({'message': message.dictify(),
-                             'lessons': [x.lesson.dictify() for x in list(lesson)]})
+# GET everything that changed since the given sync token, or all of it without
+# a token, together with the token for the next sync, see levelhub.sync
+@login_required
+def process_sync(request):
+    since = after_msg_id = None
+    if request.GET.get('token'):
+        try:
+            since, after_msg_id = sync.decode_token(request.GET['token'])
+        except (TypeError, ValueError, OverflowError):
+            return HttpResponseBadRequest('Invalid sync token')
+    return pack_json_response(request, sync.query_sync(request.user, since, after_msg_id,
+                                                       inbox=inbox.fanout_on_write(),
+                                                       profiles=request_profiles(request)))
+
+
+# GET the pulse once the user's requests or message feed changed since the
+# pulse token of the previous answer, or after PULSE_WAIT_TIMEOUT seconds.
+# Without a token the pulse is answered at once. A user without a profile has
+# no stamps, so nothing can change for them and the pulse always times out
+# with a None token.
+@login_required
+def process_pulse(request):
+    user = request.user
+    token = request.GET.get('token')
+    # The notifications come from commits on the primary, which the replica
+    # may not have yet
+    routers.pin_primary()
 
-        # Sort the final response by decreasing order of message id
-        response.sort(key=lambda entry: -entry['message']['message_id'])
+    def current_token():
+        stamp = stamps.last_modified((user.id, stamps.REQUESTS), (user.id, stamps.MESSAGES))
+        return sync.encode_token(stamp) if stamp is not None else None
 
-        return pack_json_response(request, response)
+    # Subscribe before reading the stamps so no change can slip in between
+    subscription = notify.subscribe(user.id)
+    try:
+        deadline = time.time() + PULSE_WAIT_TIMEOUT
+        current = current_token()
+        while current is None or (token and current == token):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            subscription.wait(min(remaining, PULSE_RECHECK_INTERVAL))
+            current = current_token()
+    finally:
+        subscription.close()
+    return pack_json_response(request, {'token': current, 'changed': current is not None and current != token})
 
 
 @csrf_exempt
@@ -775,6 +1040,9 @@ def debug_reset_db(request):
         lesson_reg_logs = [LessonRegLog(lesson_reg=lesson_reg_4,
                                         use_time='2014-07-01 16:30:00' if i < 8 else None) for i in range(18)]
         LessonRegLog.objects.bulk_create(lesson_reg_logs)
+        counters.rebuild_active_reg_counts()
+        counters.rebuild_reg_log_counters()
+        cache.clear()
 
         message = Message(sender=elsa,
                           body='Please bring your own winter coat to the class. Renting program is no longer '
@@ -793,8 +1061,7 @@ def debug_reset_db(request):
         lesson_message.save()
 
         if is_json_request(request):
-            return HttpResponse(json.dumps({}),
-                                content_type='application/json')
+            return pack_json_response(request, {}, add_pulse=False)
         else:
             return HttpResponse('<p>DB Reset successful</p>')
 